@@ -1,5 +1,7 @@
 #!/bin/sh
 
-sleep 60 # wait some time to give time to connect to internet and start the Desktop manager
+# no fixed sleep: the app waits for the modem or gpsd, a route to the
+# coordinator and the display itself, each up to BOOT_TIMEOUT seconds, and
+# starts every part as soon as what it needs is there
 
 tmux new -d -s car 'source $HOME/local_config ; DISPLAY=:0 python3 $HOME/ex.py'
@@ -15,6 +15,13 @@ export BLUE_BTN=16
 # and use serial port to get GPS data directly. 
 export USE_GPSD=True
 export MODEM_SERIAL_PORT="/dev/ttyUSB2"
+# the tty wvdial runs the PPP session on ($MODEM in wvdiald.pl); no GPS
+# source ever writes to it
+export PPP_SERIAL_PORT="/dev/ttyUSB2"
+# gpsd first, the SIM7600's spare AT port when gpsd stalls; see
+# GPS_SOURCES in the README
+# export MODEM_SERIAL_PORT="/dev/ttyUSB3"
+# export GPS_SOURCES="gpsd,at"
 
 export USERNAME="picker02-device1"
 
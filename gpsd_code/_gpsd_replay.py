@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+
+import nmea
+import log
+import metrics
+from fix import Fix
+from fixbuffer import FixRing
+
+
+logger = log.get("gps.replay")
+
+
+class GPS(threading.Thread):
+    """ Plays a recorded +CGPSINFO/NMEA capture (GPS_REPLAY_FILE) as if it
+    came from the modem: fixes are paced by their own UTC times, or one per
+    GPS_REPORT_INTERVAL when they have none, and stamped on arrival. Same
+    interface as _gpsd_serial.GPS. """
+
+    def __init__(self, gps_data_callback = None, path = None, loop = None, speed = 1., name = "replay"):
+        super(GPS, self).__init__()
+        self.name = name
+        self.fix_count = metrics.counter("gps_%s_fixes" % name)
+        self.callback_ms = metrics.histogram("gps_%s_callback_ms" % name)
+        self.callback = gps_data_callback
+        self.path = path or os.getenv("GPS_REPLAY_FILE")
+        self.loop = loop if loop is not None else os.getenv("GPS_REPLAY_LOOP", "false").lower() in ("1", "true", "yes")
+        self.speed = speed
+        self.interval = float(os.getenv("GPS_REPORT_INTERVAL", 1))
+        self.last_data = Fix() # no fix yet
+        self.fixes = FixRing(int(os.getenv("GPS_BUFFER_SIZE", 64)))
+        self.stop_event = threading.Event()
+
+        with open(self.path, 'rb') as f:
+            self.recorded = nmea.FixParser().feed(f.read())
+        logger.info("%d fixes in %s", len(self.recorded), self.path)
+
+    def set_callback(self, cb):
+        self.callback = cb
+
+    def subscribe(self, name=None):
+        return self.fixes.subscribe(name)
+
+    def get_latest_data(self):
+        return self.last_data
+
+    def _play(self):
+        previous = None
+        for recorded in self.recorded:
+            gap = self.interval
+            if previous is not None and recorded.utc and previous.utc and 0 < recorded.utc - previous.utc < 60:
+                gap = recorded.utc - previous.utc
+            previous = recorded
+            if self.stop_event.wait(gap / self.speed):
+                return
+
+            fix = Fix().copy_from(recorded)
+            fix.ts = time.time()
+            self.last_data = fix
+            self.fixes.publish(fix)
+            self.fix_count.inc()
+            if self.callback is not None:
+                with self.callback_ms.time():
+                    self.callback(fix)
+
+    def run(self):
+        self._play()
+        while self.loop and self.recorded and not self.stop_event.is_set():
+            self._play()
+        logger.info("end of %s", self.path)
+
+    def stop(self):
+        self.stop_event.set()
@@ -8,101 +8,97 @@
 
 
 import threading
-from gps import *
-import time
 import serial
-import re
 import os
+import time
+
+import nmea
+import log
+import metrics
+from fix import Fix
+from fixbuffer import FixRing
+
+
+logger = log.get("gps.serial")
+
 
 
 class GPS(threading.Thread):
-    def __init__(self, gps_data_callback = None):
+    def __init__(self, gps_data_callback = None, report_interval = None, port = None, commands = True, name = "at"):
         super(GPS, self).__init__()
-        
+
+        # per source counters, this thread is their only writer
+        self.name = name
+        self.fix_count = metrics.counter("gps_%s_fixes" % name)
+        self.no_fix_count = metrics.counter("gps_%s_no_fix" % name)
+        self.error_count = metrics.counter("gps_%s_parse_errors" % name)
+        # from the first byte available to the fixes parsed, idle waits excluded
+        self.read_ms = metrics.histogram("gps_%s_read_ms" % name)
+        self.callback_ms = metrics.histogram("gps_%s_callback_ms" % name)
+
         self.callback = gps_data_callback
-        #               (lat, lon, epx, epy, ts)
-        self.last_data = (-1, -1, -1, -1, -1)
+        self.last_data = Fix() # no fix yet
+        self.fixes = FixRing(int(os.getenv("GPS_BUFFER_SIZE", 64)))
         self.has_more_data = True
         self.stop_event = threading.Event()
 
-        self.ser = serial.Serial( str(os.getenv("MODEM_SERIAL_PORT")),115200)
-        self.ser.flushInput()  
-
-        self.regex = r"(\+CGPSINFO: )[^\\]*"
+        # seconds between unsolicited +CGPSINFO reports pushed by the modem
+        self.report_interval = int(report_interval or os.getenv("GPS_REPORT_INTERVAL", 1))
+        # commands=False for a port that streams NMEA on its own (the
+        # SIM7600's NMEA port), nothing is written to it then
+        self.commands = commands
 
-        self.gpsATBack = "+CGPSINFO: "
+        # the timeout only bounds how long a read blocks, so the stop event is
+        # still checked when the modem goes quiet
+        self.ser = serial.Serial( str(port or os.getenv("MODEM_SERIAL_PORT")),115200, timeout=1)
+        self.ser.reset_input_buffer()
 
-        self.gpsATResponseNoSignal = "+CGPSINFO: ,,,,,,,,"
+        self.parser = nmea.FixParser()
 
         self.pureDegLat = -1
         self.pureDegLog = -1
 
-    def _getPositionData(self):
-            #lat = -1
-            #lon = -1
-            epx = -1
-            epy = -1
-          
-            try:       
-                while True:
-
-                    print("Requesting GPS Data.....")
-                    self.ser.write(("AT+CGPSINFO" + "\r\n").encode())
-
-                    if self.ser.inWaiting():
-                        rawSerRead = self.ser.read(self.ser.inWaiting())
-
-                        decodedSerRead = rawSerRead.decode(errors="ignore")
-
-                        reprDecodedSerRead = repr(decodedSerRead)
-
-                        #print(reprDecodedSerRead)
-
-                        match = re.search(self.regex, reprDecodedSerRead)
-
-                        if match: # if the regex search method found a valid AT response for gps
-
-                            self.gpsATResponse = match.group() # actual AT response given back
-
-                            if self.gpsATResponse != self.gpsATResponseNoSignal: # if the gps AT response was not no signal
-                                
-                                #print(rawGPSData)
-                                gpsATResponseNoBack = self.gpsATResponse[len(self.gpsATBack):] # substring the full AT command giving back just the values, no back characters
-                                #print(gpsATResponseNoBack)
-                                gpsData = gpsATResponseNoBack.split(",") # gps data is now represented as an array/list
-                                #print(gpsData)
-           
-                                ddLat = float(gpsData[0][:2]) # dd of lat
-                                mmLat = float(gpsData[0][2:]) # mm.mmmmmm of lat
-
-                                dddLog = float(gpsData[2][:3]) # ddd of log
-                                mmLog = float(gpsData[2][3:]) # mm.mmmmmm of log
-
-
-                                self.pureDegLat = round(((mmLat / 60) + ddLat) * (1 if gpsData[1] == "N" else -1), 12)
-                                self.pureDegLog = round(((mmLog / 60) + dddLog) * (1 if gpsData[3] == "E" else -1), 12)
-
-                                positionLatLog = str(self.pureDegLat) + ", " + str(self.pureDegLog)
-                                print("GPS Online, Location: " + positionLatLog)
-                              
-                                return self.pureDegLat, self.pureDegLog, -1, -1, time.time()
-                            
-                            else: # else if there was the response of no gps signal
-                                print("GPS Online, No GPS Signal Detected")             
-                        else:
-                            print("Unexpected GPS Response")
-                    
-                    time.sleep(0.5)
-                    
-            
-            except:
-                return self.pureDegLat, self.pureDegLog, -1, -1, time.time()
-                print("stopping....")
-                self.ser.close()            
-                
+    def _startReporting(self):
+        # ask the SIM7600 to push +CGPSINFO every report_interval seconds
+        # instead of polling it with a bare AT+CGPSINFO
+        if not self.commands:
+            return
+        self.ser.write(("AT+CGPSINFO=%d" % self.report_interval + "\r\n").encode())
+
+    def _stopReporting(self):
+        if not self.commands:
+            return
+        self.ser.write(("AT+CGPSINFO=0" + "\r\n").encode())
+
+    def _readPositionData(self):
+        # block until at least one byte arrives, then take everything already
+        # buffered by the driver; only the time after the wait is measured
+        chunk = b"" if self.ser.in_waiting else self.ser.read(1)
+        t = time.perf_counter()
+        chunk += self.ser.read(self.ser.in_waiting)
+        if not chunk:
+            return []
+
+        no_fix, errors = self.parser.no_fix, self.parser.errors
+        fixes = self.parser.feed(chunk)
+        self.read_ms.observe((time.perf_counter() - t) * 1000.)
+        if self.parser.no_fix != no_fix:
+            self.no_fix_count.inc(self.parser.no_fix - no_fix)
+            logger.info("GPS online, no signal")
+        if self.parser.errors != errors:
+            self.error_count.inc(self.parser.errors - errors)
+            logger.warning("unparseable modem output, %d errors so far", self.parser.errors)
+
+        if fixes:
+            self.pureDegLat, self.pureDegLog = fixes[-1].lat, fixes[-1].lon
+        return fixes
 
     def set_callback(self, cb):
-        self.callback = cb        
+        self.callback = cb
+
+    def subscribe(self, name=None):
+        # independent reader of every fix, see fixbuffer.Subscription
+        return self.fixes.subscribe(name)
 
     def get_latest_data(self):
         return self.last_data
@@ -111,18 +107,25 @@ class GPS(threading.Thread):
         return self.has_more_data
 
     def run(self):
-        while not self.stop_event.is_set():
-            # get latest postion
-            lat, lon, epx, epy, ts = self._getPositionData() # blocking
-
-            self.last_data = (lat, lon, epx, epy, ts)
-            
-            # call callback 
-            if self.callback is not None:
-                self.callback(lat, lon, epx, epy, ts)
+        self._startReporting()
+
+        try:
+            while not self.stop_event.is_set():
+                for fix in self._readPositionData(): # blocking
+                    self.last_data = fix
+                    self.fixes.publish(fix) # never blocks on readers
+                    self.fix_count.inc()
+
+                    # call callback
+                    if self.callback is not None:
+                        with self.callback_ms.time():
+                            self.callback(fix)
+        finally:
+            logger.info("stopping")
+            self._stopReporting()
+            self.ser.close()
 
     def stop(self):
         self.stop_event.set()
-        
-        
+
 
@@ -2,52 +2,69 @@ import threading
 import gps
 from gps import *
 import time
+import os
+
+import fix
+import log
+import metrics
+from fix import Fix
+from fixbuffer import FixRing
+
+logger = log.get("gps.gpsd")
+
 
 class GPS(threading.Thread):
-    def __init__(self, gps_data_callback = None):
+    def __init__(self, gps_data_callback = None, host = None, port = None, name = "gpsd"):
         super(GPS, self).__init__()
-        self.gpsd = gps(mode=WATCH_ENABLE|WATCH_NEWSTYLE)
+        # per source counters, this thread is their only writer
+        self.name = name
+        self.fix_count = metrics.counter("gps_%s_fixes" % name)
+        self.no_fix_count = metrics.counter("gps_%s_no_fix" % name)
+        # gpsd.next() blocks until gpsd has a report, so this includes the idle wait
+        self.wait_ms = metrics.histogram("gps_%s_wait_ms" % name)
+        self.callback_ms = metrics.histogram("gps_%s_callback_ms" % name)
+        self.gpsd = gps(host=host or os.getenv("GPSD_HOST", "127.0.0.1"),
+                        port=str(port or os.getenv("GPSD_PORT", 2947)),
+                        mode=WATCH_ENABLE|WATCH_NEWSTYLE)
         self.callback = gps_data_callback
-        #               (lat, lon, epx, epy, ts)
-        self.last_data = (-1, -1, -1, -1, -1)
+        self.last_data = Fix() # no fix yet
+        self.fixes = FixRing(int(os.getenv("GPS_BUFFER_SIZE", 64)))
         self.has_more_data = True
         self.stop_event = threading.Event()
 
     def _getData(self):
         nx = None
+        t = time.perf_counter()
         try:
             nx = self.gpsd.next() # this is blocking
         except StopIteration:
-            print("ERROR no more data from gpsd")
+            logger.error("no more data from gpsd")
             self.has_more_data = False
             # TODO maybe stop the thread here?
-        
+        self.wait_ms.observe((time.perf_counter() - t) * 1000.)
         return nx
 
     def _getPositionData(self):
-            lat = -1
-            lon = -1
-            epx = -1
-            epy = -1
-            
             data = self._getData()
             
             while not(data['class'] == 'TPV'):
                 data = self._getData()
             
-            lat = getattr(data, 'lat', -1)
-            lon = getattr(data, 'lon', -1)
                     #print ("Your position: lat = " + str(lat) + ", lon = " + str(lon))
                     
-            epx = getattr(data, 'epx', -1)
-            epy = getattr(data, 'epy', -1)
-            print ("lat error = " + str(epy) + "m" + ", lon error = " + str(epx) + "m") 
+            epx = data.get('epx')
+            epy = data.get('epy')
+            logger.debug("lat error = %sm, lon error = %sm", epy, epx)
 
-            return lat, lon, epx, epy, time.time()
+            return fix.from_tpv(data, time.time())
 
     def set_callback(self, cb):
         self.callback = cb        
 
+    def subscribe(self, name=None):
+        # independent reader of every fix, see fixbuffer.Subscription
+        return self.fixes.subscribe(name)
+
     def get_latest_data(self):
         return self.last_data
 
@@ -57,13 +74,16 @@ class GPS(threading.Thread):
     def run(self):
         while not self.stop_event.is_set():
             # get latest postion
-            lat, lon, epx, epy, ts = self._getPositionData() # blocking
+            data = self._getPositionData() # blocking
+
+            self.last_data = data
+            self.fixes.publish(data) # never blocks on readers
+            (self.fix_count if data.valid else self.no_fix_count).inc()
 
-            self.last_data = (lat, lon, epx, epy, ts)
-            
             # call callback 
             if self.callback is not None:
-                self.callback(lat, lon, epx, epy, ts)
+                with self.callback_ms.time():
+                    self.callback(data)
 
     def stop(self):
         self.stop_event.set()
@@ -0,0 +1,473 @@
+import heapq
+import json
+import os
+import socket
+import threading
+import time
+
+import log
+import metrics
+import nmea
+from fix import Fix
+from fixbuffer import FixRing
+
+
+logger = log.get("atmux")
+
+COMMANDS = metrics.counter("at_commands")
+TIMEOUTS = metrics.counter("at_timeouts")
+ERRORS = metrics.counter("at_errors")
+CACHE_HITS = metrics.counter("at_cache_hits")
+URCS = metrics.counter("at_unsolicited")
+COMMAND_MS = metrics.histogram("at_command_ms")
+
+# lower runs first
+HIGH, NORMAL, LOW = 0, 1, 2
+
+FINAL = (b"OK", b"ERROR", b"NO CARRIER")
+FINAL_PREFIXES = (b"+CME ERROR", b"+CMS ERROR")
+
+# how long an answer to these may be reused, in seconds
+CACHE_AGE = {
+    "AT+CSQ": 5.,
+    "AT+CREG?": 10.,
+    "AT+CGREG?": 10.,
+    "AT+COPS?": 30.,
+    "AT+CGPS?": 10.,
+}
+
+
+class ATError(Exception):
+    pass
+
+
+class ATTimeout(ATError):
+    pass
+
+
+class Command(object):
+    """ One AT command on its way through the multiplexer. The answer is
+    `lines` (everything between the echo and the final result code) and
+    `result` (OK, ERROR, +CME ERROR: ..., or None on timeout). """
+
+    def __init__(self, cmd, priority=NORMAL, timeout=2., callback=None):
+        self.cmd = cmd
+        self.priority = priority
+        self.timeout = timeout
+        self.callbacks = [callback] if callback else []
+        self.lines = []
+        self.result = None
+        self.done = threading.Event()
+        self.queued = time.time()
+        self.finished = None
+
+    @property
+    def ok(self):
+        return self.result == "OK"
+
+    def wait(self, timeout=None):
+        # -> the answer lines, raising ATTimeout / ATError
+        if not self.done.wait(timeout if timeout is not None else self.timeout + 30.):
+            raise ATTimeout(self.cmd)
+        if self.result is None:
+            raise ATTimeout(self.cmd)
+        if not self.ok:
+            raise ATError("%s: %s" % (self.cmd, self.result))
+        return self.lines
+
+    def _finish(self, result):
+        self.result = result
+        self.finished = time.time()
+        self.done.set()
+        for cb in self.callbacks:
+            try:
+                cb(self)
+            except Exception as e:
+                logger.warning("AT callback failed: %r", e)
+
+
+class ATMux(threading.Thread):
+    """ Owns the modem's AT port and shares it.
+
+    Commands from any number of clients go into one priority queue and are
+    written back to back: the next one leaves as soon as the modem's final
+    result code for the previous one arrives (or its timeout runs out), not
+    after a fixed sleep, and each client waits only on its own command.
+    Answers to status queries (CACHE_AGE) are reused for a while, and an
+    identical query already queued is shared instead of sent twice.
+    Unsolicited +CGPSINFO / NMEA lines become fixes in a FixRing, so the mux
+    also stands in for _gpsd_serial.GPS (subscribe(), callback, stop()).
+    Local processes reach it over ATMUX_SOCKET (empty for none), served
+    while the mux runs, see serve(). Signal and registration are polled
+    every ATMUX_TELEMETRY seconds (0 for never) and kept as gauges.
+    """
+
+    def __init__(self, gps_data_callback=None, port=None, baudrate=115200, report_interval=None, ser=None,
+                 socket_path=None, telemetry_interval=None, name="atmux"):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.callback = gps_data_callback
+        # the reader thread is the only writer of these
+        self.name = name
+        self.fix_count = metrics.counter("gps_%s_fixes" % name)
+        self.no_fix_count = metrics.counter("gps_%s_no_fix" % name)
+        self.report_interval = int(report_interval or os.getenv("GPS_REPORT_INTERVAL", 1))
+        self.socket_path = socket_path if socket_path is not None else os.getenv("ATMUX_SOCKET", "/tmp/smart_picker-at.sock")
+        self.telemetry_interval = float(telemetry_interval if telemetry_interval is not None
+                                        else os.getenv("ATMUX_TELEMETRY", 30))
+        self.rssi = self.reg = None # last polled, for the gauges
+        self._server = None
+        if ser is None:
+            import serial
+            ser = serial.Serial(port or os.getenv("MODEM_SERIAL_PORT"), baudrate, timeout=0.2)
+            ser.reset_input_buffer()
+        self.ser = ser
+
+        self.last_data = Fix() # no fix yet
+        self.fixes = FixRing(int(os.getenv("GPS_BUFFER_SIZE", 64)))
+        self.parser = nmea.FixParser()
+        self.framer = nmea.LineFramer()
+        self.urc_listeners = []
+        self.stop_event = threading.Event()
+
+        self._cond = threading.Condition()
+        self._queue = [] # (priority, seq, Command)
+        self._seq = 0
+        self._inflight = None
+        self._pending = {} # cmd -> queued Command, for sharing identical queries
+        self._cache = {} # cmd -> finished Command
+        self._writer = threading.Thread(target=self._writeLoop)
+        self._writer.daemon = True
+        metrics.gauge("at_queue_depth", lambda: len(self._queue))
+        metrics.gauge("modem_rssi_dbm", lambda: self.rssi)
+        metrics.gauge("modem_registration", lambda: self.reg)
+
+    # clients
+    def submit(self, cmd, priority=NORMAL, timeout=2., callback=None, max_age=None):
+        # queue cmd, -> Command (never blocks)
+        max_age = CACHE_AGE.get(cmd, 0.) if max_age is None else max_age
+        with self._cond:
+            cached = self._cache.get(cmd)
+            if cached is not None and time.time() - cached.finished < max_age:
+                CACHE_HITS.inc()
+                if callback:
+                    callback(cached)
+                return cached
+            shared = self._pending.get(cmd) if max_age else None
+            if shared is not None:
+                if callback:
+                    shared.callbacks.append(callback)
+                return shared
+
+            command = Command(cmd, priority, timeout, callback)
+            self._seq += 1
+            heapq.heappush(self._queue, (priority, self._seq, command))
+            if max_age:
+                self._pending[cmd] = command
+            self._cond.notify_all()
+            return command
+
+    def command(self, cmd, priority=NORMAL, timeout=2., max_age=None):
+        # blocking form of submit(), -> answer lines
+        return self.submit(cmd, priority, timeout, max_age=max_age).wait()
+
+    def signal_quality(self, max_age=None):
+        # -> (rssi dBm or None, ber or None) from +CSQ
+        for line in self.command("AT+CSQ", LOW, max_age=max_age):
+            if line.startswith("+CSQ:"):
+                rssi, ber = [int(v) for v in line[5:].split(",")]
+                return (-113 + 2 * rssi if rssi != 99 else None), (ber if ber != 99 else None)
+        return None, None
+
+    def registration(self, max_age=None):
+        # -> network registration status number from +CREG (1 home, 5 roaming)
+        for line in self.command("AT+CREG?", LOW, max_age=max_age):
+            if line.startswith("+CREG:"):
+                return int(line.split(",")[1])
+        return None
+
+    def telemetry(self):
+        fix = self.last_data
+        try:
+            self.rssi = self.signal_quality()[0]
+            self.reg = self.registration()
+        except ATError as e:
+            logger.info("telemetry incomplete: %s", e)
+        return {'rssi_dbm': self.rssi, 'registration': self.reg,
+                'fix': {'lat': fix.lat, 'lon': fix.lon, 'ts': fix.ts} if fix.valid else None}
+
+    def _pollTelemetry(self):
+        # low priority, so never in the way of a client's command
+        while not self.stop_event.wait(self.telemetry_interval):
+            self.telemetry()
+
+    # the same interface as _gpsd_serial.GPS
+    def subscribe(self, name=None):
+        return self.fixes.subscribe(name)
+
+    def get_latest_data(self):
+        return self.last_data
+
+    def set_callback(self, cb):
+        self.callback = cb
+
+    # port handling
+    def _writeLoop(self):
+        while not self.stop_event.is_set():
+            with self._cond:
+                while self._inflight is not None:
+                    # wait for the final result code, or give up on it
+                    remaining = self._inflight_deadline - time.time()
+                    if remaining <= 0:
+                        TIMEOUTS.inc()
+                        logger.warning("%s timed out", self._inflight.cmd)
+                        self._complete(None)
+                        break
+                    self._cond.wait(remaining)
+                if self.stop_event.is_set():
+                    return
+                if not self._queue:
+                    self._cond.wait(0.5)
+                    continue
+                command = heapq.heappop(self._queue)[2]
+                self._inflight = command
+                self._inflight_deadline = time.time() + command.timeout
+                self._inflight_sent = time.perf_counter()
+            try:
+                self.ser.write((command.cmd + "\r\n").encode())
+            except Exception as e:
+                logger.error("cannot write to modem: %s", e)
+                with self._cond:
+                    self._complete("ERROR")
+
+    def _complete(self, result):
+        # called with self._cond held
+        command = self._inflight
+        self._inflight = None
+        if self._pending.get(command.cmd) is command:
+            del self._pending[command.cmd]
+        COMMANDS.inc()
+        COMMAND_MS.observe((time.perf_counter() - self._inflight_sent) * 1000.)
+        if result is not None and result != "OK":
+            ERRORS.inc()
+        if result == "OK" and command.cmd in CACHE_AGE:
+            self._cache[command.cmd] = command
+        self._cond.notify_all()
+        command._finish(result)
+
+    def _line(self, line):
+        if line.startswith(b"+CGPSINFO") or line.startswith(b"$"):
+            self._gnss(line)
+            inflight = self._inflight
+            if inflight is not None and inflight.cmd == "AT+CGPSINFO":
+                inflight.lines.append(line.decode("ascii", "replace"))
+            return
+
+        with self._cond:
+            inflight = self._inflight
+            if inflight is not None:
+                if line == inflight.cmd.encode():
+                    return # echo
+                if line in FINAL or line.startswith(FINAL_PREFIXES):
+                    self._complete(line.decode("ascii", "replace"))
+                    return
+                inflight.lines.append(line.decode("ascii", "replace"))
+                return
+
+        URCS.inc()
+        for listener in self.urc_listeners:
+            listener(line.decode("ascii", "replace"))
+
+    def _gnss(self, line):
+        no_fix = self.parser.no_fix
+        fix = self.parser.parse_line(line)
+        if self.parser.no_fix != no_fix:
+            self.no_fix_count.inc()
+        if fix is None:
+            return
+        self.fix_count.inc()
+        self.last_data = fix
+        self.fixes.publish(fix)
+        if self.callback is not None:
+            self.callback(fix)
+
+    def run(self):
+        self._writer.start()
+        # the modem pushes +CGPSINFO on its own, no polling needed
+        self.submit("AT+CGPSINFO=%d" % self.report_interval, HIGH)
+        if self.socket_path:
+            try:
+                self.serve(self.socket_path)
+            except (IOError, OSError) as e:
+                logger.error("cannot serve %s: %s", self.socket_path, e)
+        if self.telemetry_interval > 0:
+            poller = threading.Thread(target=self._pollTelemetry)
+            poller.daemon = True
+            poller.start()
+        try:
+            while not self.stop_event.is_set():
+                chunk = self.ser.read(self.ser.in_waiting or 1)
+                if not chunk:
+                    continue
+                for frame in self.framer.feed(chunk):
+                    line = frame.strip()
+                    if line:
+                        self._line(line)
+        except Exception as e:
+            if not self.stop_event.is_set():
+                logger.error("modem port failed: %s", e)
+        finally:
+            try:
+                self.ser.write(b"AT+CGPSINFO=0\r\n")
+            except Exception:
+                pass
+            self.ser.close()
+
+    def stop(self):
+        self.stop_event.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._server is not None:
+            # no file left behind for ATClient to be refused on
+            self._server.close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    # local clients
+    def serve(self, path=None):
+        # line protocol on a Unix socket: "AT..." -> one JSON answer,
+        # "TELEMETRY" -> signal/registration/fix, "WATCH" -> a JSON line per fix
+        path = path or os.getenv("ATMUX_SOCKET", "/tmp/smart_picker-at.sock")
+        if os.path.exists(path):
+            os.remove(path) # left by a mux that did not stop cleanly
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(8)
+        self.socket_path, self._server = path, server
+
+        def accept():
+            while not self.stop_event.is_set():
+                try:
+                    conn, _ = server.accept()
+                except OSError: # closed by stop()
+                    return
+                t = threading.Thread(target=self._client, args=(conn,))
+                t.daemon = True
+                t.start()
+
+        t = threading.Thread(target=accept)
+        t.daemon = True
+        t.start()
+        return server
+
+    def _client(self, conn):
+        reader = conn.makefile('rb')
+        send = lambda obj: conn.sendall((json.dumps(obj) + "\n").encode())
+        try:
+            for raw in reader:
+                request = raw.decode("ascii", "replace").strip()
+                if request.upper() == "WATCH":
+                    self._watch(send)
+                    return
+                if request.upper() == "TELEMETRY":
+                    send(self.telemetry())
+                elif request.upper().startswith("AT"):
+                    command = self.submit(request)
+                    command.done.wait(command.timeout + 5.)
+                    send({'cmd': request, 'lines': command.lines, 'result': command.result})
+                elif request:
+                    send({'error': 'unknown request'})
+        except (IOError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _watch(self, send):
+        sub = self.subscribe("watch")
+        try:
+            while not self.stop_event.is_set():
+                fix = sub.next(timeout=1.)
+                if fix is not None:
+                    send({'lat': fix.lat, 'lon': fix.lon, 'alt': fix.alt, 'speed': fix.speed,
+                          'utc': fix.utc, 'ts': fix.ts, 'flags': fix.flags})
+        finally:
+            sub.close()
+
+
+class ATClient(object):
+    """ Talks to an ATMux from another process over ATMUX_SOCKET. """
+
+    def __init__(self, path=None, timeout=10.):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path or os.getenv("ATMUX_SOCKET", "/tmp/smart_picker-at.sock"))
+        self._reader = self.sock.makefile('rb')
+
+    def request(self, line):
+        self.sock.sendall((line + "\n").encode())
+        return json.loads(self._reader.readline())
+
+    def command(self, cmd):
+        answer = self.request(cmd)
+        if answer.get('result') != "OK":
+            raise ATError("%s: %s" % (cmd, answer.get('result')))
+        return answer['lines']
+
+    def watch(self):
+        # yields a dict per fix
+        self.sock.sendall(b"WATCH\n")
+        for line in self._reader:
+            yield json.loads(line)
+
+    def close(self):
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    # throughput against replay's simulated modem: commands/s when each one
+    # is sent on the previous final result, versus waiting a fixed 100 ms
+    # per command like a poll loop does, and many clients at once
+    from replay import PtyModem, synthetic, epochs
+
+    modem = PtyModem(epochs(synthetic(10)))
+    modem.start()
+    mux = ATMux(port=modem.port, socket_path="")
+    mux.start()
+    mux.command("AT")
+
+    n = 200
+    t = time.perf_counter()
+    for _ in range(n):
+        mux.command("AT+CSQ", max_age=0)
+    back_to_back = n / (time.perf_counter() - t)
+
+    t = time.perf_counter()
+    for _ in range(20):
+        mux.submit("AT+CSQ", max_age=0)
+        time.sleep(0.1)
+    fixed = 20 / (time.perf_counter() - t)
+
+    results = []
+    def client():
+        for _ in range(50):
+            results.append(mux.command("AT+CREG?", max_age=0))
+    clients = [threading.Thread(target=client) for _ in range(8)]
+    t = time.perf_counter()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    shared = len(results) / (time.perf_counter() - t)
+
+    t = time.perf_counter()
+    for _ in range(n):
+        mux.signal_quality()
+    cached = n / (time.perf_counter() - t)
+
+    print("back to back %.0f cmd/s, fixed 100 ms wait %.1f cmd/s, 8 clients %.0f cmd/s, cached +CSQ %.0f/s"
+          % (back_to_back, fixed, shared, cached))
+    print("signal quality:", mux.signal_quality())
+    mux.stop()
+    modem.stop()
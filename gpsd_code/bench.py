@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the device pipeline, written as JSON and compared against a
+# stored baseline so a slowdown shows up before it reaches the fleet.
+#
+#   python bench.py                      # print results
+#   python bench.py --save baseline.json # record a baseline (on the Pi)
+#   python bench.py --baseline baseline.json --tolerance 0.2
+#                                        # exit 1 on a >20% regression
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import nmea
+import fix
+from fix import Fix
+from orders import OrdersFilter, _broadcast
+
+
+def _rate(fn, n, repeat=3):
+    # calls/s of fn(), best of `repeat` runs of n calls
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _ in range(n):
+            fn()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return n / best
+
+
+def _result(value, unit, higher_is_better=True):
+    return {'value': round(value, 3), 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def bench_at_parsing(results):
+    # what _gpsd_serial does with every read: +CGPSINFO bytes -> Fix
+    line = b"+CGPSINFO: 5211.123456,N,00033.654321,W,171120,101010.0,12.3,1.2,45.0\r\n"
+    parser = nmea.FixParser()
+    results['at_parse'] = _result(_rate(lambda: parser.feed(line), 20000), 'reports/s')
+    # the regex path it replaced, at_parse should stay above it
+    results['at_parse_legacy'] = _result(_rate(lambda: nmea._legacy_parse(line), 20000), 'reports/s')
+    results['at_parse_vs_legacy'] = _result(results['at_parse']['value'] / results['at_parse_legacy']['value'], 'x')
+
+    # the same, arriving in arbitrary serial read sized chunks
+    stream = line * 50
+    chunks = [stream[i:i + 37] for i in range(0, len(stream), 37)]
+    parser = nmea.FixParser()
+    def feed():
+        for c in chunks:
+            parser.feed(c)
+    results['at_parse_chunked'] = _result(_rate(feed, 400) * 50, 'reports/s')
+
+
+def bench_tpv(results):
+    # what _gpsd_service does per gpsd report: JSON line -> TPV dict -> Fix
+    raw = json.dumps({'class': 'TPV', 'device': '/dev/ttyUSB1', 'mode': 3,
+                      'time': '2020-11-17T10:10:10.000Z', 'lat': 52.18539, 'lon': -0.56090,
+                      'alt': 12.3, 'epx': 3.5, 'epy': 4.2, 'speed': 0.6, 'track': 45.0})
+    results['tpv_decode'] = _result(_rate(lambda: fix.from_tpv(json.loads(raw)), 20000), 'reports/s')
+
+
+def bench_rows(results):
+    # rows.RowResolver per fix on a 4000 row farm, a picker inside a row
+    import rows
+    farm = rows.farm()
+    resolver = rows.RowResolver(rows.RowIndex(farm), default='')
+    lats, lons = zip(*farm[1234][1])
+    f = Fix(sum(lats) / 4, sum(lons) / 4)
+    results['row_lookup'] = _result(_rate(lambda: resolver.update(f), 20000), 'fixes/s')
+
+
+def bench_send_gps(results):
+    # ws.WS.send_gps: encoding plus queueing in the outbox, per uplink mode
+    import ws
+
+    directory = tempfile.mkdtemp()
+    try:
+        os.environ['WS_JOURNAL'] = os.path.join(directory, 'journal')
+        f = Fix(52.18539, -0.56090, ts=time.time(), epx=3.5, epy=4.2)
+        for mode in ('compat', 'json', 'binary'):
+            os.environ['UPLINK_MODE'] = mode
+            link = ws.WS(address='ws://127.0.0.1:9', user_name='bench-picker')
+            def send():
+                f.lat += 1e-7
+                f.ts += 0.5
+                link.send_gps(f)
+            results['send_gps_%s' % mode] = _result(_rate(send, 10000), 'fixes/s')
+            results['send_gps_%s_bytes' % mode] = _result(link.uplink.stats()['bytes_per_fix'], 'bytes/fix', False)
+    finally:
+        os.environ.pop('UPLINK_MODE', None)
+        os.environ.pop('WS_JOURNAL', None)
+        shutil.rmtree(directory)
+
+
+def bench_update_orders(results):
+    user = 'picker02-device1'
+    for pickers in (10, 100, 1000):
+        raw = _broadcast(pickers, user)
+        f = OrdersFilter(user)
+        def feed():
+            f.invalidate()
+            f.feed(raw)
+        results['update_orders_%d' % pickers] = _result(_rate(feed, max(200, 100000 // pickers)), 'frames/s')
+
+
+class _LedProbe(object):
+    """ Stands in for buttons.Buttons, remembers when each LED was set. """
+
+    def __init__(self):
+        self.changed = threading.Event()
+        self.leds = {}
+
+    def _set(self, led, value):
+        self.leds[led] = (value, time.perf_counter())
+        self.changed.set()
+
+    def setRedLed(self, value):
+        self._set('r', value)
+
+    def setGreenLed(self, value):
+        self._set('g', value)
+
+    def setBlueLed(self, value):
+        self._set('b', value)
+
+
+class _NullWS(object):
+    def call_robot(self):
+        pass
+
+    def cancel_robot(self):
+        pass
+
+    def set_loaded(self):
+        pass
+
+
+def bench_button_to_led(results, presses=50):
+    # a green press in REGISTERED until the red LED is on, through the
+    # dispatcher, the state table and the UI frame on the display thread;
+    # the app's log and the headless display go to a buffer instead of the report
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        _button_to_led(results, presses)
+
+
+def _button_to_led(results, presses):
+    os.environ['DISPLAY_BACKEND'] = 'headless'
+    import main
+    import ui
+
+    app = main.MainApp(gps=object())
+    probe = _LedProbe()
+    app.ui = ui.UI(app._gui, probe)
+    app._ws = _NullWS()
+    app.commands.debounce = 0.
+
+    # handler alone: state table, LEDs and text recorded, frame applied,
+    # before the display thread runs frames of its own
+    def handle():
+        app.on_event('car_INIT')
+        app.on_event('green')
+        app.ui.flush()
+    results['button_handler'] = _result(1e6 / _rate(handle, 2000), 'us', False)
+
+    app.commands.start()
+    app.ui.start()
+    app._gui.setupMainWindow()
+    display = threading.Thread(target=app._gui.loopMainWindow)
+    display.daemon = True
+    display.start()
+
+    samples = []
+    for _ in range(presses):
+        app.on_event('car_INIT')
+        time.sleep(0.05) # green LED on, red off
+        probe.changed.clear()
+        t = time.perf_counter()
+        app.press('green', app.green_callback)(None)
+        while probe.leds.get('r', (False, 0))[0] is not True:
+            probe.changed.wait(1.)
+            probe.changed.clear()
+        samples.append(probe.leds['r'][1] - t)
+    app._gui.quit()
+    app.commands.stop()
+
+    samples.sort()
+    results['button_to_led_p50'] = _result(samples[len(samples) // 2] * 1000, 'ms', False)
+    results['button_to_led_p90'] = _result(samples[int(len(samples) * 0.9)] * 1000, 'ms', False)
+
+
+BENCHMARKS = [bench_at_parsing, bench_tpv, bench_rows, bench_send_gps, bench_update_orders, bench_button_to_led]
+
+
+def run():
+    results = {}
+    for bench in BENCHMARKS:
+        bench(results)
+    return {
+        'meta': {'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                 'python': platform.python_version(), 'machine': platform.machine(),
+                 'node': platform.node()},
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    # -> names of the results that got worse than the baseline by more
+    # than `tolerance` (0.2 = 20%)
+    regressions = []
+    for name, base in baseline['results'].items():
+        new = report['results'].get(name)
+        if new is None or not base['value']:
+            continue
+        change = new['value'] / base['value'] - 1
+        if not base['higher_is_better']:
+            change = -change
+        new['baseline'] = base['value']
+        new['change'] = round(change, 3)
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the device pipeline")
+    parser.add_argument('--baseline', help="compare against this stored report")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    parser.add_argument('--save', help="write the report here, e.g. as the new baseline")
+    args = parser.parse_args()
+
+    report = run()
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,187 @@
+import contextlib
+import importlib
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import log
+
+
+logger = log.get("boot")
+
+
+def uptime():
+    # seconds since the system booted, None off Linux
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# readiness checks: cheap, non-blocking beyond a short connect timeout
+
+def device_ready(path):
+    return bool(path) and os.path.exists(path) and os.access(path, os.R_OK | os.W_OK)
+
+
+def gpsd_ready(host=None, port=None):
+    try:
+        socket.create_connection((host or os.getenv("GPSD_HOST", "127.0.0.1"),
+                                  int(port or os.getenv("GPSD_PORT", 2947))), 0.5).close()
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def route_ready(address=None):
+    # a route to the coordinator (and its name resolving); a UDP connect
+    # only asks the kernel, nothing is sent
+    url = urlsplit(address or os.getenv('WS_ADDRESS') or '')
+    if not url.hostname:
+        return True
+    try:
+        for family, kind, proto, _, addr in socket.getaddrinfo(url.hostname, url.port or 80, 0, socket.SOCK_DGRAM):
+            s = socket.socket(family, kind, proto)
+            try:
+                s.connect(addr)
+                return True
+            finally:
+                s.close()
+    except OSError:
+        pass
+    return False
+
+
+def display_ready(display=None):
+    # the X server's socket for ":N" displays; anything else is not ours
+    # to check
+    display = display if display is not None else os.getenv('DISPLAY', '')
+    if not display.startswith(':'):
+        return True
+    path = '/tmp/.X11-unix/X%s' % display[1:].split('.')[0]
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(0.5)
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+class Boot(object):
+    """ Brings the app up in stages and keeps their timings.
+
+    Subsystems start on their own thread as soon as what they need is
+    there (a device node, gpsd, a route, the display), instead of after
+    one fixed sleep; a wait that runs past BOOT_TIMEOUT seconds is logged
+    and the subsystem started anyway, it has its own retries. Imports of
+    the heavy modules are deferred to the stage that needs them and timed.
+    Once every mark in `until` has been hit, the breakdown is logged.
+    """
+
+    def __init__(self, until=(), timeout=None):
+        self.started = time.time()
+        self.uptime = uptime()
+        self.timeout = float(timeout if timeout is not None else os.getenv('BOOT_TIMEOUT', 120))
+        self.until = set(until)
+        self.timings = [] # (kind, name, start offset, seconds)
+        self.marks = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _record(self, kind, name, start, seconds):
+        with self._lock:
+            self.timings.append((kind, name, start - self.started, seconds))
+
+    def load(self, name):
+        # import a module, timed
+        t = time.time()
+        module = importlib.import_module(name)
+        self._record('import', name, t, time.time() - t)
+        return module
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - t
+            self._record('stage', name, t, seconds)
+            logger.info("%s up in %.0f ms", name, seconds * 1000)
+
+    def wait(self, name, check, interval=0.2):
+        # poll check() until it holds or BOOT_TIMEOUT runs out
+        t = time.time()
+        ready = check()
+        while not ready and time.time() - t < self.timeout:
+            time.sleep(interval)
+            ready = check()
+        return self._waited(name, t, ready)
+
+    async def wait_async(self, name, check, interval=0.2):
+        # wait() for an event loop: check() runs on the default executor,
+        # it may block for its connect timeout
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        t = time.time()
+        ready = await loop.run_in_executor(None, check)
+        while not ready and time.time() - t < self.timeout:
+            await asyncio.sleep(interval)
+            ready = await loop.run_in_executor(None, check)
+        return self._waited(name, t, ready)
+
+    def _waited(self, name, t, ready):
+        self._record('wait', name, t, time.time() - t)
+        if ready:
+            logger.info("%s ready after %.1f s", name, time.time() - t)
+        else:
+            logger.warning("%s not ready after %.0f s, starting anyway", name, self.timeout)
+        return ready
+
+    def spawn(self, name, fn, *waits):
+        # fn on its own thread once each (name, check) in waits is ready
+        def run():
+            for what, check in waits:
+                self.wait(what, check)
+            try:
+                with self.stage(name):
+                    fn()
+            except Exception:
+                logger.exception("%s failed to start", name)
+        thread = threading.Thread(target=run, name="boot-" + name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def mark(self, name):
+        # a milestone, the first time it is reached
+        if name in self.marks:
+            return
+        with self._lock:
+            if name in self.marks:
+                return
+            self.marks[name] = time.time() - self.started
+            done = self.until and self.until.issubset(self.marks)
+        since_boot = " (%.1f s after system boot)" % (self.uptime + self.marks[name]) if self.uptime is not None else ""
+        logger.info("%s %.2f s after start%s", name, self.marks[name], since_boot)
+        if done:
+            self.report()
+
+    def report(self):
+        with self._lock:
+            timings = sorted(self.timings, key=lambda t: t[2])
+            marks = sorted(self.marks.items(), key=lambda m: m[1])
+        # one message, the rate limit would hold back lines of the same form
+        lines = ["  %-6s %-24s at %6.2f s  %8.1f ms" % (kind, name, start, seconds * 1000)
+                 for kind, name, start, seconds in timings]
+        lines += ["  mark   %-24s at %6.2f s" % m for m in marks]
+        logger.info("startup:\n%s", "\n".join(lines))
+        return {'timings': timings, 'marks': dict(marks)}
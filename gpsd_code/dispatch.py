@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+
+import log
+import metrics
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+logger = log.get("dispatch")
+
+HANDLER_MS = metrics.histogram("button_handler_ms")
+
+
+class Dispatcher(threading.Thread):
+    """ Runs button handlers one after the other off the GPIO and Tk threads.
+
+    press() only debounces and queues, so whichever thread saw the press is
+    free again at once; handlers run in press order on this thread. A second
+    press of the same button within `debounce` seconds (contact bounce, the
+    screen and the hardware button hit together, an impatient picker) is
+    dropped. `submit` lets another runtime run the handlers instead, e.g.
+    on an event loop.
+    """
+
+    def __init__(self, debounce=None, submit=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.debounce = float(debounce if debounce is not None else os.getenv('BUTTON_DEBOUNCE', 0.3))
+        self._queue = queue.Queue()
+        self._submit = submit or self._enqueue
+        self._last = {}
+        self._lock = threading.Lock()
+        self.debounced = 0
+        self.handled = 0
+        self.max_latency = 0.
+
+    def press(self, name, fn, *args):
+        now = time.time()
+        with self._lock:
+            if now - self._last.get(name, 0.) < self.debounce:
+                self.debounced += 1
+                return False
+            self._last[name] = now
+        self._submit(self._timed, now, fn, *args)
+        return True
+
+    def call(self, fn, *args):
+        self._submit(fn, *args)
+
+    def later(self, seconds, fn, *args):
+        timer = threading.Timer(seconds, self.call, (fn,) + args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _timed(self, pressed, fn, *args):
+        # time from the press to the handler, the UI shows it within a frame
+        self.max_latency = max(self.max_latency, time.time() - pressed)
+        self.handled += 1
+        fn(*args)
+
+    def _enqueue(self, fn, *args):
+        self._queue.put((fn, args))
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            fn, args = item
+            try:
+                with HANDLER_MS.time():
+                    fn(*args)
+            except Exception as e:
+                logger.exception("button handler failed: %r", e)
+
+    def stop(self):
+        self._queue.put(None)
@@ -0,0 +1,211 @@
+import calendar
+import struct
+import time
+
+
+# validity flags, a field is only meaningful when its flag is set
+HAS_POSITION = 0x01
+HAS_ALT = 0x02
+HAS_SPEED = 0x04
+HAS_COURSE = 0x08
+HAS_UTC = 0x10
+HAS_SATS = 0x20
+HAS_HDOP = 0x40
+HAS_ERROR = 0x80
+
+# fixed little-endian record of the track files (track.py), in FIELDS
+# order; kalman.FIX_DTYPE is derived from it. Only the track uses it: the
+# uplink sends delta-coded batches (protocol.py), replay raw modem captures
+#   lat lon alt speed course utc ts epx epy hdop sats flags
+FIX_STRUCT = struct.Struct("<ddfffddfffBB")
+FIX_SIZE = FIX_STRUCT.size
+FIELDS = ('lat', 'lon', 'alt', 'speed', 'course', 'utc', 'ts', 'epx', 'epy', 'hdop', 'sats', 'flags')
+
+
+class Fix(object):
+    """ One GNSS position report.
+
+    Replaces the old (lat, lon, epx, epy, ts) tuple and its -1 sentinels:
+    every optional field has a bit in `flags`, and unset fields hold 0.
+    `ts` is the local receive time, `utc` the time reported by the receiver.
+    """
+
+    # _raw only holds the undecoded fields of a LazyFix
+    __slots__ = FIELDS + ('_raw',)
+
+    def __init__(self, lat=None, lon=None, alt=None, speed=None, course=None,
+                 utc=None, ts=0.0, epx=None, epy=None, hdop=None, sats=None):
+        self.lat = lat or 0.0
+        self.lon = lon or 0.0
+        self.ts = ts
+        flags = 0
+        if lat is not None and lon is not None:
+            flags |= HAS_POSITION
+
+        self.alt = alt or 0.0
+        if alt is not None:
+            flags |= HAS_ALT
+        self.speed = speed or 0.0
+        if speed is not None:
+            flags |= HAS_SPEED
+        self.course = course or 0.0
+        if course is not None:
+            flags |= HAS_COURSE
+        self.utc = utc or 0.0
+        if utc is not None:
+            flags |= HAS_UTC
+        self.sats = sats or 0
+        if sats is not None:
+            flags |= HAS_SATS
+        self.hdop = hdop or 0.0
+        if hdop is not None:
+            flags |= HAS_HDOP
+        self.epx = epx or 0.0
+        self.epy = epy or 0.0
+        if epx is not None and epy is not None:
+            flags |= HAS_ERROR
+
+        self.flags = flags
+
+    @property
+    def valid(self):
+        return bool(self.flags & HAS_POSITION)
+
+    def has(self, flag):
+        return bool(self.flags & flag)
+
+    @property
+    def accuracy(self):
+        # horizontal error estimate in metres, -1 when unknown (old protocol)
+        if self.flags & HAS_ERROR:
+            return max(self.epx, self.epy)
+        return -1
+
+    def copy_from(self, other):
+        if self.__class__ is not Fix:
+            self.__class__ = Fix # drop what is left of an older LazyFix
+        if other.__class__ is not Fix:
+            # still undecoded: so is the copy, whoever reads it decodes it
+            self.__class__ = other.__class__
+            self._raw = other._raw
+        else:
+            self.alt = other.alt
+            self.speed = other.speed
+            self.course = other.course
+            self.hdop = other.hdop
+        self.lat = other.lat
+        self.lon = other.lon
+        self.utc = other.utc
+        self.ts = other.ts
+        self.epx = other.epx
+        self.epy = other.epy
+        self.sats = other.sats
+        self.flags = other.flags
+        return self
+
+    def as_tuple(self):
+        # the legacy (lat, lon, epx, epy, ts) form
+        if not self.flags & HAS_POSITION:
+            return (-1, -1, -1, -1, -1)
+        if self.flags & HAS_ERROR:
+            return (self.lat, self.lon, self.epx, self.epy, self.ts)
+        return (self.lat, self.lon, -1, -1, self.ts)
+
+    def pack(self):
+        return FIX_STRUCT.pack(self.lat, self.lon, self.alt, self.speed, self.course,
+                               self.utc, self.ts, self.epx, self.epy, self.hdop,
+                               self.sats, self.flags)
+
+    def pack_into(self, buf, offset=0):
+        FIX_STRUCT.pack_into(buf, offset, self.lat, self.lon, self.alt, self.speed,
+                             self.course, self.utc, self.ts, self.epx, self.epy,
+                             self.hdop, self.sats, self.flags)
+
+    def unpack_from(self, buf, offset=0):
+        (self.lat, self.lon, self.alt, self.speed, self.course, self.utc, self.ts,
+         self.epx, self.epy, self.hdop, self.sats, self.flags) = FIX_STRUCT.unpack_from(buf, offset)
+        return self
+
+    @classmethod
+    def unpack(cls, buf, offset=0):
+        return cls().unpack_from(buf, offset)
+
+    def __repr__(self):
+        if not self.flags & HAS_POSITION:
+            return "Fix(no fix)"
+        return "Fix(lat=%.7f, lon=%.7f, ts=%.3f, flags=0x%02x)" % (self.lat, self.lon, self.ts, self.flags)
+
+
+class LazyFix(Fix):
+    """ A Fix whose alt, speed, course and hdop are still the receiver's
+    text, `_raw[i]` for i in `_at`, decoded the first time one of them is
+    read or written; it is a plain Fix from then on. The parser sets the
+    flags from which fields are there, a field that does not parse loses
+    its flag when decoded. `_speed` turns the speed into m/s.
+    """
+
+    __slots__ = ()
+    _at = (0, 1, 2, 3)
+    _speed = 1.
+
+
+def _decode(fix):
+    if fix.__class__ is Fix:
+        return # another reader got there first
+    raw = fix._raw
+    flags = fix.flags
+    values = []
+    for i, flag in zip(fix._at, (HAS_ALT, HAS_SPEED, HAS_COURSE, HAS_HDOP)):
+        value = raw[i]
+        if value:
+            try:
+                value = float(value)
+            except ValueError:
+                value = 0.
+                flags &= ~flag
+        else:
+            value = 0.
+        values.append(value)
+    speed = fix._speed
+    fix.__class__ = Fix
+    fix.alt, fix.speed, fix.course, fix.hdop = values
+    fix.speed *= speed
+    fix.flags = flags
+
+
+def _lazy(name):
+    def get(self):
+        _decode(self)
+        return getattr(self, name)
+
+    def set(self, value):
+        _decode(self)
+        setattr(self, name, value)
+    return property(get, set)
+
+
+for _name in ('alt', 'speed', 'course', 'hdop'):
+    setattr(LazyFix, _name, _lazy(_name))
+
+
+def iso_time(value):
+    # gpsd reports ISO 8601 UTC, e.g. 2020-11-17T10:10:10.000Z
+    if not value:
+        return None
+    try:
+        whole = calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+    frac = value[19:].rstrip("Z")
+    return whole + (float(frac) if frac else 0.0)
+
+
+def from_tpv(tpv, ts=None):
+    # gpsd TPV report (the gps client's dictwrapper or a plain dict) -> Fix
+    return Fix(tpv.get('lat'), tpv.get('lon'),
+               alt=tpv.get('alt'),
+               speed=tpv.get('speed'),
+               course=tpv.get('track'),
+               utc=iso_time(tpv.get('time')),
+               ts=ts or time.time(),
+               epx=tpv.get('epx'), epy=tpv.get('epy'))
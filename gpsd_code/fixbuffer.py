@@ -0,0 +1,104 @@
+import threading
+
+from fix import Fix
+
+
+class FixRing(object):
+    """ Fixed-size ring of preallocated Fix slots with independent readers.
+
+    There is a single producer (the GPS thread). publish() copies the fix
+    into the next slot and bumps a sequence number; it never waits for a
+    reader; a reader that falls more than `size` fixes behind loses the
+    oldest ones and sees them in its `dropped` counter.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self._slots = [Fix() for _ in range(size)]
+        self._seq = 0 # fixes published so far, slot of fix n is n % size
+        self._subscribers = ()
+
+    def publish(self, fix):
+        self._slots[self._seq % self.size].copy_from(fix)
+        # an int store is atomic under the GIL: readers only look at slots
+        # below _seq, so the copy above is complete before it becomes visible
+        self._seq += 1
+
+        for sub in self._subscribers:
+            sub._wake.set()
+
+    def subscribe(self, name=None):
+        sub = Subscription(self, name)
+        self._subscribers = self._subscribers + (sub,)
+        return sub
+
+    def unsubscribe(self, sub):
+        self._subscribers = tuple(s for s in self._subscribers if s is not sub)
+
+    def _read(self, seq, out):
+        # seqlock style read: if the producer lapped us while copying, the
+        # slot belongs to a newer fix and the read is discarded
+        out.copy_from(self._slots[seq % self.size])
+        if self._seq - seq >= self.size:
+            return None
+        return out
+
+
+class Subscription(object):
+    def __init__(self, ring, name=None):
+        self.ring = ring
+        self.name = name
+        self.cursor = ring._seq # only fixes published after subscribing
+        self.dropped = 0
+        self._wake = threading.Event()
+
+    def pending(self):
+        return self.ring._seq - self.cursor
+
+    def _skipOverrun(self):
+        behind = self.ring._seq - self.cursor
+        if behind > self.ring.size:
+            # oldest slot may be overwritten any moment, start one after it
+            lost = behind - self.ring.size + 1
+            self.dropped += lost
+            self.cursor += lost
+
+    def _take(self, out):
+        while self.cursor < self.ring._seq:
+            self._skipOverrun()
+            fix = self.ring._read(self.cursor, out or Fix())
+            self.cursor += 1
+            if fix is not None:
+                return fix
+            self.dropped += 1
+        return None
+
+    def latest(self, out=None):
+        # newest fix without moving the cursor, None before the first one
+        seq = self.ring._seq
+        if seq == 0:
+            return None
+        return self.ring._read(seq - 1, out or Fix())
+
+    def next(self, timeout=None, out=None):
+        # oldest unread fix, blocking up to timeout seconds for one to arrive
+        while True:
+            self._wake.clear()
+            fix = self._take(out)
+            if fix is not None:
+                return fix
+            if not self._wake.wait(timeout):
+                return None
+
+    def drain(self, max_items=None):
+        # every unread fix, oldest first
+        fixes = []
+        while max_items is None or len(fixes) < max_items:
+            fix = self._take(None)
+            if fix is None:
+                break
+            fixes.append(fix)
+        return fixes
+
+    def close(self):
+        self.ring.unsubscribe(self)
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+# Virtual picker fleet: thousands of pickers as asyncio tasks in one process,
+# each registering, pressing buttons through a RobotState lifecycle and
+# walking a synthetic track, against a coordinator (a local stand-in unless
+# --address is given). Reports per message latency and update_orders fan-out.
+#
+#   python fleet.py --pickers 500 --rate 1 --duration 60
+#   python fleet.py --pickers 50 --address ws://coordinator:8127 --site http://coordinator/register
+#   python fleet.py --serve 8127 &  python fleet.py --pickers 2000 --address ws://127.0.0.1:8127 \
+#       --site http://127.0.0.1:8128/register
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import re
+import time
+from urllib.parse import urlencode, urlsplit
+
+import protocol
+import uplink
+from fix import Fix
+from orders import OrdersFilter
+from robotStateCode import RobotState, BUTTONS
+
+
+# button presses of one visit, each pressed once the robot state allows it
+LIFECYCLES = [
+    ['green', 'blue', 'green'],     # call, load the robot when it arrives, reset
+    ['green', 'red', 'green'],      # call, change of mind, reset
+    ['green', 'blue', 'green', 'green', 'red', 'green'],
+]
+
+# the message each ws.WS action sends: (method, protocol function, arguments)
+ACTIONS = {
+    'call_robot': ('call', protocol.call, ()),
+    'cancel_robot': ('cancel', protocol.cancel, ()),
+    'set_loaded': ('set_state', protocol.set_state, ('car_LOADED',)),
+    'set_init': ('set_state', protocol.set_state, ('car_INIT',)),
+}
+
+# stand-in coordinator: the state a message puts its picker in at once, and
+# what follows after how many seconds (divided by --speed)
+ECHO = {'call': 'car_CALLED', 'cancel': 'car_CANCEL'}
+REACTIONS = {
+    'call': [(2., 'car_ACCEPT'), (6., 'car_ARRIVED')],
+    'car_LOADED': [(2., 'car_COMPLETE')],
+}
+
+# the stand-in puts these first in update_orders, see Stats.broadcast
+_STAMP = re.compile(r'"seq": (\d+), "ts": ([0-9.]+)')
+
+
+def _pct(samples):
+    s = sorted(samples)
+    pct = lambda p: round(s[min(len(s) - 1, int(p / 100. * len(s)))] * 1000, 2) if s else None
+    return {'n': len(s), 'p50': pct(50), 'p90': pct(90), 'p99': pct(99), 'max': pct(100)}
+
+
+class Stats(object):
+    """ Latency samples of the whole fleet, in seconds.
+
+    Control messages (call, cancel, set_state) are timed from sending to
+    the update_orders that echoes the state they asked for; locations from
+    sending to their arrival at the stand-in; update_orders fan-out from
+    the broadcast to its last receiver. Everything runs on one loop and one
+    clock, so one way times are exact.
+    """
+
+    def __init__(self):
+        self.latency = collections.defaultdict(list)
+        self.counts = collections.Counter()
+        self._fanout = {} # broadcast -> [sent, last receipt, receivers]
+
+    def broadcast(self, raw, now):
+        # the stand-in stamps its broadcasts, for a real coordinator the
+        # first receipt of the same frame stands in for the send time
+        m = _STAMP.search(raw, 0, 80)
+        key, sent = (int(m.group(1)), float(m.group(2))) if m else (hash(raw), now)
+        entry = self._fanout.get(key)
+        if entry is None:
+            entry = self._fanout[key] = [sent, now, 0]
+        entry[1] = max(entry[1], now)
+        entry[2] += 1
+
+    def report(self, pickers, elapsed):
+        fanout = [last - sent for sent, last, _ in self._fanout.values()]
+        receivers = [n for _, _, n in self._fanout.values()]
+        return {
+            'pickers': pickers,
+            'elapsed_s': round(elapsed, 2),
+            'counts': dict(self.counts),
+            'latency_ms': {name: _pct(s) for name, s in sorted(self.latency.items())},
+            'update_orders': {'broadcasts': len(fanout), 'fanout_ms': _pct(fanout),
+                              'mean_receivers': round(sum(receivers) / float(len(receivers)), 1) if receivers else None},
+        }
+
+
+async def register(site, user_name, stats):
+    # the registration POST of registration.Registrar, on the loop
+    url = urlsplit(site)
+    body = urlencode(protocol.registration(user_name)).encode()
+    t = time.time()
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    try:
+        writer.write(("POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n" % (url.path or '/', url.netloc, len(body))).encode() + body)
+        status = (await reader.readline()).split()
+        ok = len(status) > 1 and status[1].startswith(b'2')
+    finally:
+        writer.close()
+    stats.latency['register'].append(time.time() - t)
+    stats.counts['register_ok' if ok else 'register_failed'] += 1
+    return ok
+
+
+class VirtualPicker(object):
+    """ One device: the same messages ws.WS sends, on an asyncio task. """
+
+    def __init__(self, user_name, index, stats, lifecycle, rate=1., think=(1., 5.), speed=1.,
+                 mode='compat', stuck=60.):
+        self.user_name = user_name
+        self.stats = stats
+        self.lifecycle = lifecycle
+        self.rate = rate
+        self.think = think
+        self.speed = speed
+        self.stuck = stuck
+        self.rs = RobotState()
+        self.orders = OrdersFilter(user_name)
+        self.uplink = uplink.LocationBatcher(user_name, mode=mode)
+        # spread the fleet over the field, ~1 m apart, walking north
+        self.lat = 53.2680 + (index // 100) * 0.00001
+        self.lon = -0.5240 + (index % 100) * 0.00002
+        self.changed = asyncio.Event()
+        self.pending = None # (expected state, sent, method)
+        self.visits = 0
+
+    async def _send(self, conn, frame, method):
+        await conn.send(frame)
+        self.stats.counts[method] += 1
+
+    async def _receive(self, conn):
+        async for raw in conn:
+            now = time.time()
+            if isinstance(raw, bytes):
+                raw = raw.decode('utf-8')
+            if '"update_orders"' in raw:
+                self.stats.broadcast(raw, now)
+            state = self.orders.feed(raw)
+            if state is None:
+                continue
+            if self.pending and state == self.pending[0]:
+                self.stats.latency[self.pending[2]].append(now - self.pending[1])
+                self.pending = None
+            self.rs.fire(state)
+            self.changed.set()
+
+    async def _walk(self, conn):
+        if self.rate <= 0:
+            return
+        while True:
+            self.lat += 0.000001
+            fix = Fix(self.lat, self.lon, epx=2.5, epy=2.5, ts=time.time())
+            for frame in self.uplink.add(fix):
+                await self._send(conn, frame, 'location')
+            await asyncio.sleep(1. / self.rate)
+
+    async def _press(self, conn, button):
+        # like a person at the screen: wait until the last press shows its
+        # answer and the button does something, think, press; try again if
+        # the state moved on meanwhile
+        deadline = time.time() + self.stuck
+        while True:
+            while self.pending or (self.rs.state, button) not in BUTTONS:
+                self.changed.clear()
+                await asyncio.wait_for(self.changed.wait(), max(0., deadline - time.time()))
+            await asyncio.sleep(random.uniform(*self.think) / self.speed)
+            if (self.rs.state, button) in BUTTONS:
+                break
+        step = self.rs.fire(button)
+        if step.action is None:
+            return
+        method, make, args = ACTIONS[step.action]
+        frame = make(self.user_name, *args)
+        # a local transition, the coordinator's next word on it counts again
+        self.orders.invalidate()
+        self.pending = (step.dest, time.time(), method)
+        await self._send(conn, frame, method)
+
+    async def run(self, address, site=None, cycles=1, compression='deflate'):
+        from websockets.asyncio.client import connect
+
+        if site:
+            await register(site, self.user_name, self.stats)
+        async with connect(address, compression=compression, max_size=None) as conn:
+            self.stats.counts['connected'] += 1
+            tasks = [asyncio.ensure_future(self._receive(conn)), asyncio.ensure_future(self._walk(conn))]
+            try:
+                # the first location introduces us, then wait to be REGISTERED
+                fix = Fix(self.lat, self.lon, epx=2.5, epy=2.5, ts=time.time())
+                await self._send(conn, protocol.location_update(self.user_name, fix), 'location')
+                for _ in range(cycles):
+                    for button in self.lifecycle:
+                        await self._press(conn, button)
+                    self.visits += 1
+                self.stats.counts['visits'] += self.visits
+            except asyncio.TimeoutError:
+                self.stats.counts['stuck'] += 1
+                self.stats.counts['stuck_in_' + self.rs.state] += 1
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+
+class Coordinator(object):
+    """ Local stand-in for the coordinator on the same loop: takes the
+    registration POST, answers call / cancel / set_state like ECHO and
+    REACTIONS say and broadcasts every change to every connection as
+    update_orders. Broadcasts are coalesced over `interval` seconds (0
+    sends one per change, like the real one). """
+
+    def __init__(self, stats, speed=1., interval=0., compression='deflate', host='127.0.0.1', port=0):
+        self.stats = stats
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.interval = interval
+        self.compression = compression
+        self.states = {}
+        self.conns = set()
+        self.seq = 0
+        self.received = collections.Counter()
+        self._timers = collections.defaultdict(list)
+        self._dirty = False
+
+    async def start(self):
+        from websockets.asyncio.server import serve
+
+        self._ws = await serve(self._handler, self.host, self.port, compression=self.compression,
+                               max_size=None, ping_interval=None)
+        self.address = 'ws://%s:%d' % (self.host, self._ws.sockets[0].getsockname()[1])
+        # registration one port up when the port is given
+        self._http = await asyncio.start_server(self._register, self.host, self.port and self.port + 1)
+        self.site = 'http://%s:%d/register' % (self.host, self._http.sockets[0].getsockname()[1])
+        if self.interval > 0:
+            self._flusher = asyncio.ensure_future(self._flushLoop())
+
+    async def _register(self, reader, writer):
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    def _set(self, user, state):
+        self.states[user] = state
+        if self.interval > 0:
+            self._dirty = True
+        else:
+            self._broadcast()
+
+    def _broadcast(self):
+        from websockets.asyncio.server import broadcast
+
+        self.seq += 1
+        # seq and ts first, so receivers find them without a full decode
+        broadcast(self.conns, json.dumps({'method': 'update_orders', 'seq': self.seq, 'ts': time.time(),
+                                          'states': self.states}))
+
+    async def _flushLoop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._dirty:
+                self._dirty = False
+                self._broadcast()
+
+    def _react(self, user, key):
+        for delay, state in REACTIONS.get(key, ()):
+            self._timers[user].append(asyncio.get_running_loop().call_later(delay / self.speed, self._set, user, state))
+
+    def _locations(self, message, now):
+        if isinstance(message, bytes) or '"location_batch"' in message:
+            user, _, fixes = protocol.decode_location_batch(message)
+            for _, _, _, ts in fixes:
+                self.stats.latency['location'].append(now - ts)
+            return user
+        msg = json.loads(message)
+        self.stats.latency['location'].append(now - msg['rcv_time'])
+        return msg['user']
+
+    async def _handler(self, conn):
+        user = None
+        try:
+            async for message in conn:
+                now = time.time()
+                if isinstance(message, bytes) or '"location_' in message:
+                    self.received['location'] += 1
+                    sender = self._locations(message, now)
+                    if user is None:
+                        # a new device: connected, then registered
+                        user = sender
+                        self.conns.add(conn)
+                        self.states[user] = 'CONNECTED'
+                        self._set(user, 'REGISTERED')
+                    continue
+                msg = json.loads(message)
+                method = msg.get('method')
+                self.received[method] += 1
+                user = user or msg.get('user')
+                for timer in self._timers.pop(user, ()):
+                    timer.cancel()
+                state = msg.get('state') if method == 'set_state' else ECHO.get(method)
+                if state:
+                    self._set(user, state)
+                self._react(user, msg.get('state') or method)
+        finally:
+            self.conns.discard(conn)
+
+    def stop(self):
+        self._ws.close()
+        self._http.close()
+        if self.interval > 0:
+            self._flusher.cancel()
+
+
+async def serve(port, speed=1., interval=0., compression='deflate'):
+    # the stand-in alone, so the fleet's own load does not slow it down
+    stats = Stats()
+    coordinator = Coordinator(stats, speed, interval, compression, port=port)
+    await coordinator.start()
+    print("coordinator on %s, registration on %s" % (coordinator.address, coordinator.site))
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(json.dumps({'messages': dict(coordinator.received), 'broadcasts': coordinator.seq,
+                              'connections': len(coordinator.conns),
+                              'location_ms': _pct(stats.latency.pop('location', []))}))
+    finally:
+        coordinator.stop()
+
+
+async def run(pickers=100, address=None, site=None, rate=1., cycles=1, speed=1., duration=None,
+              ramp=5., interval=0., mode='compat', compression='deflate', stuck=60.):
+    stats = Stats()
+    coordinator = None
+    if address is None:
+        coordinator = Coordinator(stats, speed, interval, compression)
+        await coordinator.start()
+        address, site = coordinator.address, coordinator.site
+
+    async def picker(i):
+        # connect the fleet over `ramp` seconds, not all in the same instant
+        await asyncio.sleep(ramp * i / max(1, pickers))
+        p = VirtualPicker('fleet_%05d' % i, i, stats, LIFECYCLES[i % len(LIFECYCLES)], rate,
+                          speed=speed, mode=mode, stuck=stuck)
+        try:
+            await p.run(address, site, cycles, compression)
+        except (OSError, asyncio.TimeoutError) as e:
+            stats.counts['failed'] += 1
+            stats.counts['failed_' + type(e).__name__] += 1
+
+    started = time.time()
+    tasks = [asyncio.ensure_future(picker(i)) for i in range(pickers)]
+    done, pending = await asyncio.wait(tasks, timeout=duration)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    report = stats.report(pickers, time.time() - started)
+    report['unfinished'] = len(pending)
+    if coordinator is not None:
+        coordinator.stop()
+        report['coordinator'] = {'messages': dict(coordinator.received), 'broadcasts': coordinator.seq}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fleet of virtual pickers against a coordinator")
+    parser.add_argument('--pickers', type=int, default=100)
+    parser.add_argument('--address', help="coordinator websocket, the local stand-in if omitted")
+    parser.add_argument('--site', help="registration endpoint (SITE_ADDRESS) of --address")
+    parser.add_argument('--rate', type=float, default=1., help="fixes per second per picker, 0 for none")
+    parser.add_argument('--cycles', type=int, default=1, help="lifecycles per picker")
+    parser.add_argument('--speed', type=float, default=1., help="picker and stand-in delays run N x faster")
+    parser.add_argument('--duration', type=float, help="stop after N seconds")
+    parser.add_argument('--ramp', type=float, default=5., help="seconds to connect the whole fleet")
+    parser.add_argument('--interval', type=float, default=0., help="stand-in broadcast coalescing, seconds")
+    parser.add_argument('--mode', choices=uplink.LocationBatcher.MODES, default='compat', help="UPLINK_MODE")
+    parser.add_argument('--compression', choices=('deflate', 'none'), default=os.getenv('WS_COMPRESSION', 'deflate'))
+    parser.add_argument('--serve', type=int, metavar='PORT', help="only run the stand-in coordinator on PORT")
+    parser.add_argument('--stuck', type=float, default=60., help="give up on a picker waiting this long for a state")
+    args = parser.parse_args()
+    compression = None if args.compression == 'none' else 'deflate'
+
+    if args.serve:
+        asyncio.run(serve(args.serve, args.speed, args.interval, compression))
+
+    report = asyncio.run(run(args.pickers, args.address, args.site, args.rate, args.cycles, args.speed,
+                             args.duration, args.ramp, args.interval, args.mode, compression, args.stuck))
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import os
+
+import fix
+import log
+import nmea
+
+logger = log.get("gps.async")
+
+
+# asyncio counterparts of _gpsd_serial.GPS and _gpsd_service.GPS: async
+# generators of fix.Fix that never block the event loop
+
+
+async def serial_fixes(port=None, report_interval=None, baudrate=115200, commands=True):
+    import serial
+
+    port = port or os.getenv("MODEM_SERIAL_PORT")
+    report_interval = int(report_interval or os.getenv("GPS_REPORT_INTERVAL", 1))
+
+    ser = serial.Serial(port, baudrate, timeout=0) # non-blocking reads
+    ser.reset_input_buffer()
+    parser = nmea.FixParser()
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def readable():
+        try:
+            data = ser.read(ser.in_waiting or 1)
+        except (IOError, OSError) as e: # the port went away
+            loop.remove_reader(ser.fileno())
+            queue.put_nowait(e)
+            return
+        for f in parser.feed(data):
+            queue.put_nowait(f)
+
+    # let the modem push +CGPSINFO and wake us only when bytes arrive; an
+    # NMEA port (commands=False) streams without being asked
+    if commands:
+        ser.write(("AT+CGPSINFO=%d" % report_interval + "\r\n").encode())
+    loop.add_reader(ser.fileno(), readable)
+    try:
+        while True:
+            item = await queue.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        try:
+            loop.remove_reader(ser.fileno())
+            if commands:
+                ser.write(("AT+CGPSINFO=0" + "\r\n").encode())
+        except (IOError, OSError, ValueError):
+            pass
+        ser.close()
+
+
+async def atmux_fixes(port=None):
+    # the AT multiplexer keeps its threads (it serves other processes and
+    # waits on the modem's answers); its fixes are handed over to the loop
+    import atmux
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    mux = atmux.ATMux(lambda f: loop.call_soon_threadsafe(queue.put_nowait, f), port=port)
+    mux.start()
+    try:
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), 1.)
+            except asyncio.TimeoutError:
+                if not mux.is_alive(): # the port went away
+                    raise IOError("AT multiplexer stopped")
+    finally:
+        mux.stop()
+
+
+async def gpsd_fixes(host=None, port=None):
+    host = host or os.getenv("GPSD_HOST", "127.0.0.1")
+    port = int(port or os.getenv("GPSD_PORT", 2947))
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'?WATCH={"enable":true,"json":true};\n')
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                logger.error("no more data from gpsd")
+                return
+            try:
+                report = json.loads(line)
+            except ValueError:
+                continue
+            if report.get('class') == 'TPV':
+                yield fix.from_tpv(report)
+    finally:
+        writer.close()
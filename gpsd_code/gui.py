@@ -1,136 +1,173 @@
+import heapq
+import os
+import threading
+import time
 
+import log
 
-# import threading
-from tkinter import *
-import tkinter as tk
+logger = log.get("gui")
 
 
-class GUI:
+# DISPLAY_BACKEND -> (module, class); modules are only imported when the
+# window is set up, so choosing a backend costs nothing at startup
+BACKENDS = {
+    'tk': ('gui_tk', 'TkDisplay'),
+    'fb': ('gui_fb', 'FramebufferDisplay'),
+    'headless': ('gui_headless', 'HeadlessDisplay'),
+}
+
+
+class Display(object):
+    """ Base of the display backends.
+
+    Keeps the state the app asked for (button colours, texts) so a backend
+    can render it whenever it likes, and provides the after()/update()
+    timer loop that non-Tk backends run instead of a Tk mainloop.
+    """
+
     def __init__(self, on_green, on_blue, on_red):
-        self.main_w = None
-        self.main_root = None
         self.green_callback = on_green
         self.blue_callback = on_blue
         self.red_callback = on_red
+        self.state = {'green': False, 'red': False, 'blue': False, 'description': '', 'user': ''}
+        self._timers = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._closed = False
 
-    def waitForLogin(self):
-        root = Tk()
-        root.title("User Login")
-        root.focus_force()
-        root.geometry("300x250")
-        login_w = LoginPage(root)
-        root.mainloop()
-
-        return login_w.user
-
+    # what the app drives
     def setupMainWindow(self):
-        self.main_root = Tk()
-        self.main_root.title("Call a Robot")
-        self.main_root.focus_force()
-        self.main_root.geometry("800x430")
-        self.main_root.configure(bg='white')
-        self.main_w = MainWindow(self.main_root, self.green_callback, self.blue_callback, self.red_callback)
-
-    def loopMainWindow(self):
-        self.main_root.mainloop()
+        pass
 
     def setGreenButton(self, value):
-        if self.main_w is not None:
-            if value:
-                self.main_w.gbutton.configure(bg = "green")
-            else:
-                self.main_w.gbutton.configure(bg = "white")
+        self._set('green', bool(value))
 
     def setRedButton(self, value):
-        if self.main_w is not None:
-            if value:
-                self.main_w.rbutton.configure(bg = "red")
-            else:
-                self.main_w.rbutton.configure(bg = "white")
+        self._set('red', bool(value))
 
     def setBlueButton(self, value):
-        if self.main_w is not None:
-            if value:
-                self.main_w.bbutton.configure(bg = "blue")
-            else:
-                self.main_w.bbutton.configure(bg = "white")
+        self._set('blue', bool(value))
 
     def setDescription(self, string):
-        self.main_w.label_text.set(string)
+        self._set('description', string)
 
     def getDescription(self):
-        self.main_w.label_text.get()
-        
-    def setUser(self, string):
-        self.main_w.user_text.set(string)
-
-
-class MainWindow():
-    def __init__(self, root, green_callback, blue_callback, red_callback):
-        self.root = root
+        return self.state['description']
 
-        # initialize tkinter
-        self.label_text = StringVar()
-
-        self.user_text = StringVar()
+    def setUser(self, string):
+        self._set('user', string)
+
+    def _set(self, key, value):
+        if self.state[key] != value:
+            self.state[key] = value
+            self.render(key)
+
+    def render(self, key):
+        # called after state[key] changed
+        pass
+
+    # timers
+    def after(self, ms, fn):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._timers, (time.time() + ms / 1000., self._seq, fn))
+            self._cond.notify()
+
+    def after_idle(self, fn):
+        # run fn on the display thread as soon as it is free; any thread
+        self.after(0, fn)
+
+    def update(self):
+        # run what is due without blocking, False once the display is closed
+        while True:
+            with self._cond:
+                if not self._timers or self._timers[0][0] > time.time():
+                    break
+                fn = heapq.heappop(self._timers)[2]
+            fn()
+        return not self._closed
 
-        # set window title
-        self.root.wm_title("Call A Robot")
+    def loopMainWindow(self):
+        while self.update():
+            with self._cond:
+                timeout = self._timers[0][0] - time.time() if self._timers else None
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
 
-        self.text = Label(self.root, text="Welcome to Call A Robot.",background="white", foreground="#2B394A", font = ('gomono', 24, "bold"), textvariable = self.label_text)
-        self.text.place(relx = 0.5, rely = 0.1, anchor = CENTER)
+    def quit(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
 
-        self.userText = Label(self.root, text="", foreground="#9B9A94",background="white", font = "arial 12 normal", textvariable = self.user_text)
-        self.userText.place(relx = 0.5, rely = 0.2, anchor = CENTER)
 
-        self.gbutton = Button(self.root, text="Call", bg="white", height=10, width=20, command=lambda : green_callback(None))
-        self.gbutton.place(relx = 0.1, rely = 0.5, anchor = 'w') 
-        self.gbutton.config(highlightbackground="green")
+class GUI:
+    """ What MainApp talks to. Forwards to the backend chosen by
+    DISPLAY_BACKEND (tk when an X display is set, headless otherwise) and
+    remembers anything set before setupMainWindow() so the window can come
+    up after the rest of the app.
+    """
 
-        self.rbutton = Button(self.root, text="Cancel", bg="white", height=10, width=20, command=lambda : red_callback(None))
-        self.rbutton.place(relx = 0.5, rely = 0.5, anchor = CENTER) 
-        self.rbutton.config(highlightbackground="red")
+    def __init__(self, on_green, on_blue, on_red, backend=None):
+        self.callbacks = (on_green, on_blue, on_red)
+        self.backend = backend or os.getenv('DISPLAY_BACKEND') or ('tk' if os.getenv('DISPLAY') else 'headless')
+        self.display = Display(on_green, on_blue, on_red) # placeholder until setupMainWindow
 
-        self.bbutton = Button(self.root, text="Load", bg="white", height=10, width=20, command=lambda : blue_callback(None))
-        self.bbutton.place(relx = 0.9, rely = 0.5, anchor = 'e') 
-        self.bbutton.config(highlightbackground="blue")
+    def _load(self, name):
+        module, cls = BACKENDS[name]
+        return getattr(__import__(module), cls)(*self.callbacks)
 
+    def setupMainWindow(self):
+        try:
+            display = self._load(self.backend)
+            display.setupMainWindow()
+        except Exception as e:
+            logger.warning("display backend %r unavailable (%s), running headless", self.backend, e)
+            self.backend = 'headless'
+            display = self._load(self.backend)
+            display.setupMainWindow()
+        # replay what was set while the window did not exist
+        state = self.display.state
+        display.setGreenButton(state['green'])
+        display.setRedButton(state['red'])
+        display.setBlueButton(state['blue'])
+        display.setDescription(state['description'])
+        display.setUser(state['user'])
+        for when, _, fn in self.display._timers:
+            display.after(max(0, int((when - time.time()) * 1000)), fn)
+        self.display = display
 
-class LoginPage():
-    def __init__(self, master=None):
-        self.master = master
+    def loopMainWindow(self):
+        self.display.loopMainWindow()
 
-        #self.login_screen.attributes("-fullscreen", True)  
-        self.loginText = Label(self.master, text="Please enter login details", font = "arial 12 bold", foreground="red")
-        self.loginText.place(relx = 0.5, rely = 0.1, anchor = CENTER)
-        self.usernameText = Label(self.master, text="Username:")
-        self.usernameText.place(relx = 0.2, rely = 0.3, anchor = CENTER)
-        self.username_login_entry = Entry(self.master)
-        self.username_login_entry.place(relx = 0.5, rely = 0.4, anchor = CENTER, width = 270)
-        self.subButton = Button(self.master, text="Login", width=30, height=1, command =self.submit, bg = "green")
-        self.subButton.place(relx = 0.5, rely = 0.6, anchor = CENTER)
-        self.user = "not set"
-    
-    def submit(self):
-        self.user = self.username_login_entry.get()
-        print("The user is : " + self.user)
-        self.master.destroy()
+    def update(self):
+        return self.display.update()
 
+    def after(self, ms, fn):
+        self.display.after(ms, fn)
 
+    def after_idle(self, fn):
+        self.display.after_idle(fn)
 
-if __name__ == "__main__":
-    # tests
+    def quit(self):
+        self.display.quit()
 
-    gui = GUI()
+    def waitForLogin(self):
+        return self._load('tk').waitForLogin()
 
-    user = gui.waitForLogin()
+    def setGreenButton(self, value):
+        self.display.setGreenButton(value)
 
-    print("user logged {}".format(user))
+    def setRedButton(self, value):
+        self.display.setRedButton(value)
 
-    gui.setupMainWindow()
+    def setBlueButton(self, value):
+        self.display.setBlueButton(value)
 
-    gui.greenButtonPressed()
+    def setDescription(self, string):
+        self.display.setDescription(string)
 
-    gui.loopMainWindow()
+    def getDescription(self):
+        return self.display.getDescription()
 
-    # gui.redBut    tonPressed()
+    def setUser(self, string):
+        self.display.setUser(string)
@@ -0,0 +1,91 @@
+import os
+
+from gui import Display
+
+
+class FramebufferDisplay(Display):
+    """ Draws the three buttons and both texts straight into a Linux
+    framebuffer (small SPI/HDMI LCD) with Pillow, no X server needed.
+    Input comes from the physical buttons only.
+    """
+
+    COLOURS = {'green': (0, 128, 0), 'red': (255, 0, 0), 'blue': (0, 0, 255)}
+
+    def __init__(self, on_green, on_blue, on_red, device=None):
+        super(FramebufferDisplay, self).__init__(on_green, on_blue, on_red)
+        self.device = device or os.getenv('FRAMEBUFFER', '/dev/fb0')
+        self._fb = None
+
+    def _sysfs(self, name):
+        with open('/sys/class/graphics/%s/%s' % (os.path.basename(self.device), name)) as f:
+            return f.read().strip()
+
+    def setupMainWindow(self):
+        from PIL import Image, ImageDraw, ImageFont
+
+        self.width, self.height = (int(v) for v in self._sysfs('virtual_size').split(','))
+        self.bpp = int(self._sysfs('bits_per_pixel'))
+        self.stride = int(self._sysfs('stride')) if os.path.exists(
+            '/sys/class/graphics/%s/stride' % os.path.basename(self.device)) else self.width * self.bpp // 8
+
+        self._image = Image.new('RGB', (self.width, self.height), 'white')
+        self._draw = ImageDraw.Draw(self._image)
+        size = max(12, self.height // 14)
+        try:
+            self._font = ImageFont.truetype('DejaVuSans-Bold.ttf', size)
+            self._small = ImageFont.truetype('DejaVuSans.ttf', size * 2 // 3)
+        except IOError:
+            self._font = self._small = ImageFont.load_default()
+
+        self._fb = open(self.device, 'r+b', buffering=0)
+        self.redraw()
+
+    def render(self, key):
+        if self._fb is not None:
+            self.redraw()
+
+    def redraw(self):
+        w, h = self.width, self.height
+        d = self._draw
+        d.rectangle((0, 0, w, h), fill='white')
+        d.text((w // 2, h // 10), self.state['description'], fill=(43, 57, 74), font=self._font, anchor='mm')
+        d.text((w // 2, h // 5), self.state['user'], fill=(155, 154, 148), font=self._small, anchor='mm')
+
+        bw = w // 4
+        for i, (key, label) in enumerate((('green', 'Call'), ('red', 'Cancel'), ('blue', 'Load'))):
+            x = w // 16 + i * (bw + w // 16 + w // 48)
+            box = (x, h * 3 // 10, x + bw, h * 9 // 10)
+            d.rectangle(box, fill=self.COLOURS[key] if self.state[key] else 'white',
+                        outline=self.COLOURS[key], width=3)
+            d.text(((box[0] + box[2]) // 2, (box[1] + box[3]) // 2), label,
+                   fill='white' if self.state[key] else 'black', font=self._small, anchor='mm')
+
+        self._blit()
+
+    def _rgb565(self):
+        # little-endian RGB565 from band arithmetic, Pillow has no packer for it
+        from PIL import Image, ImageChops
+
+        r, g, b = self._image.split()
+        high = ImageChops.add(r.point(lambda v: v & 0xf8), g.point(lambda v: v >> 5))
+        low = ImageChops.add(g.point(lambda v: (v << 3) & 0xe0), b.point(lambda v: v >> 3))
+        return Image.merge('LA', (low, high)).tobytes()
+
+    def _blit(self):
+        if self.bpp == 16:
+            data = self._rgb565()
+        else:
+            data = self._image.tobytes('raw', 'BGRX')
+        row = len(data) // self.height
+        self._fb.seek(0)
+        if row == self.stride:
+            self._fb.write(data)
+        else:
+            for y in range(self.height):
+                self._fb.seek(y * self.stride)
+                self._fb.write(data[y * row:(y + 1) * row])
+
+    def quit(self):
+        super(FramebufferDisplay, self).quit()
+        if self._fb is not None:
+            self._fb.close()
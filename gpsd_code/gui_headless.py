@@ -0,0 +1,11 @@
+from gui import Display
+
+
+class HeadlessDisplay(Display):
+    """ No screen at all: the LEDs driven by buttons.Buttons are the only
+    feedback, the description is printed so it still reaches the log.
+    """
+
+    def render(self, key):
+        if key == 'description':
+            print("[display]", self.state['description'])
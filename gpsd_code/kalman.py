@@ -0,0 +1,345 @@
+import math
+import os
+import time
+
+import metrics
+from fix import Fix, FIELDS, FIX_STRUCT, FIX_SIZE, HAS_ERROR, HAS_HDOP, HAS_UTC, HAS_SPEED, HAS_COURSE, HAS_POSITION
+from rate import EARTH_RADIUS
+
+
+ACCEPTED = metrics.counter("filter_accepted")
+REJECTED = metrics.counter("filter_rejected")
+RESETS = metrics.counter("filter_resets")
+
+# metres per degree of latitude
+_KY = math.radians(1.) * EARTH_RADIUS
+
+
+def enabled():
+    return os.getenv('GPS_FILTER', 'true').lower() not in ('0', 'false', 'no')
+
+
+class FixFilter(object):
+    """ Constant velocity Kalman filter over the fix stream, in metres
+    east/north of the first fix.
+
+    A fix whose innovation is further than `gate` (squared Mahalanobis
+    distance, chi-square with 2 degrees of freedom: 9.21 is 99%) from the
+    prediction is rejected as multipath; `reset_after` rejections in a row,
+    a gap over `max_gap` seconds or time going backwards start again from
+    the fix. Measurement noise is the same on both axes, so both share one
+    covariance and the filter is a handful of float operations per fix.
+
+    update() filters one fix at a time for the live stream; batch() runs
+    whole recorded tracks offline. The gate makes every step depend on the
+    one before, so NumPy only helps across tracks: many of them run side by
+    side, a single track goes through the same scalar step as update().
+    """
+
+    def __init__(self, accel=None, gate=None, error=None, uere=None, max_gap=None, reset_after=None, speed=2.):
+        # accel: process noise, m/s^2 (1 sigma) of the picker's acceleration
+        # error: 1 sigma metres of a fix that has no error estimate (+CGPSINFO)
+        # uere: metres per unit of HDOP when only that is known
+        self.accel = float(accel if accel is not None else os.getenv('GPS_FILTER_ACCEL', 0.5))
+        self.gate = float(gate if gate is not None else os.getenv('GPS_FILTER_GATE', 9.21))
+        self.error = float(error if error is not None else os.getenv('GPS_FILTER_ERROR', 4))
+        self.uere = float(uere if uere is not None else os.getenv('GPS_FILTER_UERE', 5))
+        self.max_gap = float(max_gap if max_gap is not None else os.getenv('GPS_FILTER_MAX_GAP', 10))
+        self.reset_after = int(reset_after if reset_after is not None else os.getenv('GPS_FILTER_RESET', 5))
+        self.v0 = speed * speed # initial velocity variance
+        self._origin = None
+        self._t = None
+        self.rejected = 0 # in a row
+
+    def sigma(self, fix):
+        # 1 sigma horizontal error of a fix in metres; gpsd's epx/epy are
+        # 95% bounds, NMEA gives HDOP, +CGPSINFO nothing
+        if fix.flags & HAS_ERROR:
+            return max(fix.epx, fix.epy, 0.2) / 2.
+        if fix.flags & HAS_HDOP and fix.hdop > 0:
+            return fix.hdop * self.uere
+        return self.error
+
+    def _reset(self, x, y, r):
+        self.px, self.py, self.vx, self.vy = x, y, 0., 0.
+        self.a, self.b, self.c = r, 0., self.v0 # position, cross, velocity variance
+        self.rejected = 0
+
+    def _step(self, x, y, r, t):
+        # one measurement in metres, its variance and time -> None when the
+        # filter started again from it, else whether it passed the gate
+        dt = t - self._t if self._t is not None else -1.
+        self._t = t
+        if dt < 0 or dt > self.max_gap or self.rejected >= self.reset_after:
+            self._reset(x, y, r)
+            return None
+
+        # predict
+        q = self.accel * self.accel
+        dt2 = dt * dt
+        a, b, c = self.a, self.b, self.c
+        self.px += self.vx * dt
+        self.py += self.vy * dt
+        a = a + 2 * dt * b + dt2 * c + q * dt2 * dt2 / 4.
+        b = b + dt * c + q * dt2 * dt / 2.
+        c = c + q * dt2
+
+        # gate, then update
+        ex, ey = x - self.px, y - self.py
+        s = a + r
+        if (ex * ex + ey * ey) / s > self.gate:
+            self.a, self.b, self.c = a, b, c
+            self.rejected += 1
+            return False
+        kp, kv = a / s, b / s
+        self.px += kp * ex
+        self.py += kp * ey
+        self.vx += kv * ex
+        self.vy += kv * ey
+        self.a, self.b, self.c = (1 - kp) * a, (1 - kp) * b, c - kv * b
+        self.rejected = 0
+        return True
+
+    def update(self, fix, out=None):
+        # -> the smoothed fix (in `out` when given), None for an outlier
+        if not fix.flags & HAS_POSITION:
+            return None
+        if self._origin is None:
+            self._origin = (fix.lat, fix.lon, _KY * math.cos(math.radians(fix.lat)))
+        lat0, lon0, kx = self._origin
+        sigma = self.sigma(fix)
+        ok = self._step((fix.lon - lon0) * kx, (fix.lat - lat0) * _KY, sigma * sigma,
+                        fix.utc if fix.flags & HAS_UTC else fix.ts)
+        if ok is False:
+            REJECTED.inc()
+            return None
+        if ok is None:
+            RESETS.inc()
+        ACCEPTED.inc()
+
+        out = (out or Fix()).copy_from(fix)
+        out.lat = lat0 + self.py / _KY
+        out.lon = lon0 + self.px / kx
+        out.epx = out.epy = 2. * math.sqrt(self.a) # 95%, like gpsd's
+        out.flags |= HAS_ERROR
+        if not fix.flags & HAS_SPEED:
+            out.speed = math.hypot(self.vx, self.vy)
+            out.flags |= HAS_SPEED
+        if not fix.flags & HAS_COURSE:
+            out.course = math.degrees(math.atan2(self.vx, self.vy)) % 360.
+            out.flags |= HAS_COURSE
+        return out
+
+    def batch(self, lat, lon, t, sigma):
+        # arrays of shape (n,) or (tracks, n), fixes along the last axis and
+        # tracks independent; -> lat, lon, 95% error in metres and the
+        # accepted mask, same shapes. Offline only (replays, recorded
+        # tracks), the device filters with update(). Several tracks: the
+        # loop runs over time only, every step updates all tracks at once.
+        import numpy as np
+
+        single = np.ndim(lat) == 1
+        lat, lon, t = (np.atleast_2d(np.asarray(v, dtype=float)) for v in (lat, lon, t))
+        r = np.broadcast_to(np.asarray(sigma, dtype=float) ** 2, lat.shape)
+        tracks, n = lat.shape
+        lat0, lon0 = lat[:, :1], lon[:, :1]
+        kx = _KY * np.cos(np.radians(lat0))
+        zx, zy = (lon - lon0) * kx, (lat - lat0) * _KY
+        if tracks == 1:
+            out_x, out_y, out_a, accepted = self._batch1(zx[0], zy[0], r[0], t[0])
+            result = (lat0 + out_y / _KY, lon0 + out_x / kx, 2. * np.sqrt(out_a), accepted)
+            return tuple(v[0] for v in result) if single else result
+        q = self.accel * self.accel
+
+        out_x, out_y, out_a = np.empty_like(zx), np.empty_like(zy), np.empty_like(zx)
+        accepted = np.empty(lat.shape, dtype=bool)
+        px, py, vx, vy = zx[:, 0].copy(), zy[:, 0].copy(), np.zeros(tracks), np.zeros(tracks)
+        a, b, c = r[:, 0].copy(), np.zeros(tracks), np.full(tracks, self.v0)
+        rejected = np.zeros(tracks, dtype=int)
+        last = t[:, 0].copy()
+        for k in range(n):
+            dt = t[:, k] - last
+            last = t[:, k]
+            reset = (dt < 0) | (dt > self.max_gap) | (rejected >= self.reset_after)
+            if k == 0:
+                reset[:] = True
+            dt = np.where(reset, 0., dt)
+            dt2 = dt * dt
+
+            px += vx * dt
+            py += vy * dt
+            a = a + 2 * dt * b + dt2 * c + q * dt2 * dt2 / 4.
+            b = b + dt * c + q * dt2 * dt / 2.
+            c = c + q * dt2
+
+            ex, ey = zx[:, k] - px, zy[:, k] - py
+            s = a + r[:, k]
+            ok = ((ex * ex + ey * ey) / s <= self.gate) & ~reset
+            kp, kv = np.where(ok, a / s, 0.), np.where(ok, b / s, 0.)
+            px += kp * ex
+            py += kp * ey
+            vx += kv * ex
+            vy += kv * ey
+            a, b, c = (1 - kp) * a, (1 - kp) * b, c - kv * b
+
+            px = np.where(reset, zx[:, k], px)
+            py = np.where(reset, zy[:, k], py)
+            vx, vy = np.where(reset, 0., vx), np.where(reset, 0., vy)
+            a, b, c = np.where(reset, r[:, k], a), np.where(reset, 0., b), np.where(reset, self.v0, c)
+            rejected = np.where(ok | reset, 0, rejected + 1)
+
+            out_x[:, k], out_y[:, k], out_a[:, k] = px, py, a
+            accepted[:, k] = ok | reset
+
+        result = (lat0 + out_y / _KY, lon0 + out_x / kx, 2. * np.sqrt(out_a), accepted)
+        return tuple(v[0] for v in result) if single else result
+
+    def _batch1(self, zx, zy, r, t):
+        # one track through _step() on plain floats, a NumPy step per fix
+        # would cost more than it saves; self's own state is left alone
+        import numpy as np
+
+        f = FixFilter(self.accel, self.gate, self.error, self.uere, self.max_gap, self.reset_after)
+        f.v0 = self.v0
+        out = [(f.px, f.py, f.a, ok is not False)
+               for ok in map(f._step, zx.tolist(), zy.tolist(), r.tolist(), t.tolist())]
+        out_x, out_y, out_a, accepted = (np.array(v) for v in zip(*out)) if out else [np.zeros(0)] * 4
+        return out_x[None], out_y[None], out_a[None], accepted.astype(bool)[None]
+
+
+# FIX_STRUCT as a NumPy record, for reading track files in one go: one
+# field per Fix field, in packing order, with the struct's own type codes
+# (d, f and B mean the same to NumPy)
+FIX_DTYPE = list(zip(FIELDS, ('<' + code for code in FIX_STRUCT.format.lstrip('<'))))
+
+
+def load_track(directory=None):
+    # every fix recorded by track.TrackRecorder, oldest first, as one
+    # NumPy record array; the files come in sequence order and hold their
+    # records in recording order, sorting on ts would undo a clock step
+    import numpy as np
+    import track
+
+    assert len(FIX_DTYPE) == len(FIELDS) and np.dtype(FIX_DTYPE).itemsize == FIX_SIZE, \
+        "FIX_DTYPE does not match FIX_STRUCT"
+    parts = []
+    for path in track.list_files(directory):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, size, count = track.HEADER.unpack_from(data, 0)
+        if magic == track.MAGIC and size == np.dtype(FIX_DTYPE).itemsize:
+            parts.append(np.frombuffer(data, FIX_DTYPE, count, track.HEADER.size))
+    if not parts:
+        return np.zeros(0, FIX_DTYPE)
+    fixes = np.concatenate(parts)
+    return fixes[(fixes['flags'] & HAS_POSITION) != 0]
+
+
+def walk(n=3600, seed=1, noise=2., wander=1.5, outliers=0.05):
+    # a picker at 1 Hz going up and down 50 m rows at 0.8 m/s, stopping
+    # 20 s to pick every 10 m; receiver noise, white (`noise` metres 1
+    # sigma) plus a slow wander (AR(1), `wander` metres), and `outliers` of
+    # the fixes thrown 10-40 m by multipath.
+    # -> truth and measured (x, y) in metres, outlier mask
+    import numpy as np
+
+    rnd = np.random.RandomState(seed)
+    x = y = 0.
+    up, moved, stop = True, 0., 0
+    truth = np.empty((n, 2))
+    for i in range(n):
+        if stop:
+            stop -= 1
+        else:
+            y += 0.8 if up else -0.8
+            moved += 0.8
+            if moved % 10. < 0.8:
+                stop = 20
+            if not 0. <= y <= 50.:
+                y = min(50., max(0., y))
+                x += 1.5
+                up = not up
+        truth[i] = x, y
+    err = np.zeros((n, 2))
+    for i in range(1, n):
+        err[i] = 0.95 * err[i - 1] + rnd.normal(0, wander * math.sqrt(1 - 0.95 ** 2), 2)
+    err += rnd.normal(0, noise, (n, 2))
+    bad = rnd.rand(n) < outliers
+    bad[:10] = False
+    angle = rnd.uniform(0, 2 * math.pi, n)
+    jump = rnd.uniform(10, 40, n)
+    err[bad] += np.c_[np.cos(angle) * jump, np.sin(angle) * jump][bad]
+    return truth, truth + err, bad
+
+
+if __name__ == "__main__":
+    # on a recorded track (python kalman.py TRACK_DIR) or a synthetic
+    # walk with multipath: outliers caught, error, how many fixes
+    # AdaptiveRate would publish, and fixes/s streaming and in batches
+    import sys
+    import numpy as np
+    from rate import AdaptiveRate
+
+    filt = FixFilter()
+    if len(sys.argv) > 1:
+        rec = load_track(sys.argv[1])
+        raw = [Fix().unpack_from(r.tobytes()) for r in rec]
+        lat, lon = rec['lat'], rec['lon']
+        t = np.where(rec['flags'] & HAS_UTC, rec['utc'], rec['ts'])
+        sigma = np.array([filt.sigma(f) for f in raw])
+        truth = None
+        print("%d recorded fixes" % len(raw))
+    else:
+        truth_xy, xy, bad = walk()
+        lat0, lon0 = 53.2680, -0.5240
+        kx = _KY * math.cos(math.radians(lat0))
+        lat, lon = lat0 + xy[:, 1] / _KY, lon0 + xy[:, 0] / kx
+        truth = (lat0 + truth_xy[:, 1] / _KY, lon0 + truth_xy[:, 0] / kx)
+        t = 1605607810. + np.arange(len(lat))
+        sigma = np.full(len(lat), filt.error)
+        # like +CGPSINFO: no error estimate, a Doppler speed much steadier
+        # than the positions
+        moving = np.r_[0., np.hypot(*np.diff(truth_xy, axis=0).T) > 0]
+        speed = np.abs(0.8 * moving + np.random.RandomState(2).normal(0, 0.1, len(lat)))
+        raw = [Fix(float(la), float(lo), speed=float(sp), utc=float(ti), ts=float(ti))
+               for la, lo, sp, ti in zip(lat, lon, speed, t)]
+        print("synthetic walk, %d fixes, %d multipath outliers" % (len(lat), bad.sum()))
+
+    streaming = FixFilter()
+    t0 = time.perf_counter()
+    smoothed = [streaming.update(f) for f in raw]
+    scalar = len(raw) / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    blat, blon, berr, accepted = FixFilter().batch(lat, lon, t, sigma)
+    batch1 = len(lat) / (time.perf_counter() - t0)
+    tracks = 500
+    t0 = time.perf_counter()
+    FixFilter().batch(*(np.tile(v, (tracks, 1)) for v in (lat, lon, t, sigma)))
+    batchn = tracks * len(lat) / (time.perf_counter() - t0)
+
+    # streaming and batch agree
+    assert (np.array([s is not None for s in smoothed]) == accepted).all()
+    assert np.allclose([s.lat for s in smoothed if s], blat[accepted], rtol=0, atol=1e-9)
+    print("rejected %d fixes (%.1f%%)" % ((~accepted).sum(), 100. * (~accepted).mean()))
+
+    def metres(la, lo, la2, lo2):
+        return np.hypot((la - la2) * _KY, (lo - lo2) * _KY * math.cos(math.radians(lat[0])))
+
+    if truth is not None:
+        print("outliers caught %d of %d, good fixes rejected %d" % (
+            (~accepted & bad).sum(), bad.sum(), (~accepted & ~bad).sum()))
+        rms = lambda m: np.sqrt(np.mean(metres(lat[m], lon[m], truth[0][m], truth[1][m]) ** 2))
+        print("error vs truth, rms: raw %.2f m, good raw fixes %.2f m, filtered %.2f m" % (
+            rms(slice(None)), rms(~bad),
+            np.sqrt(np.mean(metres(blat[accepted], blon[accepted], truth[0][accepted], truth[1][accepted]) ** 2))))
+    print("mean step between fixes: raw %.2f m, filtered %.2f m" % (
+        metres(lat[1:], lon[1:], lat[:-1], lon[:-1]).mean(),
+        metres(blat[accepted][1:], blon[accepted][1:], blat[accepted][:-1], blon[accepted][:-1]).mean()))
+
+    def published(stream):
+        rate = AdaptiveRate(max_rate=1., heartbeat=30., min_distance=3., min_speed=0.5, adaptive=True)
+        return sum(1 for f in stream if f is not None and rate.should_send(f, None, now=f.ts))
+    print("AdaptiveRate would publish: raw %d, filtered %d" % (published(raw), published(smoothed)))
+    print("streaming %.0f fixes/s, batch of one track %.0f fixes/s, %d tracks side by side %.0f fixes/s" % (
+        scalar, batch1, tracks, batchn))
@@ -0,0 +1,49 @@
+import logging
+import os
+import threading
+
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class RateLimit(logging.Filter):
+    """ Lets each message (by logger and format string, not by its
+    arguments) through at most `burst` times per `interval` seconds. The
+    next one let through says how many were held back meanwhile, so a
+    report per fix cannot flood the tmux log. """
+
+    def __init__(self, interval=None, burst=None):
+        logging.Filter.__init__(self)
+        self.interval = float(interval if interval is not None else os.getenv('LOG_INTERVAL', 10))
+        self.burst = int(burst if burst is not None else os.getenv('LOG_BURST', 3))
+        self._seen = {} # (name, msg) -> [window start, passed, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = record.created
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is None or now - entry[0] >= self.interval:
+                suppressed = entry[2] if entry else 0
+                entry = self._seen[key] = [now, 0, 0]
+                if suppressed:
+                    record.msg = "%s (%d more suppressed)" % (record.msg, suppressed)
+            if entry[1] >= self.burst:
+                entry[2] += 1
+                return False
+            entry[1] += 1
+        return True
+
+
+def setup(level=None):
+    # LOG_LEVEL (DEBUG, INFO, WARNING...) gates what is formatted at all
+    level = level or os.getenv('LOG_LEVEL', 'INFO')
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.INFO), format=FORMAT)
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, RateLimit) for f in handler.filters):
+            handler.addFilter(RateLimit())
+
+
+def get(name):
+    return logging.getLogger(name)
@@ -2,225 +2,263 @@
 
 import os
 import threading
-import json
-import time
 from uuid import getnode as gma
 
-from robotStateCode import RobotState
+import boot
+# stage and import timings from here on, logged once the first fix is out
+BOOT = boot.Boot(until=("first fix queued", "websocket connected"))
+
+from robotStateCode import RobotState, REFUSALS
 import gui
 import buttons
+import ui
+from dispatch import Dispatcher
+from rate import AdaptiveRate
+from rows import RowResolver
+import kalman
 
-use_gpsd = bool( os.getenv("MODEM_SERIAL_PORT") )
-if use_gpsd: 
-    import _gpsd_service
-else:
-    import _gpsd_serial
+import log
+import metrics
+log.setup()
+logger = log.get("main")
 
+# the gps client library, pyserial, the websocket and track modules are
+# only imported by the stage that starts them
+import sources
 
-import ws
 
-from logging import basicConfig, INFO
-basicConfig(level=INFO)
+def gps_waits(names=None):
+    # the gps starts once one of its sources can be opened, it opens the
+    # others as they turn up
+    names = names or sources.configured()
+    return [("gps source (%s)" % ", ".join(names), lambda: sources.any_ready(names))]
 
 
 class MainApp():
 
-    def __init__(self, gps_rate=None):
-        # initialize objects
-        self.stop_blink = threading.Event()
+    def __init__(self, gps_rate=None, gps=None):
+        # initialize objects; gps lets the replay harness hand in its own GPS
+        self.gps_rate = gps_rate
+        self.stop_event = threading.Event()
+        # presses are queued here, the GPIO and Tk threads never wait on a handler
+        self.commands = Dispatcher()
         self._gui = gui.GUI(
-            on_green=self.green_callback,
-            on_blue=self.blue_callback,
-            on_red=self.red_callback
+            on_green=self.press('green', self.green_callback),
+            on_blue=self.press('blue', self.blue_callback),
+            on_red=self.press('red', self.red_callback)
         )
         self._buttons = buttons.Buttons(
-            on_green=self.green_callback, 
-            on_blue=self.blue_callback, 
-            on_red=self.red_callback
+            on_green=self.press('green', self.green_callback),
+            on_blue=self.press('blue', self.blue_callback),
+            on_red=self.press('red', self.red_callback)
         )
+        # LEDs and widgets are only written from the display thread
+        self.ui = ui.UI(self._gui, self._buttons)
 
         self.rs = RobotState()
-        print("The first state in the state machine is: %s" % self.rs.state)
+        logger.info("the first state in the state machine is: %s", self.rs.state)
         # print("Mac Address: " + str(gma()))
-        self._gps = _gps.GPS()
+        # opened by the gps stage, see start()
+        self._gps = gps
 
     def set(self, all=None, r=None, g=None, b=None):
-        if all is not None:
-            r, g, b = all, all, all
-        if r is not None:
-            self._buttons.setRedLed(r)
-            self._gui.setRedButton(r)
-        if g is not None:
-            self._buttons.setGreenLed(g)
-            self._gui.setGreenButton(g)
-        if b is not None:
-            self._buttons.setBlueLed(b)
-            self._gui.setBlueButton(b)
+        self.ui.set(all, r, g, b)
 
     def set_text(self, desc):
-        print(desc)
-        self._gui.setDescription(desc)
+        logger.info("%s", desc)
+        self.ui.set_text(desc)
 
     def get_text(self):
-        return self._gui.getDescription()
+        return self.ui.get_text()
 
-    def start(self, gps_rate=None):
+    def toast(self, text, seconds=2.):
+        # shown over the current text, which comes back on its own
+        logger.info("%s", text)
+        self.ui.toast(text, seconds)
+
+    def press(self, name, handler):
+        return lambda channel: self.commands.press(name, handler, channel)
+
+    def get_user_name(self):
         # User login
-        # self.user_name = self._gui.waitForLogin() # < blocking
+        # return self._gui.waitForLogin() # < blocking
         if os.getenv('USERNAME', None):
-            self.user_name = os.getenv('USERNAME')
-        else:
-            temp_user = '%012x' % gma()
-            self.user_name = "picker_"+temp_user.replace(':', '')
-            print("User: "+self.user_name)
-
-        # init websocket
-        address = os.getenv('WS_ADDRESS')
-        self._ws = ws.WS(address=address,
-                         user_name=self.user_name,
-                         update_orders_cb=self.update_orders_cb)
+            return os.getenv('USERNAME')
+        temp_user = '%012x' % gma()
+        user_name = "picker_"+temp_user.replace(':', '')
+        logger.info("user: %s", user_name)
+        return user_name
 
-        # setup the main gui window
-        self._gui.setupMainWindow()
+    def after(self, seconds, fn):
+        # run fn once seconds have passed, in order with the button handlers
+        self.commands.later(seconds, fn)
 
-        self._gui.setUser("User: " + self.user_name)
+    def start(self, gps_rate=None):
+        self.user_name = self.get_user_name()
+        gps_rate = gps_rate if gps_rate is not None else self.gps_rate
+
+        # init websocket; until its stage starts it, it only queues
+        with BOOT.stage("websocket setup"):
+            ws = BOOT.load("ws")
+            self._ws = ws.WS(address=os.getenv('WS_ADDRESS'),
+                             user_name=self.user_name,
+                             update_orders_cb=self.update_orders_cb)
+
+        # kept by the gui until the window is set up below
+        self.ui.set_user("User: " + self.user_name)
         self.set_text("Welcome to Call A Robot.")
+        self.ui.start()
+        self.commands.start()
 
-        # start gps thread
-        self._gps.start()
+        # gps and websocket come up in parallel, each once its hardware or
+        # network is there
+        BOOT.spawn("gps", lambda: self.start_gps(gps_rate),
+                   *(gps_waits() if self._gps is None else ()))
+        BOOT.spawn("websocket", self.start_ws,
+                   ("network route", lambda: boot.route_ready(self._ws.address)))
 
-        # start ws thread
-        self._ws.start()
+        self.serve_metrics()
 
-        print("Initialization complete")
-        if gps_rate is None:
-            # we want gps readings as soon as they arrive
-            self._gps.set_callback(self._ws.send_gps)
+        # setup the main gui window last, the uplink does not wait for it
+        if self._gui.backend == 'tk':
+            BOOT.wait("display", boot.display_ready)
+        with BOOT.stage("window"):
+            self._gui.setupMainWindow()
 
-            # start gui thread (tkinter only runs on the main thread :-( )
-            self._gui.loopMainWindow()  # < blocking
-        else:
-            # we want gps readings at a certain rate
-            seconds = 1./float(gps_rate)
+        logger.info("initialization complete")
+
+        # start gui thread (tkinter only runs on the main thread :-( )
+        self._gui.loopMainWindow()  # < blocking
+
+    def start_gps(self, gps_rate=None):
+        if self._gps is None:
+            self._gps = sources.FailoverGPS(load=BOOT.load)
+        self._gps.start()
 
-            while self._gps.has_more_data():
-                lat, lon, epx, epy, ts  = self._gps.get_latest_data()
+        # forward fixes from the gps ring buffer, so a slow uplink never
+        # holds up the gps thread
+        self._uplink = threading.Thread(target=self.uplink, args=(gps_rate,))
+        self._uplink.daemon = True
+        self._uplink.start()
 
-                self._ws.send_gps(lat, lon, epx, epy, ts)
+        self._track = self.start_track(self._gps.subscribe("track"))
 
-                time.sleep(seconds)
+    def start_ws(self):
+        self._ws.start()
+        if self._ws.connected.wait(BOOT.timeout):
+            BOOT.mark("websocket connected")
+
+    def serve_metrics(self):
+        # local endpoint (METRICS_ADDRESS), the coordinator gets a summary
+        # every METRICS_INTERVAL seconds with the locations, see flush_uplink()
+        try:
+            self._metrics = metrics.serve()
+        except (IOError, OSError) as e:
+            logger.warning("metrics endpoint unavailable: %s", e)
+
+    def setup_uplink(self, gps_rate=None):
+        # gps_rate caps the publish rate, the robot state and the picker's
+        # motion decide how much of it is used
+        self.rate = AdaptiveRate(max_rate=gps_rate)
+        self.rows = RowResolver()
+        # multipath under the tunnels: smooth, and drop what cannot be right
+        self.smooth = kalman.FixFilter() if kalman.enabled() else None
+        self.summary = metrics.Summary()
+
+    def forward(self, fix):
+        # one fix from the gps on its way to the coordinator
+        if self.smooth is not None:
+            fix = self.smooth.update(fix)
+        if fix is not None and fix.valid:
+            # entering a row is news for the coordinator, send it now
+            row = self.rows.update(fix)
+            if self.rate.should_send(fix, self.rs.state, row=row):
+                self._ws.send_gps(fix, row)
+                BOOT.mark("first fix queued")
+
+    def flush_uplink(self):
+        # a batch whose window ran out while the gps was quiet, and the
+        # metrics summary when it is due
+        self._ws.flush_gps()
+        if self.summary.due():
+            self._ws.send_metrics(self.summary.take())
+
+    def uplink(self, gps_rate=None):
+        sub = self._gps.subscribe("uplink")
+        self.setup_uplink(gps_rate)
+        metrics.gauge("uplink_dropped", lambda: sub.dropped)
+
+        while not self.stop_event.is_set():
+            fix = sub.next(timeout=1.)
+            if fix is not None:
+                self.forward(fix)
+            self.flush_uplink()
+
+        self._ws.flush_gps(force=True)
+        sub.close()
+
+    def start_track(self, subscription):
+        # keep the track on the device, TRACK_DIR= (empty) turns it off
+        track = BOOT.load("track")
+        if not track.default_dir():
+            subscription.close()
+            return None
+        recorder = track.TrackRecorder(subscription)
+        recorder.start()
+        return recorder
 
     def stop(self):
-        self._gps.stop()
+        self.stop_event.set()
+        self.commands.stop()
+        if getattr(self, '_track', None) is not None:
+            self._track.stop()
+            self._track.join(2.)
+        if self._gps is not None:
+            self._gps.stop()
         self._ws.stop()
         self._buttons.cleanup()
 
     # this receives updated state for the current user
     def update_orders_cb(self, new_state):
-        old_state = self.rs.state
-        self.rs.state = new_state
-
-        # CONNECTED sent from the coordintor on agent init
-        if new_state in ["CONNECTED"]:
-            self.set_text("Connected to Server.")
-            self.set(True)
-
-
-        # REGISTERED sent once human_base_init completes, at this point the picker is able to respond
-        # car_INIT sent after completion or cancellation
-        elif new_state in ["REGISTERED", "car_INIT"]:
-            self.set_text("Ready to Call")
-            self.set(g=True, r=False, b=False) #prompt for valid inputs
-
-
-        # car_ACCEPT sent once robot is assigned by coordinator in response to BEGUN
-        elif new_state in ["car_ACCEPT"]:
-            self.set_text("A Robot is on the way")
-            self.set(g=False, r=True, b=False)
-
-        # car_ARRIVED sent once robot has reached the picker
-        elif new_state in ["car_ARRIVED"]:
-            self.set_text("Load trays on robot then press BLUE button.")
-            self.set(g=False, r=True, b=True)
-            self.blink_thr = threading.Thread(target=self.blue_blink)
-            self.blink_thr.start()
-
-        # car_LOADED sent by picker once trays have been loaded
-        # elif new_state == "car_LOADED" and old_state == "car_LOADED":
-        #     self.stop_blink.set()
-
-        # car_COMPLETE sent by ???
-        elif new_state in ["car_COMPLETE"]:
-            self.stop_blink.set()
-
-        # Task cancellation from coordinator
-        elif new_state in ["car_CANCEL"]:
-            self.set_text("Task Has Been Cancelled. \nClick any to Reset")
-            self.set(g=False, r=True, b=False)
-
+        # handled with the button presses, so only one thread moves self.rs
+        self.commands.call(self.on_event, new_state)
 
     def green_callback(self, _):
-        print("Green button pressed")
-        if self.rs.state in ["REGISTERED", "car_INIT"]:
-            self.set_text("Request has been sent.")
-            self.set(g=False, r=True, b=False) #prompt for valid inputs
-            # self.stop_blink.clear()
-            self._ws.call_robot()
-            self.rs.state = "car_CALLED"
-
-        elif self.rs.state in ["car_COMPLETE", "car_CANCEL"]:
-            self.set_text("Ready to Call")
-            self.set(g=True, r=False, b=False) #prompt for valid inputs
-            self.rs.state = "car_INIT"
-
-        else:
-            txt = self.get_text()
-            self.set_text("Cannot call a robot right now.")
-            time.sleep(2)
-            self.set_text(txt)
+        logger.info("green button pressed")
+        self.on_event('green')
 
     def red_callback(self, _):
-        print("Red button pressed")
-        if self.rs.state in ["car_CALLED", "car_ACCEPT", "car_ARRIVED"]:
-            self.set_text("Cancelling...")
-            self.stop_blink.clear()
-            self.set(False)
-            self._ws.cancel_robot()
-            self.rs.state = "car_CANCEL"
-            time.sleep(2)
-            self.set_text("Press GREEN to continue.")
-            self.set(g=True, r=False, b=False) #prompt for valid inputs
-        else:
-            txt = self.get_text()
-            self.set_text("Cannot cancel any robot right now.")
-            time.sleep(2)
-            self.set_text(txt)
+        logger.info("red button pressed")
+        self.on_event('red')
 
     def blue_callback(self, _):
-        if self.rs.state in ["car_ARRIVED"]:
-            self.set_text("Thank you the robot will now drive away.")
-            self.stop_blink.clear()
-            self.set(False)
-            self._ws.set_loaded()
-            self.rs.state = "car_LOADED"
-            time.sleep(2)
-            self.set_text("Press GREEN to continue.")
-            self.set(g=True, r=False, b=False) #prompt for valid inputs
-
+        logger.info("blue button pressed")
+        self.on_event('blue')
+
+    def on_event(self, event):
+        # coordinator states and button presses, see robotStateCode's tables
+        step = self.rs.fire(event)
+        if step is None:
+            self.toast(REFUSALS[event])
+            return
+        if step.action is not None:
+            getattr(self._ws, step.action)()
+        self.show(step.view)
+        if step.then is not None:
+            self.after(2, lambda: self.rs.state == step.dest and self.show(step.then))
+
+    def show(self, view):
+        if view is None:
+            return
+        text, leds, blink = view
+        if text is not None:
+            self.set_text(text)
+        if leds is not None:
+            self.set(r=leds[0], g=leds[1], b=leds[2])
+        if blink:
+            self.ui.blink(blink)
         else:
-            txt = self.get_text()
-            self.set_text("Cannot load a robot right now.")
-            time.sleep(2)
-            self.set_text(txt)
-
-
-
-    def blue_blink(self):        
-        while not (self.stop_blink.is_set()):
-            self.set(b=True)
-            time.sleep(0.5)
-            self.set(b=False)
-            time.sleep(0.5)
+            self.ui.stop_blink()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Single-threaded runtime: GNSS, websocket, registration, buttons, the UI
+# and the Tk window all run on one asyncio event loop.
+
+import asyncio
+import os
+import signal
+import threading
+
+from robotStateCode import RobotState
+from fixbuffer import FixRing
+import boot
+import gui
+import buttons
+import ui
+from dispatch import Dispatcher
+import gps_async
+import sources
+import ws_async
+import log
+
+from main import BOOT, MainApp, gps_waits
+
+logger = log.get("main")
+
+
+class AsyncApp(MainApp):
+
+    def __init__(self, gps_rate=None):
+        self.gps_rate = gps_rate
+        self.loop = asyncio.new_event_loop()
+        self.stop_event = threading.Event()
+
+        # debounced like MainApp, but handlers run on the loop; RPi.GPIO
+        # calls back on its own thread, so hop over thread-safely
+        self.commands = Dispatcher(submit=self.loop.call_soon_threadsafe)
+        self._gui = gui.GUI(
+            on_green=self.press('green', self.green_callback),
+            on_blue=self.press('blue', self.blue_callback),
+            on_red=self.press('red', self.red_callback)
+        )
+        self._buttons = buttons.Buttons(
+            on_green=self.press('green', self.green_callback),
+            on_blue=self.press('blue', self.blue_callback),
+            on_red=self.press('red', self.red_callback)
+        )
+        # blinking runs on the display timers the loop pumps in tk()
+        self.ui = ui.UI(self._gui, self._buttons)
+
+        self.rs = RobotState()
+        self.fixes = FixRing(int(os.getenv("GPS_BUFFER_SIZE", 64)))
+        # the loop runs the gpsd, serial and multiplexed AT sources, see
+        # sources.Selector
+        self.sources = [n for n in sources.configured() if n in ('gpsd', 'at', 'atmux', 'nmea')]
+        self.selector = sources.Selector(self.sources)
+        self.retry = float(os.getenv("GPS_RETRY", 5))
+        self.setup_uplink(gps_rate)
+
+    def after(self, seconds, fn):
+        self.loop.call_later(seconds, fn)
+
+    def _gps_source(self, name):
+        if name == 'gpsd':
+            return gps_async.gpsd_fixes()
+        if name == 'nmea':
+            return gps_async.serial_fixes(os.getenv("NMEA_SERIAL_PORT", "/dev/ttyUSB1"), commands=False)
+        if name == 'atmux':
+            return gps_async.atmux_fixes()
+        return gps_async.serial_fixes()
+
+    async def gps_source(self, name):
+        # one source, reopened GPS_RETRY seconds after it fails or ends
+        while True:
+            if not sources.SOURCES[name].ready(): # not there yet, or the PPP tty
+                await asyncio.sleep(self.retry)
+                continue
+            try:
+                async for fix in self._gps_source(name):
+                    for f in self.selector.offer(name, fix):
+                        self.on_fix(f)
+                logger.info("gps source %s ended", name)
+            except (IOError, OSError, ValueError) as e:
+                logger.warning("gps source %s failed: %s", name, e)
+            await asyncio.sleep(self.retry)
+
+    async def gps(self):
+        if not self.sources:
+            raise ValueError("no GPS source the event loop can run in %s" % ", ".join(sources.configured()))
+        for name, check in gps_waits(self.sources):
+            await BOOT.wait_async(name, check)
+        await asyncio.gather(*(self.gps_source(name) for name in self.sources))
+
+    async def websocket(self):
+        await BOOT.wait_async("network route", lambda: boot.route_ready(self._ws.address))
+        connected = self.loop.create_task(self._ws.connected.wait())
+        connected.add_done_callback(lambda t: t.cancelled() or BOOT.mark("websocket connected"))
+        try:
+            await self._ws.run()
+        finally:
+            connected.cancel()
+
+    def on_fix(self, fix):
+        self.fixes.publish(fix)
+        sources.FIXES.inc()
+        self.forward(fix)
+
+    async def flush_gps(self):
+        # the switch to a standby source when the active one went quiet,
+        # then what MainApp.uplink flushes every second
+        while True:
+            await asyncio.sleep(1.)
+            for fix in self.selector.tick():
+                self.on_fix(fix)
+            self.flush_uplink()
+
+    async def tk(self):
+        # pump the display (Tk events, display timers) from the loop instead
+        # of handing the thread to its mainloop
+        while self._gui.update():
+            await asyncio.sleep(0.02)
+
+    async def run(self):
+        self.user_name = self.get_user_name()
+        with BOOT.stage("websocket setup"):
+            self._ws = ws_async.AsyncWS(address=os.getenv('WS_ADDRESS'),
+                                        user_name=self.user_name,
+                                        update_orders_cb=self.update_orders_cb)
+
+        self.ui.set_user("User: " + self.user_name)
+        self.set_text("Welcome to Call A Robot.")
+        self.ui.start()
+
+        # the recorder's file writes stay off the loop, on its own thread
+        self._track = self.start_track(self.fixes.subscribe("track"))
+
+        # gps and websocket come up as tasks, each once its hardware or
+        # network is there
+        tasks = [self.websocket(), self.gps(), self.flush_gps()]
+        tasks = [self.loop.create_task(t) for t in tasks]
+        try:
+            self.serve_metrics()
+
+            # setup the main gui window once the uplink is on its way
+            await asyncio.sleep(0)
+            if self._gui.backend == 'tk':
+                await BOOT.wait_async("display", boot.display_ready)
+            with BOOT.stage("window"):
+                self._gui.setupMainWindow()
+            tasks.append(self.loop.create_task(self.tk()))
+
+            logger.info("initialization complete")
+
+            # the first subsystem to finish (or fail) shuts the others down
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is not None:
+                    logger.error("subsystem failed: %r", t.exception())
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def start(self, gps_rate=None):
+        if gps_rate is not None:
+            self.gps_rate = gps_rate
+            self.rate.max_rate = float(gps_rate)
+
+        main = self.loop.create_task(self.run())
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, main.cancel)
+        try:
+            self.loop.run_until_complete(main)
+        except asyncio.CancelledError:
+            print ("Exiting")
+        finally:
+            self.stop()
+
+    def stop(self):
+        if getattr(self, '_track', None) is not None:
+            self._track.stop()
+            self._track.join(2.)
+        if getattr(self, '_ws', None) is not None:
+            self._ws.stop()
+        self._buttons.cleanup()
+        self.loop.close()
+
+
+if __name__ == "__main__":
+    # pub gps rate
+    rate = 2 # hz
+    AsyncApp(rate).start()
@@ -0,0 +1,248 @@
+import bisect
+import json
+import os
+import threading
+import time
+from array import array
+
+
+# histogram bucket upper bounds, 1-2-5 steps from 10 us to 10 s (in ms)
+BOUNDS = tuple(m * 10 ** e for e in range(-2, 5) for m in (1, 2, 5) if m * 10 ** e <= 10000)
+
+
+class Counter(object):
+    __slots__ = ('name', '_values', '_i')
+
+    def __init__(self, name, values, i):
+        self.name = name
+        self._values = values
+        self._i = i
+
+    def inc(self, n=1):
+        self._values[self._i] += n
+
+    @property
+    def value(self):
+        return self._values[self._i]
+
+
+class Histogram(object):
+    """ Counts of observations per BOUNDS bucket (plus one for anything
+    larger), their sum and count, all in slots of the registry's arrays. """
+
+    __slots__ = ('name', '_counts', '_sums', '_base', '_i')
+
+    def __init__(self, name, counts, sums, base, i):
+        self.name = name
+        self._counts = counts
+        self._sums = sums
+        self._base = base
+        self._i = i
+
+    def observe(self, value):
+        self._counts[self._base + bisect.bisect_left(BOUNDS, value)] += 1
+        self._sums[self._i] += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        counts = self._counts[self._base:self._base + len(BOUNDS) + 1]
+        n = sum(counts)
+        return {'count': n, 'sum': round(self._sums[self._i], 3),
+                'p50': self._quantile(counts, n, .5), 'p90': self._quantile(counts, n, .9),
+                'p99': self._quantile(counts, n, .99)}
+
+    @staticmethod
+    def _quantile(counts, n, q):
+        # upper bound of the bucket holding the q-th observation, 'inf' past
+        # the last bound (kept a string so the JSON stays standard)
+        if not n:
+            return None
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= q * n:
+                return BOUNDS[i] if i < len(BOUNDS) else 'inf'
+
+
+class _Timer(object):
+    # with histogram.time(): ...  observes the block's duration in ms
+    __slots__ = ('_h', '_t')
+
+    def __init__(self, h):
+        self._h = h
+
+    def __enter__(self):
+        self._t = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self._h.observe((time.perf_counter() - self._t) * 1000.)
+
+
+class Metrics(object):
+    """ Counters, histograms and gauges of the running device.
+
+    Values live in arrays allocated up front, so recording is an index and
+    an add, no allocation. Each metric is meant to have one writing thread
+    (an unlocked += could lose an update under contention, which is fine
+    for statistics). Gauges are functions sampled only when a snapshot is
+    taken, so queue depths and byte counts cost nothing on the hot path.
+    """
+
+    def __init__(self, max_counters=64, max_histograms=16):
+        self._counter_values = array('q', [0] * max_counters)
+        self._hist_counts = array('q', [0] * (max_histograms * (len(BOUNDS) + 1)))
+        self._hist_sums = array('d', [0.] * max_histograms)
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def counter(self, name):
+        with self._lock:
+            c = self.counters.get(name)
+            if c is None:
+                if len(self.counters) == len(self._counter_values):
+                    raise ValueError("no counter slot left for %r" % name)
+                c = self.counters[name] = Counter(name, self._counter_values, len(self.counters))
+            return c
+
+    def histogram(self, name):
+        with self._lock:
+            h = self.histograms.get(name)
+            if h is None:
+                i = len(self.histograms)
+                if i == len(self._hist_sums):
+                    raise ValueError("no histogram slot left for %r" % name)
+                h = self.histograms[name] = Histogram(name, self._hist_counts, self._hist_sums,
+                                                      i * (len(BOUNDS) + 1), i)
+            return h
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        gauges = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception:
+                gauges[name] = None
+        counters = {name: c.value for name, c in self.counters.items()}
+        # reports without a position, over every source's gps_<name>_* counters
+        fixes = no_fix = 0
+        for name, value in counters.items():
+            if name.startswith('gps_'):
+                if name.endswith('_fixes'):
+                    fixes += value
+                elif name.endswith('_no_fix'):
+                    no_fix += value
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'counters': counters,
+            'no_fix_ratio': round(no_fix / float(fixes + no_fix), 3) if fixes + no_fix else None,
+            'histograms': {name: h.snapshot() for name, h in self.histograms.items()},
+            'gauges': gauges,
+        }
+
+
+METRICS = Metrics()
+counter = METRICS.counter
+histogram = METRICS.histogram
+gauge = METRICS.gauge
+snapshot = METRICS.snapshot
+
+
+class Summary(object):
+    """ What the device tells the coordinator every `interval` seconds:
+    the snapshot plus per second rates of the counters since the last one. """
+
+    def __init__(self, interval=None, metrics=METRICS):
+        self.interval = float(interval if interval is not None else os.getenv('METRICS_INTERVAL', 60))
+        self.metrics = metrics
+        self._last = (time.time(), {})
+
+    def due(self, now=None):
+        return self.interval > 0 and (now or time.time()) - self._last[0] >= self.interval
+
+    def take(self, now=None):
+        now = now or time.time()
+        snap = self.metrics.snapshot()
+        then, before = self._last
+        dt = max(now - then, 1e-6)
+        snap['rates'] = {name: round((value - before.get(name, 0)) / dt, 3)
+                         for name, value in snap['counters'].items()}
+        self._last = (now, snap['counters'])
+        return snap
+
+
+def serve(address=None, metrics=METRICS):
+    # GET /metrics (JSON) on METRICS_ADDRESS: "host:port" or "unix:/path";
+    # returns the server, already serving on a daemon thread, or None
+    address = address if address is not None else os.getenv('METRICS_ADDRESS', '127.0.0.1:9108')
+    if not address:
+        return None
+    from http.server import BaseHTTPRequestHandler
+    import socketserver
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = json.dumps(metrics.snapshot()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    if address.startswith('unix:'):
+        path = address[5:]
+        if os.path.exists(path):
+            os.remove(path)
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+            def get_request(self):
+                # BaseHTTPRequestHandler expects a (host, port) client address
+                sock, _ = socketserver.UnixStreamServer.get_request(self)
+                return sock, ('unix', 0)
+
+        server = Server(path, Handler)
+    else:
+        host, port = address.rsplit(':', 1)
+
+        class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        server = Server((host, int(port)), Handler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    # cost of recording, per call
+    n = 200000
+    c = counter('bench')
+    h = histogram('bench_ms')
+    t = time.perf_counter()
+    for _ in range(n):
+        c.inc()
+    inc = (time.perf_counter() - t) / n * 1e9
+    t = time.perf_counter()
+    for i in range(n):
+        h.observe(i % 1000 * 0.01)
+    observe = (time.perf_counter() - t) / n * 1e9
+    print("counter.inc %.0f ns, histogram.observe %.0f ns" % (inc, observe))
+    print(json.dumps(snapshot()['histograms']['bench_ms']))
@@ -0,0 +1,368 @@
+import calendar
+import re
+import time
+
+from fix import LazyFix, HAS_POSITION, HAS_ALT, HAS_SPEED, HAS_COURSE, HAS_UTC, HAS_SATS, HAS_HDOP
+
+
+# knots -> m/s, +CGPSINFO and RMC both report speed over ground in knots
+KNOTS = 0.514444
+
+NO_FIX = None
+
+_new = LazyFix.__new__
+
+
+class _ATFix(LazyFix):
+    # the +CGPSINFO fields, lat,N/S,lon,E/W,date,time,alt,speed,course,
+    # with the last hdop seen put in place of the time
+    __slots__ = ()
+    _at = (6, 7, 8, 5)
+    _speed = KNOTS
+
+
+class _NMEAFix(LazyFix):
+    # an epoch collected from RMC/GGA/GSA, see FixParser._pending
+    __slots__ = ()
+    _at = (2, 3, 4, 7)
+    _speed = KNOTS
+
+
+class LineFramer:
+    """ Incremental \\r\\n framer: feed() returns the complete lines read so
+    far, without their \\r\\n, and keeps the incomplete last one for the next
+    read. A last line growing past max_size without a line end (a modem
+    spewing garbage) is dropped, the complete lines before it are not.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._tail = b""
+        self.dropped = 0
+
+    def feed(self, data):
+        if self._tail:
+            data = self._tail + data
+        lines = data.split(b"\r\n")
+        tail = lines.pop()
+        if len(tail) > self.max_size:
+            self.dropped += len(tail)
+            tail = b""
+        self._tail = tail
+        return lines
+
+
+def _degrees(value, hemisphere, negative):
+    # ddmm.mmmm / dddmm.mmmm -> decimal degrees
+    value = float(value)
+    deg = value // 100
+    deg += (value - deg * 100) / 60
+    return -deg if hemisphere == negative else deg
+
+
+_midnights = {}
+
+
+def _utc(date, hms):
+    # ddmmyy + hhmmss.s -> epoch seconds, the date part changes once a day
+    if len(hms) < 6:
+        return None
+    midnight = _midnights.get(date)
+    if midnight is None:
+        if len(date) < 6:
+            return None
+        _midnights.clear()
+        midnight = _midnights[date] = calendar.timegm(
+            (2000 + int(date[4:6]), int(date[2:4]), int(date[0:2]), 0, 0, 0))
+    hms = float(hms)
+    hh = hms // 10000
+    mm = hms // 100 - hh * 100
+    return midnight + hh * 3600 + mm * 60 + (hms - hh * 10000 - mm * 100)
+
+
+def _xor(line):
+    # XOR of all bytes: fold the bytes as one integer onto its low byte,
+    # 7 shifts instead of a Python loop; NMEA sentences are at most 82 bytes
+    if len(line) > 128:
+        acc = 0
+        for c in line:
+            acc ^= c
+        return acc
+    x = int.from_bytes(line, 'little')
+    x ^= x >> 512
+    x ^= x >> 256
+    x ^= x >> 128
+    x ^= x >> 64
+    x ^= x >> 32
+    x ^= x >> 16
+    x ^= x >> 8
+    return x & 0xFF
+
+
+_HEX = dict((b"%02X" % i, i) for i in range(256))
+_HEX.update((b"%02x" % i, i) for i in range(256))
+
+
+class FixParser:
+    """ Turns raw modem bytes into fix.Fix records.
+
+    Understands the +CGPSINFO AT report and the RMC/GGA/GSA NMEA sentences
+    (any talker: GP, GN, GL, ...). RMC and GGA belonging to the same epoch
+    are merged into one fix, or each one is a fix by itself while the other
+    has never been seen; the last GSA dilution values are attached to it.
+    Position and time are decoded straight away, altitude, speed, course
+    and HDOP when they are first read (fix.LazyFix).
+    """
+
+    def __init__(self, verify_checksum=True):
+        self.framer = LineFramer()
+        self.verify_checksum = verify_checksum
+        self.no_fix = 0
+        self.errors = 0
+
+        self._epoch = None # time of the epoch being collected
+        self._emitted = None # of the last one that became a fix on one sentence
+        self._rmc_seen = self._gga_seen = False
+        self._rmc_ever = self._gga_ever = False
+        # [lat, lon, alt, speed, course, utc, sats, hdop], alt, speed,
+        # course and hdop as the sentence's bytes
+        self._pending = [None] * 8
+        self._date = b""
+        self._hdop = None
+
+    def feed(self, data):
+        fixes = []
+        parse = self.parse_line
+        for line in self.framer.feed(data):
+            fix = parse(line)
+            if fix is not None:
+                fixes.append(fix)
+        return fixes
+
+    def parse_line(self, line):
+        # line: one line without its \r\n
+        try:
+            if line[:11] == b"+CGPSINFO: ":
+                return self._cgpsinfo(line[11:].split(b","))
+            if line[:1] != b"$":
+                return NO_FIX
+            star = len(line) - 3
+            if star > 0 and line[star] == 42: # "*hh"
+                if self.verify_checksum and _xor(line[1:star]) != _HEX.get(line[star + 1:]):
+                    self.errors += 1
+                    return NO_FIX
+                line = line[:star]
+            kind = line[3:6]
+            if kind == b"RMC":
+                return self._rmc(line.split(b","))
+            if kind == b"GGA":
+                return self._gga(line.split(b","))
+            if kind == b"GSA":
+                return self._gsa(line.split(b","))
+            return NO_FIX
+        except (IndexError, ValueError):
+            self.errors += 1
+            return NO_FIX
+
+    def _cgpsinfo(self, f):
+        # +CGPSINFO: lat,N/S,log,E/W,date,UTC time,alt,speed,course
+        lat, ns, lon, ew, date, hms, alt, speed, course = f[:9]
+        if not lat:
+            self.no_fix += 1
+            return NO_FIX
+        fix = _new(_ATFix)
+        # ddmm.mmmm / dddmm.mmmm -> decimal degrees
+        lat = float(lat)
+        deg = lat // 100
+        lat = deg + (lat - deg * 100) / 60
+        fix.lat = -lat if ns == b"S" else lat
+        lon = float(lon)
+        deg = lon // 100
+        lon = deg + (lon - deg * 100) / 60
+        fix.lon = -lon if ew == b"W" else lon
+        flags = HAS_POSITION
+        utc = _utc(date, hms)
+        if utc is None:
+            fix.utc = 0.
+        else:
+            fix.utc = utc
+            flags |= HAS_UTC
+        fix.ts = time.time()
+        fix.epx = fix.epy = 0.
+        fix.sats = 0
+        if alt:
+            flags |= HAS_ALT
+        if speed:
+            flags |= HAS_SPEED
+        if course:
+            flags |= HAS_COURSE
+        if self._hdop:
+            flags |= HAS_HDOP
+        f[5] = self._hdop
+        fix._raw = f
+        fix.flags = flags
+        return fix
+
+    def _rmc(self, f):
+        # $--RMC,time,status,lat,N/S,lon,E/W,speed,course,date,...
+        self._rmc_ever = True
+        if f[2] != b"A":
+            self.no_fix += 1
+            return NO_FIX
+        if f[1] == self._emitted:
+            self._emitted = None
+            return NO_FIX # that epoch went out on GGA alone
+        flushed = self._begin(f[1])
+        p = self._pending
+        p[0] = _degrees(f[3], f[4], b"S")
+        p[1] = _degrees(f[5], f[6], b"W")
+        p[3] = f[7]
+        p[4] = f[8]
+        self._date = f[9]
+        p[5] = _utc(f[9], f[1])
+        self._rmc_seen = True
+        return flushed or self._complete()
+
+    def _gga(self, f):
+        # $--GGA,time,lat,N/S,lon,E/W,quality,sats,hdop,alt,M,...
+        self._gga_ever = True
+        if f[6] in (b"", b"0"):
+            self.no_fix += 1
+            return NO_FIX
+        if f[1] == self._emitted:
+            self._emitted = None
+            return NO_FIX # that epoch went out on RMC alone
+        flushed = self._begin(f[1])
+        p = self._pending
+        p[0] = _degrees(f[2], f[3], b"S")
+        p[1] = _degrees(f[4], f[5], b"W")
+        p[2] = f[9]
+        if p[5] is None:
+            p[5] = _utc(self._date, f[1])
+        p[6] = int(f[7]) if f[7] else None
+        self._hdop = f[8]
+        self._gga_seen = True
+        return flushed or self._complete()
+
+    def _gsa(self, f):
+        # $--GSA,mode,fix,sv x12,pdop,hdop,vdop
+        if f[2] != b"1":
+            self._hdop = f[16]
+        return NO_FIX
+
+    def _begin(self, hms):
+        # start collecting a new epoch, flushing a half-seen previous one
+        if hms == self._epoch:
+            return NO_FIX
+        flushed = NO_FIX
+        if self._epoch is not None and self._pending[0] is not None:
+            flushed = self._emit()
+        self._epoch = hms
+        self._rmc_seen = self._gga_seen = False
+        return flushed
+
+    def _complete(self):
+        # both sentences of the epoch, or the only kind the receiver sends
+        if (self._rmc_seen or not self._rmc_ever) and (self._gga_seen or not self._gga_ever):
+            # alone, the other kind may still turn up for this epoch
+            self._emitted = None if self._rmc_seen and self._gga_seen else self._epoch
+            self._epoch = None
+            return self._emit()
+        return NO_FIX
+
+    def _emit(self):
+        p = self._pending
+        self._pending = [None] * 8
+        fix = _new(_NMEAFix)
+        fix.lat = p[0]
+        fix.lon = p[1]
+        flags = HAS_POSITION
+        if p[5] is None:
+            fix.utc = 0.
+        else:
+            fix.utc = p[5]
+            flags |= HAS_UTC
+        fix.ts = time.time()
+        fix.epx = fix.epy = 0.
+        if p[6] is None:
+            fix.sats = 0
+        else:
+            fix.sats = p[6]
+            flags |= HAS_SATS
+        if p[2]:
+            flags |= HAS_ALT
+        if p[3]:
+            flags |= HAS_SPEED
+        if p[4]:
+            flags |= HAS_COURSE
+        p[7] = self._hdop
+        if p[7]:
+            flags |= HAS_HDOP
+        fix._raw = p
+        fix.flags = flags
+        return fix
+
+
+# the parsing path _gpsd_serial used before this module, kept for the benchmark
+_LEGACY_REGEX = re.compile(r"(\+CGPSINFO: )[^\\]*")
+
+
+def _legacy_parse(raw):
+    match = _LEGACY_REGEX.search(repr(raw.decode(errors="ignore")))
+    if not match or match.group() == "+CGPSINFO: ,,,,,,,,":
+        return None
+    gpsData = match.group()[11:].split(",")
+    lat = round(((float(gpsData[0][2:]) / 60) + float(gpsData[0][:2])) * (1 if gpsData[1] == "N" else -1), 12)
+    lon = round(((float(gpsData[2][3:]) / 60) + float(gpsData[2][:3])) * (1 if gpsData[3] == "E" else -1), 12)
+    return lat, lon, -1, -1, time.time()
+
+
+if __name__ == "__main__":
+    # microbenchmark: sentences/s through the legacy regex path and this parser
+
+    n = 20000
+    cgps = b"+CGPSINFO: 5211.123456,N,00033.654321,W,171120,101010.0,12.3,1.2,45.0\r\n"
+    nmea = (b"$GPGGA,101010.0,5211.123456,N,00033.654321,W,1,09,0.8,12.3,M,47.0,M,,*7A\r\n"
+            b"$GPRMC,101010.0,A,5211.123456,N,00033.654321,W,1.2,45.0,171120,,,A*4C\r\n"
+            b"$GPGSA,A,3,01,02,03,04,05,06,07,08,09,,,,1.5,0.8,1.2*3C\r\n")
+
+    def rate(run, sentences):
+        t = time.perf_counter()
+        run()
+        return sentences / (time.perf_counter() - t)
+
+    def legacy_run():
+        for _ in range(n):
+            _legacy_parse(cgps)
+
+    def cgps_run(parser=FixParser()):
+        for _ in range(n):
+            parser.feed(cgps)
+
+    # checksums verified, as on the device
+    def nmea_run(parser=FixParser()):
+        for _ in range(n):
+            parser.feed(nmea)
+
+    # the same stream, split at arbitrary points like real serial reads are
+    stream = (cgps + nmea) * 100
+    fixes = []
+
+    def split_run(parser=FixParser()):
+        del fixes[:]
+        for i in range(0, len(stream), 37):
+            fixes.extend(parser.feed(stream[i:i + 37]))
+
+    # interleaved, best of 5: a busy machine only ever makes a run slower
+    legacy = fast = fast_nmea = split = 0
+    for _ in range(5):
+        legacy = max(legacy, rate(legacy_run, n))
+        fast = max(fast, rate(cgps_run, n))
+        fast_nmea = max(fast_nmea, rate(nmea_run, 3 * n))
+        split = max(split, rate(split_run, 400))
+    fixes = len(fixes)
+
+    print("legacy regex +CGPSINFO : %10.0f sentences/s" % legacy)
+    print("framer +CGPSINFO       : %10.0f sentences/s" % fast)
+    print("framer RMC/GGA/GSA     : %10.0f sentences/s" % fast_nmea)
+    print("framer split reads     : %10.0f sentences/s (%d fixes)" % (split, fixes))
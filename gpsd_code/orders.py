@@ -0,0 +1,144 @@
+import json
+import os
+import time
+
+
+_SPACE = ' \t\n\r'
+
+_MISSING = object() # our user is not in the broadcast at all
+
+
+def _json_backend(name=None):
+    # fastest installed decoder, or the one named in JSON_BACKEND
+    name = name or os.getenv('JSON_BACKEND')
+    for candidate in ([name] if name else ['orjson', 'ujson', 'json']):
+        try:
+            return __import__(candidate).loads
+        except ImportError:
+            continue
+    return json.loads
+
+
+class OrdersFilter(object):
+    """ Pulls this device's state out of update_orders broadcasts.
+
+    The coordinator sends the state of every picker in each broadcast; we
+    only need one entry. Instead of decoding the whole frame, the user's key
+    is located with a substring search and only its value is decoded. Frames
+    that do not change our state return None, so update_orders_cb only sees
+    real transitions.
+    """
+
+    def __init__(self, user_name, backend=None):
+        self.user_name = user_name
+        self.loads = _json_backend(backend)
+        self._decoder = json.JSONDecoder()
+        self._key = json.dumps(user_name)
+        # a name the coordinator might escape differently is never scanned for
+        self._scan = self._key == '"%s"' % user_name and '\\' not in user_name
+        self.last_state = None
+        self.frames = 0
+        self.skipped = 0
+        # update_orders broadcasts in a row without us: a coordinator that
+        # restarted has forgotten us
+        self.missing = 0
+
+    def invalidate(self):
+        # our state was changed locally, pass the next broadcast through
+        self.last_state = None
+
+    def reset(self):
+        # a new connection
+        self.invalidate()
+        self.missing = 0
+
+    def feed(self, raw):
+        # -> new state for this user, or None
+        self.frames += 1
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        if '"update_orders"' not in raw:
+            return None
+
+        state = self._scanState(raw) if self._scan else self._parseState(raw)
+        if state is _MISSING:
+            self.missing += 1
+            self.skipped += 1
+            return None
+        self.missing = 0
+        if state is None or state == self.last_state:
+            self.skipped += 1
+            return None
+        self.last_state = state
+        return state
+
+    def _scanState(self, raw):
+        # the key is only searched for inside the states object, which
+        # holds plain strings: it ends at the first '}'. Anything that does
+        # not look like that (a nested object, our key after the end, where
+        # a '}' in a string would have cut it short) is decoded in full.
+        states = raw.find('"states"')
+        start = raw.find('{', states) if states >= 0 else -1
+        close = raw.find('}', start) if start >= 0 else -1
+        if (close < 0 or raw[states + 8:start].strip() != ':'
+                or raw.find('{', start + 1, close) >= 0):
+            return self._parseState(raw)
+
+        key = self._key
+        end = len(raw)
+        pos = raw.find(key, start, close)
+        while pos >= 0:
+            # only a key of the states object counts, not a value elsewhere
+            before = pos - 1
+            while before >= 0 and raw[before] in _SPACE:
+                before -= 1
+            after = pos + len(key)
+            while after < end and raw[after] in _SPACE:
+                after += 1
+            if before >= 0 and raw[before] in '{,' and after < end and raw[after] == ':':
+                after += 1
+                while after < end and raw[after] in _SPACE:
+                    after += 1
+                return self._decoder.raw_decode(raw, after)[0]
+            pos = raw.find(key, pos + 1, close)
+        if raw.find(key, close) >= 0:
+            return self._parseState(raw)
+        return _MISSING
+
+    def _parseState(self, raw):
+        msg = self.loads(raw)
+        if msg.get('method') != 'update_orders':
+            return None
+        return msg.get('states', {}).get(self.user_name, _MISSING)
+
+
+def _broadcast(pickers, user_name):
+    states = {'picker_%04d' % i: 'car_INIT' for i in range(pickers)}
+    states[user_name] = 'car_ACCEPT'
+    return json.dumps({'method': 'update_orders', 'states': states})
+
+
+if __name__ == "__main__":
+    # benchmark: frames/s for the full decode the client used to do and for
+    # the scan, with this user somewhere in the middle of the states
+    user = 'picker02-device1'
+    for pickers in (10, 100, 1000):
+        raw = _broadcast(pickers, user)
+        n = max(200, 200000 // pickers)
+
+        t = time.perf_counter()
+        for _ in range(n):
+            msg = json.loads(raw)
+            if msg['method'] == 'update_orders' and user in msg['states']:
+                msg['states'][user]
+        full = n / (time.perf_counter() - t)
+
+        f = OrdersFilter(user)
+        t = time.perf_counter()
+        for _ in range(n):
+            f.invalidate()
+            f.feed(raw)
+        scan = n / (time.perf_counter() - t)
+
+        print("%5d pickers, %7d bytes: json.loads %9.0f frames/s, scan %9.0f frames/s (x%.1f)"
+              % (pickers, len(raw), full, scan, scan / full))
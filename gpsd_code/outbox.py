@@ -0,0 +1,155 @@
+import collections
+import json
+import os
+import random
+import threading
+import time
+
+import log
+
+logger = log.get("outbox")
+
+
+CONTROL = 0
+LOCATION = 1
+
+
+def backoff_delay(attempt, base=1., cap=60.):
+    # full jitter exponential backoff: uniform in [0, min(cap, base * 2^n)]
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def default_journal_path():
+    return os.getenv('WS_JOURNAL',
+                     os.path.join(os.path.expanduser('~'), '.cache', 'smart_picker', 'ws_journal.jsonl'))
+
+
+class Journal(object):
+    """ Control messages not yet delivered, kept on disk so a restart does
+    not lose a call or a cancel. The file is tiny: it is rewritten with the
+    messages still pending whenever one is delivered.
+    """
+
+    def __init__(self, path=None, max_age=600.):
+        self.path = path or default_journal_path()
+        self.max_age = max_age
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def load(self):
+        # pending messages from a previous run, minus the ones too old to act on
+        entries = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # torn last line after a power cut
+                    if time.time() - entry['ts'] <= self.max_age:
+                        entries.append(entry)
+        except (IOError, OSError):
+            pass
+        return entries
+
+    def write(self, entries):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+
+class Outbox(object):
+    """ Bounded outbound queue for the coordinator link.
+
+    Control messages (call/cancel/set_state) always go before location
+    updates, are journaled and are never dropped: there are only ever a
+    few, one per button press, and the journal ages them out on restart.
+    Location frames that can be merged (single
+    location_update) replace the one still waiting; batches are kept, up to
+    max_locations, oldest dropped first.
+    """
+
+    def __init__(self, journal=None, max_locations=16):
+        self.journal = journal
+        self.max_locations = max_locations
+        self._control = collections.deque()
+        self._locations = collections.deque()
+        self._cond = threading.Condition()
+        self._journal_lock = threading.Lock() # one write at a time, in order
+        self.dropped = 0
+
+        if journal is not None:
+            for entry in journal.load():
+                self._control.append(entry)
+            if self._control:
+                logger.info("replaying %d journaled messages", len(self._control))
+
+    def put_control(self, frame):
+        with self._cond:
+            self._control.append({'ts': time.time(), 'frame': frame})
+            self._cond.notify()
+        self._sync()
+
+    def put_location(self, frame, mergeable=True):
+        with self._cond:
+            if mergeable and self._locations and self._locations[-1][0]:
+                self._locations[-1] = (True, frame) # stale position, replace it
+                self.dropped += 1
+            else:
+                if len(self._locations) >= self.max_locations:
+                    self._locations.popleft()
+                    self.dropped += 1
+                self._locations.append((mergeable, frame))
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        # -> (kind, frame) or None on timeout; the item stays owned by the
+        # caller until done() or requeue()
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._control or self._locations, timeout):
+                return None
+            if self._control:
+                return CONTROL, self._control[0]
+            return LOCATION, self._locations.popleft()
+
+    def done(self, item):
+        kind, entry = item
+        if kind == CONTROL:
+            with self._cond:
+                if not (self._control and self._control[0] is entry):
+                    return
+                self._control.popleft()
+            self._sync()
+
+    def requeue(self, item):
+        kind, entry = item
+        if kind == LOCATION:
+            with self._cond:
+                self._locations.appendleft(entry)
+        # control messages are only removed by done()
+
+    def depth(self):
+        return len(self._control) + len(self._locations)
+
+    def _sync(self):
+        # called without _cond, a slow SD card must not hold up the queue;
+        # the copy is taken under the journal lock so writes land in order
+        if self.journal is None:
+            return
+        with self._journal_lock:
+            with self._cond:
+                entries = list(self._control)
+            try:
+                self.journal.write(entries)
+            except (IOError, OSError) as e:
+                logger.error("cannot write websocket journal: %s", e)
+
+    @staticmethod
+    def frame(item):
+        kind, entry = item
+        return entry['frame'] if kind == CONTROL else entry[1]
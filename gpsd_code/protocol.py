@@ -0,0 +1,137 @@
+import json
+
+# message shapes understood by the coordinator, shared by every client
+
+
+def call(user_name):
+    return json.dumps({'method':'call', 'user': user_name})
+
+
+def cancel(user_name):
+    return json.dumps({'method':'cancel', 'user': user_name})
+
+
+def set_state(user_name, state):
+    return json.dumps({'method':'set_state', 'user': user_name, 'state': state})
+
+
+def location_update(user_name, fix, row='3'):
+    return json.dumps(
+        {
+            'method':'location_update', 
+            'row':row, 
+            'user': user_name, 
+            'latitude':fix.lat, 
+            'longitude':fix.lon, 
+            'accuracy':fix.accuracy, # Fix.accuracy, as in the batches
+            'rcv_time':fix.ts
+        }
+    )
+
+
+def metrics(user_name, summary):
+    # periodic health summary, see metrics.Summary
+    return json.dumps({'method':'metrics', 'user': user_name, 'metrics': summary},
+                      separators=(',', ':'))
+
+
+def registration(user_name):
+    # form data of the registration POST to SITE_ADDRESS
+    return {'username': user_name}
+
+
+# batched location updates: one frame carries several fixes, coordinates
+# and times are sent as integer deltas from the previous fix
+#   lat/lon in 1e-7 degrees, time in ms, accuracy in dm (-1 unknown)
+LAT_SCALE = 10000000
+BATCH_MAGIC = b"LB\x01"
+
+
+def _deltas(fixes):
+    prev_lat = prev_lon = prev_t = 0
+    for fix in fixes:
+        lat = int(round(fix.lat * LAT_SCALE))
+        lon = int(round(fix.lon * LAT_SCALE))
+        t = int(round(fix.ts * 1000))
+        acc = fix.accuracy
+        yield t - prev_t, lat - prev_lat, lon - prev_lon, int(round(acc * 10)) if acc >= 0 else -1
+        prev_lat, prev_lon, prev_t = lat, lon, t
+
+
+def location_batch(user_name, fixes, row='3'):
+    return json.dumps(
+        {
+            'method':'location_batch',
+            'row':row,
+            'user': user_name,
+            'scale':LAT_SCALE,
+            'd':[list(d) for d in _deltas(fixes)]
+        },
+        separators=(',', ':')
+    )
+
+
+def _varint(out, value):
+    # zigzag + LEB128, small deltas take one or two bytes
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def location_batch_binary(user_name, fixes, row='3'):
+    out = bytearray(BATCH_MAGIC)
+    for s in (user_name.encode(), str(row).encode()):
+        out.append(len(s))
+        out += s
+    _varint(out, len(fixes))
+    for d in _deltas(fixes):
+        for v in d:
+            _varint(out, v)
+    return bytes(out)
+
+
+def _read_varint(buf, pos):
+    shift = value = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return (value >> 1) ^ -(value & 1), pos
+
+
+def decode_location_batch(frame):
+    # either batch form -> (user, row, [(lat, lon, accuracy, ts), ...])
+    if isinstance(frame, (bytes, bytearray)):
+        if frame[:3] != BATCH_MAGIC:
+            raise ValueError("not a location batch")
+        pos = 3
+        fields = []
+        for _ in range(2):
+            n = frame[pos]
+            fields.append(frame[pos + 1:pos + 1 + n].decode())
+            pos += 1 + n
+        user_name, row = fields
+        count, pos = _read_varint(frame, pos)
+        deltas = []
+        for _ in range(count):
+            d = []
+            for _ in range(4):
+                v, pos = _read_varint(frame, pos)
+                d.append(v)
+            deltas.append(d)
+    else:
+        msg = json.loads(frame)
+        user_name, row, deltas = msg['user'], msg['row'], msg['d']
+
+    fixes = []
+    lat = lon = t = 0
+    for dt, dlat, dlon, acc in deltas:
+        t += dt
+        lat += dlat
+        lon += dlon
+        fixes.append((lat / LAT_SCALE, lon / LAT_SCALE, acc / 10. if acc >= 0 else -1, t / 1000.))
+    return user_name, row, fixes
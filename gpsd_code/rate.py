@@ -0,0 +1,75 @@
+import math
+import os
+import time
+
+from fix import HAS_SPEED
+from robotStateCode import uplink_states
+
+
+EARTH_RADIUS = 6371000. # m
+
+# robot states in which the coordinator is steering a robot to this picker
+FAST_STATES = uplink_states('fast')
+# states in which nothing depends on our position
+HEARTBEAT_STATES = uplink_states('heartbeat')
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # equirectangular approximation, plenty for a few hundred metres
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.hypot(x, y)
+
+
+class AdaptiveRate(object):
+    """ Decides which fixes are worth sending to the coordinator.
+
+    - in FAST_STATES every fix is sent, up to max_rate Hz
+    - in HEARTBEAT_STATES one fix every `heartbeat` seconds
+    - otherwise a fix is sent once the picker moved `min_distance` metres
+      or is walking faster than `min_speed` m/s, and at least every
+      `heartbeat` seconds while standing still
+    A change of robot state or row always lets the next fix through.
+    """
+
+    def __init__(self, max_rate=None, heartbeat=None, min_distance=None, min_speed=None, adaptive=None):
+        self.max_rate = float(max_rate or os.getenv('GPS_MAX_RATE', 2))
+        self.heartbeat = float(heartbeat or os.getenv('GPS_HEARTBEAT', 30))
+        self.min_distance = float(min_distance or os.getenv('GPS_MIN_DISTANCE', 3))
+        self.min_speed = float(min_speed or os.getenv('GPS_MIN_SPEED', 0.5))
+        if adaptive is None:
+            adaptive = os.getenv('GPS_ADAPTIVE', 'true').lower() not in ('0', 'false', 'no')
+        self.adaptive = adaptive
+
+        self._last = None # (lat, lon, time) of the last fix sent
+        self._state = None
+        self._row = None
+
+    def should_send(self, fix, state=None, now=None, row=None):
+        now = now or time.time()
+        if self._last is not None and now - self._last[2] < 1. / self.max_rate:
+            return False
+
+        if self._send(fix, state, now, row):
+            self._last = (fix.lat, fix.lon, now)
+            self._state = state
+            self._row = row
+            return True
+        return False
+
+    def _send(self, fix, state, now, row):
+        if not self.adaptive or self._last is None or state != self._state or row != self._row:
+            return True
+
+        if state in FAST_STATES:
+            return True
+
+        since = now - self._last[2]
+        if since >= self.heartbeat:
+            return True
+        if state in HEARTBEAT_STATES:
+            return False
+
+        if fix.has(HAS_SPEED) and fix.speed >= self.min_speed:
+            return True
+        return distance(self._last[0], self._last[1], fix.lat, fix.lon) >= self.min_distance
@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+import time
+
+import log
+import protocol
+
+logger = log.get("registration")
+from outbox import backoff_delay
+
+
+def default_cache_path():
+    return os.getenv('REGISTRATION_CACHE',
+                     os.path.join(os.path.expanduser('~'), '.cache', 'smart_picker', 'registration.json'))
+
+
+class Registrar(object):
+    """ Registers the picker with SITE_ADDRESS once, off the receive path.
+
+    Uses one keep-alive requests.Session with bounded timeouts and retries,
+    and remembers the last successful registration (user, server, time) on
+    disk, so a restart within `max_age` seconds does not register again.
+    The cache can outlive the coordinator's memory of us (it restarted),
+    see check().
+    """
+
+    def __init__(self, user_name, site_address=None, cache_path=None, max_age=None, timeout=(5., 10.),
+                 retry_interval=None, missing_frames=None):
+        self.user_name = user_name
+        self.site_address = site_address or os.getenv('SITE_ADDRESS')
+        self.cache_path = cache_path or default_cache_path()
+        self.max_age = float(max_age or os.getenv('REGISTRATION_MAX_AGE', 12 * 3600))
+        self.timeout = timeout # (connect, read) seconds
+        # update_orders broadcasts in a row without our user before
+        # registering again, and the least seconds between two of those
+        self.missing_frames = int(missing_frames or os.getenv('REGISTRATION_MISSING', 3))
+        self.retry_interval = float(retry_interval or os.getenv('REGISTRATION_RETRY', 60))
+        self.registered = threading.Event()
+        self._session = None
+        self._retried_at = 0.
+
+    def _getSession(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(total=3, backoff_factor=0.5, allowed_methods=None,
+                          status_forcelist=(500, 502, 503, 504))
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=1)
+            self._session = requests.Session()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def cached(self):
+        try:
+            with open(self.cache_path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        return (entry.get('user') == self.user_name
+                and entry.get('server') == self.site_address
+                and time.time() - entry.get('time', 0) < self.max_age)
+
+    def _store(self):
+        directory = os.path.dirname(self.cache_path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = self.cache_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'user': self.user_name, 'server': self.site_address, 'time': time.time()}, f)
+            os.rename(tmp, self.cache_path)
+        except (IOError, OSError) as e:
+            logger.error("cannot write registration cache: %s", e)
+
+    def forget(self):
+        # the coordinator does not know us after all, register on next ensure()
+        self.registered.clear()
+        try:
+            os.remove(self.cache_path)
+        except OSError:
+            pass
+
+    def check(self, orders, now=None):
+        # True when the coordinator shows it does not know us: broadcasts
+        # arrive but `missing_frames` of them in a row leave our user out (a
+        # quiet link proves nothing). The cached registration is forgotten
+        # then; the caller runs ensure() again. At most once per
+        # `retry_interval` seconds.
+        now = now or time.time()
+        if orders.missing < self.missing_frames or now - self._retried_at < self.retry_interval:
+            return False
+        self._retried_at = now
+        orders.missing = 0
+        logger.warning("coordinator does not know %s, registering again", self.user_name)
+        self.forget()
+        return True
+
+    def register(self):
+        try:
+            res = self._getSession().post(self.site_address,
+                                          data=protocol.registration(self.user_name),
+                                          timeout=self.timeout)
+        except Exception as e:
+            logger.warning("registration failed: %s", e)
+            return False
+        if not res.ok:
+            logger.warning("registration refused, response: %s", res)
+            return False
+        logger.info("registered, response: %s", res)
+        self._store()
+        self.registered.set()
+        return True
+
+    def ensure(self, stop_event=None):
+        # blocks until registered (or stop_event is set)
+        if self.registered.is_set():
+            return True
+        if self.cached():
+            logger.info("registration cached for %s", self.user_name)
+            self.registered.set()
+            return True
+
+        stop_event = stop_event or threading.Event()
+        attempt = 0
+        while not stop_event.is_set():
+            if self.register():
+                return True
+            stop_event.wait(backoff_delay(attempt, base=2., cap=120.))
+            attempt += 1
+        return False
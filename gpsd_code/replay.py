@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+
+# Off-device replay: a pty standing in for the SIM7600 (or a fake gpsd), a
+# local websocket coordinator and registration endpoint, and MainApp running
+# headless in between. Reports fix-to-uplink latency and throughput.
+#
+#   python replay.py --speed 10 --fixes 600
+#   python replay.py --file drive.nmea --source gpsd --mode binary
+
+import argparse
+import collections
+import json
+import os
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import tty
+
+import nmea
+import protocol
+
+
+def synthetic(n, lat=53.2680, lon=-0.5240, step=0.00001):
+    # +CGPSINFO lines of a picker walking north, one per second
+    lines = []
+    t0 = 1605607810 # 17/11/2020 10:10:10
+    for i in range(n):
+        la = lat + i * step
+        t = time.gmtime(t0 + i)
+        lines.append(("+CGPSINFO: %02d%09.6f,N,%03d%09.6f,%s,%s,%s.0,25.0,1.1,0.0" % (
+            int(la), (la % 1) * 60, int(abs(lon)), (abs(lon) % 1) * 60, 'W' if lon < 0 else 'E',
+            time.strftime("%d%m%y", t), time.strftime("%H%M%S", t))).encode())
+    return lines
+
+
+def load(path):
+    # a capture of the modem port: +CGPSINFO reports and/or NMEA sentences
+    with open(path, 'rb') as f:
+        return [l.strip() for l in f if l.strip()]
+
+
+def epochs(lines):
+    # group lines into what the receiver sends per report: every +CGPSINFO
+    # on its own, NMEA sentences by the time in their RMC/GGA
+    out, current, hms = [], [], None
+    for line in lines:
+        if line.startswith(b"+CGPSINFO"):
+            new = True
+        elif line[3:6] in (b"RMC", b"GGA"):
+            t = line.split(b",")[1]
+            new, hms = t != hms, t
+        else:
+            new = False
+        if new and current:
+            out.append(b"".join(l + b"\r\n" for l in current))
+            current = []
+        current.append(line)
+    if current:
+        out.append(b"".join(l + b"\r\n" for l in current))
+    return out
+
+
+def _key(lat):
+    return int(round(lat * 1e6))
+
+
+class Latency(object):
+    """ Matches fixes leaving the simulated receiver to their arrival at the
+    coordinator by latitude. """
+
+    def __init__(self):
+        self._sent = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.received = 0
+        self.unmatched = 0
+        self.samples = []
+        self.first = self.last = None
+
+    def fix_sent(self, lats, now):
+        with self._lock:
+            for lat in lats:
+                self._sent[_key(lat)].append(now)
+                self.sent += 1
+
+    def fix_received(self, lat, now):
+        with self._lock:
+            queue = self._sent.get(_key(lat))
+            if not queue:
+                self.unmatched += 1
+                return
+            self.samples.append(now - queue.popleft())
+            self.received += 1
+            self.first = self.first or now
+            self.last = now
+
+    def report(self):
+        s = sorted(self.samples)
+        pct = lambda p: round(s[min(len(s) - 1, int(p / 100. * len(s)))] * 1000, 2) if s else None
+        span = (self.last - self.first) if self.received > 1 else 0
+        return {
+            'fixes_sent': self.sent, 'fixes_received': self.received, 'unmatched': self.unmatched,
+            'latency_ms': {'p50': pct(50), 'p90': pct(90), 'p99': pct(99), 'max': pct(100)},
+            'throughput_fixes_s': round((self.received - 1) / span, 2) if span else None,
+        }
+
+
+def _expected(chunks):
+    # latitudes the app's parser will emit after each chunk
+    parser = nmea.FixParser()
+    return [[f.lat for f in parser.feed(c) if f.valid] for c in chunks]
+
+
+# what PtyModem answers before OK, anything else just gets OK
+RESPONSES = {
+    b"AT+CSQ": b"+CSQ: 23,99",
+    b"AT+CREG?": b"+CREG: 0,1",
+    b"AT+CGREG?": b"+CGREG: 0,1",
+    b"AT+COPS?": b'+COPS: 0,0,"EE",7',
+    b"AT+CGPS?": b"+CGPS: 1,1",
+}
+
+
+class PtyModem(threading.Thread):
+    """ A pseudo terminal that answers AT commands like the SIM7600 and,
+    once AT+CGPSINFO=n arrives, writes one recorded epoch every
+    `interval / speed` seconds. """
+
+    def __init__(self, chunks, speed=1., interval=1., latency=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.chunks = chunks
+        self.lats = _expected(chunks)
+        self.period = interval / speed
+        self.latency = latency or Latency()
+        self.done = threading.Event()
+        self.stop_event = threading.Event()
+
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.commands = []
+
+    def _command(self, line):
+        self.commands.append(line)
+        if line.startswith(b"AT+CGPSINFO="):
+            self.streaming = int(line[12:] or 0) > 0
+        answer = RESPONSES.get(line)
+        os.write(self.master, line + b"\r\r\n" + (b"" if answer is None else answer + b"\r\n") + b"\r\nOK\r\n")
+
+    def run(self):
+        self.streaming = False
+        buf = b""
+        i, start = 0, None
+        while not self.stop_event.is_set():
+            timeout = 0.1
+            if self.streaming:
+                start = start or time.time()
+                timeout = max(0, start + i * self.period - time.time())
+            r, _, _ = select.select([self.master], [], [], min(timeout, 0.1))
+            if r:
+                try:
+                    buf += os.read(self.master, 1024)
+                except OSError:
+                    break
+                while b"\r" in buf:
+                    line, buf = buf.split(b"\r", 1)
+                    buf = buf.lstrip(b"\n")
+                    if line.strip():
+                        self._command(line.strip())
+            if self.streaming:
+                start = start or time.time()
+            if self.streaming and time.time() >= start + i * self.period:
+                if i >= len(self.chunks):
+                    self.done.set()
+                    continue
+                # noted first, the fix can reach the coordinator before
+                # this thread runs again
+                self.latency.fix_sent(self.lats[i], time.time())
+                os.write(self.master, self.chunks[i])
+                i += 1
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class FakeGpsd(threading.Thread):
+    """ Enough of gpsd's JSON protocol for _gpsd_service / gps_async: a
+    WATCH request gets a TPV report per recorded fix, paced like PtyModem. """
+
+    def __init__(self, chunks, speed=1., interval=1., latency=None, host='127.0.0.1', port=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        parser = nmea.FixParser()
+        self.fixes = [[f for f in parser.feed(c) if f.valid] for c in chunks]
+        self.period = interval / speed
+        self.latency = latency or Latency()
+        self.done = threading.Event()
+        self.stop_event = threading.Event()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1)
+        self.host, self.port = self.sock.getsockname()
+
+    def _tpv(self, fix):
+        utc = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(fix.utc)) + ".000Z"
+        return {'class': 'TPV', 'device': '/dev/ttyUSB1', 'mode': 3, 'time': utc,
+                'lat': fix.lat, 'lon': fix.lon, 'alt': fix.alt, 'speed': fix.speed,
+                'track': fix.course, 'epx': 3.5, 'epy': 4.2}
+
+    def run(self):
+        self.sock.settimeout(0.5)
+        while not self.stop_event.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                self._serve(conn)
+
+    def _serve(self, conn):
+        send = lambda obj: conn.sendall((json.dumps(obj) + "\n").encode())
+        send({'class': 'VERSION', 'release': '3.22', 'proto_major': 3, 'proto_minor': 14})
+        conn.settimeout(5.)
+        request = conn.recv(1024)
+        if b"?WATCH" not in request:
+            return
+        send({'class': 'DEVICES', 'devices': [{'class': 'DEVICE', 'path': '/dev/ttyUSB1'}]})
+        send({'class': 'WATCH', 'enable': True, 'json': True})
+        start = time.time()
+        try:
+            for i, fixes in enumerate(self.fixes):
+                delay = start + i * self.period - time.time()
+                if self.stop_event.wait(max(0, delay)):
+                    return
+                for fix in fixes:
+                    self.latency.fix_sent([fix.lat], time.time())
+                    send(self._tpv(fix))
+        except OSError:
+            return
+        self.done.set()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+# coordinator reactions: what it answers, and after how many (replay) seconds
+REACTIONS = {
+    'call': [(1., 'car_ACCEPT'), (3., 'car_ARRIVED')],
+    'cancel': [(0.5, 'car_CANCEL')],
+    'car_LOADED': [(1., 'car_COMPLETE')],
+}
+SCRIPT = [(0.2, 'CONNECTED'), (0.5, 'REGISTERED')]
+
+
+class FakeCoordinator(threading.Thread):
+    """ Local websocket coordinator. Sends `script` as update_orders
+    broadcasts (with `pickers` other pickers in them), reacts to call /
+    cancel / set_state like REACTIONS says and feeds every location it
+    receives to `latency`. """
+
+    def __init__(self, user_name, latency=None, script=SCRIPT, reactions=REACTIONS,
+                 pickers=100, speed=1., compression='deflate'):
+        from websockets.sync.server import serve
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.user_name = user_name
+        self.latency = latency or Latency()
+        self.script = script
+        self.reactions = reactions
+        self.speed = speed
+        self.states = {'picker_%04d' % i: 'car_INIT' for i in range(pickers)}
+        self.received = collections.Counter()
+        self.bytes = 0
+        self.connections = 0
+        self._server = serve(self._handler, '127.0.0.1', 0, compression=compression)
+        self.port = self._server.socket.getsockname()[1]
+        self.address = 'ws://127.0.0.1:%d' % self.port
+
+    def run(self):
+        self._server.serve_forever()
+
+    def _broadcast(self, conn, state):
+        self.states[self.user_name] = state
+        try:
+            conn.send(json.dumps({'method': 'update_orders', 'states': self.states}))
+        except Exception:
+            pass
+
+    def _later(self, conn, delay, state):
+        timer = threading.Timer(delay / self.speed, self._broadcast, (conn, state))
+        timer.daemon = True
+        timer.start()
+
+    def _handler(self, conn):
+        self.connections += 1
+        for delay, state in self.script:
+            self._later(conn, delay, state)
+        for message in conn:
+            now = time.time()
+            self.bytes += len(message)
+            if isinstance(message, bytes):
+                self.received['location_batch_binary'] += 1
+                for lat, _, _, _ in protocol.decode_location_batch(message)[2]:
+                    self.latency.fix_received(lat, now)
+                continue
+            msg = json.loads(message)
+            method = msg.get('method')
+            self.received[method] += 1
+            if method == 'location_update':
+                self.latency.fix_received(msg['latitude'], now)
+            elif method == 'location_batch':
+                for lat, _, _, _ in protocol.decode_location_batch(message)[2]:
+                    self.latency.fix_received(lat, now)
+            for delay, state in self.reactions.get(msg.get('state') or method, ()):
+                self._later(conn, delay, state)
+
+    def stop(self):
+        self._server.shutdown()
+
+
+class RegistrationServer(threading.Thread):
+    """ Accepts the registration POST to SITE_ADDRESS, keeps the bodies in `posts`. """
+
+    def __init__(self):
+        try:
+            from http.server import ThreadingHTTPServer as HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+
+        posts = self.posts = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                posts.append(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.address = 'http://127.0.0.1:%d/register' % self._server.server_address[1]
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+
+
+def run(lines, source='serial', speed=10., mode=None, pickers=100, rate=None, grace=None):
+    # replay `lines` through MainApp, headless, and return the report
+    workdir = tempfile.mkdtemp(prefix='replay-')
+    user_name = 'replay-picker'
+    env = {
+        'DISPLAY_BACKEND': 'headless', 'USERNAME': user_name,
+        'REGISTRATION_CACHE': os.path.join(workdir, 'registration.json'),
+        'WS_JOURNAL': os.path.join(workdir, 'journal'),
+        'TRACK_DIR': os.path.join(workdir, 'track'),
+    }
+    if mode:
+        env['UPLINK_MODE'] = mode
+    os.environ.update(env)
+    # every fix counts for the measurement, not only the ones the picker's
+    # motion would send; the caller's environment still wins
+    os.environ.setdefault('GPS_ADAPTIVE', 'false')
+    # latitudes are how sent and received fixes are matched, keep them raw
+    os.environ.setdefault('GPS_FILTER', 'false')
+
+    latency = Latency()
+    chunks = epochs(lines)
+    coordinator = FakeCoordinator(user_name, latency, pickers=pickers, speed=speed)
+    registration = RegistrationServer()
+    coordinator.start()
+    registration.start()
+    os.environ['WS_ADDRESS'] = coordinator.address
+    os.environ['SITE_ADDRESS'] = registration.address
+
+    import main
+    if source == 'gpsd':
+        import _gpsd_service
+        receiver = FakeGpsd(chunks, speed, latency=latency)
+        receiver.start()
+        gps = _gpsd_service.GPS(host=receiver.host, port=receiver.port)
+    else:
+        receiver = PtyModem(chunks, speed, latency=latency)
+        receiver.start()
+        os.environ['MODEM_SERIAL_PORT'] = receiver.port
+        gps = None
+        if source == 'serial':
+            import _gpsd_serial
+            gps = _gpsd_serial.GPS()
+        else:
+            # MainApp's own source selection, through sources.FailoverGPS
+            os.environ.setdefault('GPS_SOURCES', 'at')
+
+    app = main.MainApp(rate if rate is not None else 2 * speed, gps=gps)
+    runner = threading.Thread(target=app.start)
+    runner.daemon = True
+    started = time.time()
+    runner.start()
+    try:
+        # bounded, in case the app never asks for reports
+        receiver.done.wait(len(chunks) * receiver.period + 30.)
+        # let the uplink drain, batches wait for their window to close
+        time.sleep(grace if grace is not None else 1. + float(os.getenv('UPLINK_WINDOW', 5)) * (mode in ('json', 'binary')))
+    finally:
+        app.stop()
+        app._gui.quit()
+        runner.join(5.)
+        receiver.stop()
+        coordinator.stop()
+        registration.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = latency.report()
+    report.update({
+        'source': source, 'speed': speed, 'uplink_mode': app._ws.uplink.mode,
+        'elapsed_s': round(time.time() - started, 2),
+        'coordinator': {'messages': dict(coordinator.received), 'bytes': coordinator.bytes,
+                        'connections': coordinator.connections},
+        'robot_state': app.rs.state,
+    })
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a GNSS stream through MainApp, headless")
+    parser.add_argument('--file', help="recorded +CGPSINFO/NMEA stream, a synthetic walk if omitted")
+    parser.add_argument('--fixes', type=int, default=300, help="length of the synthetic walk")
+    parser.add_argument('--source', choices=('serial', 'gpsd', 'failover'), default='serial',
+                        help="failover: the modem port through GPS_SOURCES (at) and sources.FailoverGPS")
+    parser.add_argument('--speed', type=float, default=10., help="replay at N x real time")
+    parser.add_argument('--mode', choices=('compat', 'json', 'binary'), help="UPLINK_MODE")
+    parser.add_argument('--pickers', type=int, default=100, help="other pickers in update_orders")
+    parser.add_argument('--rate', type=float, help="publish rate cap, 2 x speed by default")
+    args = parser.parse_args()
+
+    lines = load(args.file) if args.file else synthetic(args.fixes)
+    print(json.dumps(run(lines, args.source, args.speed, args.mode, args.pickers, args.rate), indent=2))
@@ -1,41 +1,175 @@
-from transitions import Machine
+import time
 
-class RobotState(object):
 
-    # Define states. 
-    states = ['car_INIT', 'car_CALLED', 'car_ACCEPTED', 'car_ARRIVED', 'car_LOADED']
+# What the picker sees: (text, (red, green, blue) LEDs, LED to blink).
+# None leaves the text or LEDs as they are; showing a view stops any
+# blinking it does not ask for itself.
+VIEWS = {
+    'connected':  ("Connected to Server.", (True, True, True), None),
+    'ready':      ("Ready to Call", (False, True, False), None),
+    'requested':  ("Request has been sent.", (True, False, False), None),
+    'on_the_way': ("A Robot is on the way", (True, False, False), None),
+    'arrived':    ("Load trays on robot then press BLUE button.", (True, False, True), 'b'),
+    'complete':   (None, None, None),
+    'cancelled':  ("Task Has Been Cancelled. \nClick any to Reset", (True, False, False), None),
+    'cancelling': ("Cancelling...", (False, False, False), None),
+    'loaded':     ("Thank you the robot will now drive away.", (False, False, False), None),
+    'continue':   ("Press GREEN to continue.", (False, True, False), None),
+}
+
+# state: (view shown when the coordinator puts us there, uplink)
+# uplink is how rate.AdaptiveRate treats gps fixes in that state:
+# 'fast' every fix, 'heartbeat' one now and then, 'adaptive' on movement
+STATES = {
+    'INIT':         (None, 'adaptive'),
+    'CONNECTED':    ('connected', 'heartbeat'),
+    'REGISTERED':   ('ready', 'heartbeat'),
+    'car_INIT':     ('ready', 'heartbeat'),
+    'car_CALLED':   ('requested', 'adaptive'),
+    'car_ACCEPT':   ('on_the_way', 'fast'),
+    'car_ARRIVED':  ('arrived', 'fast'),
+    'car_LOADED':   (None, 'heartbeat'),
+    'car_COMPLETE': ('complete', 'heartbeat'),
+    'car_CANCEL':   ('cancelled', 'heartbeat'),
+}
+
+# (state, button): (next state, WS method to call, view, view shown 2 s later)
+BUTTONS = {
+    ('REGISTERED', 'green'):   ('car_CALLED', 'call_robot', 'requested', None),
+    ('car_INIT', 'green'):     ('car_CALLED', 'call_robot', 'requested', None),
+    ('car_COMPLETE', 'green'): ('car_INIT', None, 'ready', None),
+    ('car_CANCEL', 'green'):   ('car_INIT', None, 'ready', None),
+    ('car_CALLED', 'red'):     ('car_CANCEL', 'cancel_robot', 'cancelling', 'continue'),
+    ('car_ACCEPT', 'red'):     ('car_CANCEL', 'cancel_robot', 'cancelling', 'continue'),
+    ('car_ARRIVED', 'red'):    ('car_CANCEL', 'cancel_robot', 'cancelling', 'continue'),
+    ('car_ARRIVED', 'blue'):   ('car_LOADED', 'set_loaded', 'loaded', 'continue'),
+}
+
+# shown for a while when a button does nothing in the current state
+REFUSALS = {
+    'green': "Cannot call a robot right now.",
+    'red': "Cannot cancel any robot right now.",
+    'blue': "Cannot load a robot right now.",
+}
+
+
+def uplink_states(uplink):
+    return tuple(s for s, (_, u) in STATES.items() if u == uplink)
+
+
+class Step(object):
+    """ One compiled transition: where we go and what the app has to do. """
+
+    __slots__ = ('dest', 'action', 'view', 'then', 'events')
+
+    def __init__(self, dest, action=None, view=None, then=None):
+        self.dest = dest
+        self.action = action
+        self.view = VIEWS[view] if view else None
+        self.then = VIEWS[then] if then else None
+        # dest's row of TABLE, linked by _compile() so fire() needs one lookup
+        self.events = None
+
+    def __repr__(self):
+        return "Step(%s, %s)" % (self.dest, self.action)
+
+
+def _compile():
+    # state -> {event -> Step}; the coordinator may put us in any state it
+    # likes, buttons only act where BUTTONS says so
+    server = {s: Step(s, view=view) for s, (view, _) in STATES.items()}
+    table = {s: dict(server) for s in STATES}
+    for (state, button), (dest, action, view, then) in BUTTONS.items():
+        table[state][button] = Step(dest, action, view, then)
+    for row in table.values():
+        for step in row.values():
+            step.events = table[step.dest]
+    return table
+
+
+TABLE = _compile()
+
+
+class RobotState(object):
+    """ The picker's view of its robot task, driven by events: the states
+    the coordinator sends in update_orders, and 'green'/'red'/'blue' button
+    presses. fire() is a couple of dict lookups; the app applies the
+    returned Step (WS call, LEDs, text).
+    """
 
-    def __init__(self):
+    states = list(STATES)
 
-        # Initialize the state machine
-        self.machine = Machine(model=self, states=RobotState.states, initial='INIT')
+    def __init__(self, state='INIT'):
+        self.state = state
+        self._events = TABLE.get(state) or TABLE['INIT']
 
-        # self.machine.add_transition(source='curent_state', trigger='__enter__',      dest='new_state',    after='__exit__')
+    def fire(self, event):
+        # -> Step, or None when a button does nothing in this state
+        step = self._events.get(event)
+        if step is None:
+            if event in REFUSALS:
+                return None
+            # a state we have no table entry for, take it with no effects
+            # (buttons then act as in INIT)
+            step = Step(event)
+            step.events = TABLE['INIT']
+        self.state = step.dest
+        self._events = step.events
+        return step
 
-        # Transitions
-        self.machine.add_transition(source='car_INIT',     trigger='call_robot',     dest='car_CALLED',   after='called_session')
-        self.machine.add_transition(source='car_CALLED',   trigger='accepted_robot', dest='car_ACCEPTED', after='accepted_session')
-        self.machine.add_transition(source='car_ACCEPTED', trigger='robot_arrived',  dest='car_ARRIVED',  after='arrived_session')
-        self.machine.add_transition(source='car_ARRIVED',  trigger='robot_loaded',   dest='car_LOADED',   after='loaded_session')
-        self.machine.add_transition(source='car_LOADED',   trigger='user_reset',     dest='car_COMPLETE', after='reset_session')
 
-        # Cancellation routes
-        self.machine.add_transition(source='car_CALLED',   trigger='cancel_robot',   dest='car_CANCEL',     after='canceled_session')
-        self.machine.add_transition(source='car_ACCEPTED', trigger='cancel_accept',  dest='car_CANCEL',     after='canceled_accept_session')
-        self.machine.add_transition(source='car_ARRIVED',  trigger='cancel_load',    dest='car_CANCEL',     after='canceled_load_session')
+def _legacy(state, event):
+    # the if-chains MainApp used to run, for the benchmark
+    if event in ("green", "red", "blue"):
+        if event == "green":
+            if state in ["REGISTERED", "car_INIT"]:
+                return "car_CALLED"
+            elif state in ["car_COMPLETE", "car_CANCEL"]:
+                return "car_INIT"
+        elif event == "red":
+            if state in ["car_CALLED", "car_ACCEPT", "car_ARRIVED"]:
+                return "car_CANCEL"
+        elif state in ["car_ARRIVED"]:
+            return "car_LOADED"
+        return state
+    if event in ["CONNECTED"]:
+        pass
+    elif event in ["REGISTERED", "car_INIT"]:
+        pass
+    elif event in ["car_ACCEPT"]:
+        pass
+    elif event in ["car_ARRIVED"]:
+        pass
+    elif event in ["car_COMPLETE"]:
+        pass
+    elif event in ["car_CANCEL"]:
+        pass
+    return event
 
-        # Reset route
-        self.machine.add_transition(source='car_COMPLETE', trigger='reset_complete', dest='car_INIT',     after='reset_session')
-        self.machine.add_transition(source='car_CANCEL',   trigger='reset_cancel',   dest='car_INIT',     after='reset_session')
 
+SCRIPTS = [
+    # (events, expected final state)
+    (['CONNECTED', 'REGISTERED', 'green', 'car_ACCEPT', 'car_ARRIVED', 'blue', 'car_COMPLETE', 'green'], 'car_INIT'),
+    (['CONNECTED', 'REGISTERED', 'green', 'car_ACCEPT', 'red', 'green'], 'car_INIT'),
+    (['CONNECTED', 'REGISTERED', 'green', 'red', 'red', 'blue'], 'car_CANCEL'),
+    (['CONNECTED', 'REGISTERED', 'blue', 'red', 'green', 'car_CANCEL', 'green'], 'car_INIT'),
+    (['REGISTERED', 'green', 'car_ACCEPT', 'car_ARRIVED', 'car_CANCEL', 'green', 'green'], 'car_CALLED'),
+]
 
-    def called_session(self):           print("Now in state: " + self.state)
-    def accepted_session(self):         print("Now in state: " + self.state)
-    def arrived_session(self):          print("Now in state: " + self.state)
-    def loaded_session(self):           print("Now in state: " + self.state)
 
-    def canceled_session(self):         print("Now in state: " + self.state)
-    def canceled_accept_session(self):  print("Now in state: " + self.state)
-    def canceled_load_session(self):    print("Now in state: " + self.state)
+if __name__ == "__main__":
+    # time the table against the old if-chains over the scripts
+    # (tests/test_robot_state.py checks that they agree)
+    events = [e for script, _ in SCRIPTS for e in script] * 2000
+    rs = RobotState()
+    t = time.perf_counter()
+    for event in events:
+        rs.fire(event)
+    table = len(events) / (time.perf_counter() - t)
 
-    def reset_session(self):            print("Now in state: " + self.state)
+    state = 'INIT'
+    t = time.perf_counter()
+    for event in events:
+        state = _legacy(state, event)
+    legacy = len(events) / (time.perf_counter() - t)
+    print("table %.0f events/s, if-chains %.0f events/s" % (table, legacy))
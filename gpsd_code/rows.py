@@ -0,0 +1,312 @@
+import json
+import math
+import os
+import time
+
+import metrics
+from rate import EARTH_RADIUS
+
+
+ROW_CHANGES = metrics.counter("row_changes")
+
+
+def _default_row():
+    # what the coordinator was always told before there was a farm map
+    return os.getenv('ROW_DEFAULT', '3')
+
+
+class _Projection(object):
+    # lat/lon to metres east/north of the farm's middle, equirectangular
+    def __init__(self, lat0, lon0):
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.ky = math.radians(1.) * EARTH_RADIUS
+        self.kx = self.ky * math.cos(math.radians(lat0))
+
+    def __call__(self, lat, lon):
+        return (lon - self.lon0) * self.kx, (lat - self.lat0) * self.ky
+
+
+def _strip(points, width):
+    # a row given by its centre line: one rectangle per segment
+    half = width / 2.
+    for (x1, y1), (x2, y2) in zip(points, points[1:]):
+        length = math.hypot(x2 - x1, y2 - y1)
+        if not length:
+            continue
+        nx, ny = -(y2 - y1) / length * half, (x2 - x1) / length * half
+        yield [(x1 + nx, y1 + ny), (x2 + nx, y2 + ny), (x2 - nx, y2 - ny), (x1 - nx, y1 - ny)]
+
+
+def _width(xs, ys):
+    area = perimeter = 0.
+    j = len(xs) - 1
+    for k in range(len(xs)):
+        area += xs[j] * ys[k] - xs[k] * ys[j]
+        perimeter += math.hypot(xs[k] - xs[j], ys[k] - ys[j])
+        j = k
+    return abs(area) / perimeter if perimeter else 0.
+
+
+def _slab(xs, ys, sx0, sx1):
+    # lowest and highest y of the outline between x = sx0 and x = sx1
+    lo, hi = float('inf'), -float('inf')
+    j = len(xs) - 1
+    for k in range(len(xs)):
+        ax, ay, bx, by = xs[j], ys[j], xs[k], ys[k]
+        j = k
+        if max(ax, bx) < sx0 or min(ax, bx) > sx1:
+            continue
+        for x, y in ((ax, ay), (bx, by)):
+            if sx0 <= x <= sx1:
+                lo, hi = min(lo, y), max(hi, y)
+        if ax != bx:
+            for x in (sx0, sx1):
+                t = (x - ax) / (bx - ax)
+                if 0. <= t <= 1.:
+                    y = ay + t * (by - ay)
+                    lo, hi = min(lo, y), max(hi, y)
+    return lo, hi
+
+
+def read_geojson(path, width=None):
+    # -> [(row, [(lat, lon), ...] outline or centre line, width or None)]
+    # Polygon / MultiPolygon outlines (outer rings), or LineString centre
+    # lines with a 'width' property (ROW_WIDTH metres otherwise); the row
+    # name is the 'row' or 'name' property
+    width = float(width or os.getenv('ROW_WIDTH', 1.5))
+    with open(path) as f:
+        doc = json.load(f)
+    rows = []
+    for feature in doc.get('features', [doc]):
+        props = feature.get('properties') or {}
+        name = str(props.get('row', props.get('name', '')))
+        geometry = feature.get('geometry') or {}
+        kind, coords = geometry.get('type'), geometry.get('coordinates')
+        if kind == 'Polygon':
+            rings = [coords[0]]
+        elif kind == 'MultiPolygon':
+            rings = [p[0] for p in coords]
+        elif kind == 'LineString':
+            rows.append((name, [(lat, lon) for lon, lat in coords], float(props.get('width', width))))
+            continue
+        else:
+            continue
+        for ring in rings:
+            rows.append((name, [(lat, lon) for lon, lat in ring], None))
+    return rows
+
+
+class RowIndex(object):
+    """ The farm's rows, for finding the one a fix is in.
+
+    Outlines are projected to metres once and bucketed in a uniform grid
+    about one row wide, so a lookup is a cell computation plus a
+    point-in-polygon test against the few outlines touching that cell,
+    whatever the size of the farm.
+    """
+
+    MAX_CELLS = 1000000
+
+    def __init__(self, rows, cell=None):
+        # rows: [(row, [(lat, lon), ...], width)], see read_geojson
+        points = [p for _, outline, _ in rows for p in outline]
+        if not points:
+            raise ValueError("no rows")
+        lats, lons = [p[0] for p in points], [p[1] for p in points]
+        self.project = _Projection((min(lats) + max(lats)) / 2., (min(lons) + max(lons)) / 2.)
+
+        self.names = []
+        self.polygons = [] # (xs, ys, bbox)
+        for name, outline, width in rows:
+            xy = [self.project(lat, lon) for lat, lon in outline]
+            for polygon in (_strip(xy, width) if width else [xy]):
+                xs, ys = [p[0] for p in polygon], [p[1] for p in polygon]
+                self.names.append(name)
+                self.polygons.append((xs, ys, (min(xs), min(ys), max(xs), max(ys))))
+
+        x0 = min(b[0] for _, _, b in self.polygons)
+        y0 = min(b[1] for _, _, b in self.polygons)
+        x1 = max(b[2] for _, _, b in self.polygons)
+        y1 = max(b[3] for _, _, b in self.polygons)
+        if cell is None:
+            # about the width of a typical row (2 area / perimeter is that
+            # for a long rectangle), within MAX_CELLS
+            widths = sorted(_width(xs, ys) for xs, ys, _ in self.polygons)
+            cell = max(widths[len(widths) // 2], math.sqrt((x1 - x0) * (y1 - y0) / RowIndex.MAX_CELLS), 0.1)
+        self.cell = cell
+        self.origin = (x0, y0)
+        self.nx = int((x1 - x0) / cell) + 1
+        self.ny = int((y1 - y0) / cell) + 1
+
+        # a polygon goes in the cells of each column it spans, between the
+        # lowest and highest point of its outline within that column; rows
+        # at an angle then touch a thin band of cells, not their bounding box
+        grid = [[] for _ in range(self.nx * self.ny)]
+        for i, (xs, ys, (bx0, _, bx1, _)) in enumerate(self.polygons):
+            for cx in range(int((bx0 - x0) / cell), int((bx1 - x0) / cell) + 1):
+                lo, hi = _slab(xs, ys, x0 + cx * cell, x0 + (cx + 1) * cell)
+                for cy in range(max(0, int((lo - y0) / cell)), min(self.ny - 1, int((hi - y0) / cell)) + 1):
+                    grid[cx * self.ny + cy].append(i)
+        self._grid = [tuple(c) for c in grid]
+
+    @classmethod
+    def load(cls, path, width=None):
+        return cls(read_geojson(path, width))
+
+    def _cell(self, x, y):
+        cx = int((x - self.origin[0]) // self.cell)
+        cy = int((y - self.origin[1]) // self.cell)
+        if 0 <= cx < self.nx and 0 <= cy < self.ny:
+            return self._grid[cx * self.ny + cy]
+        return ()
+
+    def contains(self, i, x, y):
+        xs, ys, (bx0, by0, bx1, by1) = self.polygons[i]
+        if not (bx0 <= x <= bx1 and by0 <= y <= by1):
+            return False
+        inside = False
+        j = len(xs) - 1
+        for k in range(len(xs)):
+            if (ys[k] > y) != (ys[j] > y) and x < (xs[j] - xs[k]) * (y - ys[k]) / (ys[j] - ys[k]) + xs[k]:
+                inside = not inside
+            j = k
+        return inside
+
+    def distance(self, i, x, y):
+        # metres from (x, y) to the outline of polygon i, 0 inside
+        if self.contains(i, x, y):
+            return 0.
+        xs, ys, _ = self.polygons[i]
+        best = float('inf')
+        j = len(xs) - 1
+        for k in range(len(xs)):
+            dx, dy = xs[k] - xs[j], ys[k] - ys[j]
+            t = ((x - xs[j]) * dx + (y - ys[j]) * dy) / (dx * dx + dy * dy) if dx or dy else 0.
+            t = min(1., max(0., t))
+            best = min(best, math.hypot(x - xs[j] - t * dx, y - ys[j] - t * dy))
+            j = k
+        return best
+
+    def locate_xy(self, x, y):
+        # -> polygon index or None
+        for i in self._cell(x, y):
+            if self.contains(i, x, y):
+                return i
+        return None
+
+    def locate(self, lat, lon):
+        # -> row name or None
+        i = self.locate_xy(*self.project(lat, lon))
+        return None if i is None else self.names[i]
+
+
+class RowResolver(object):
+    """ The row a picker is in, steady at the edges.
+
+    The current row is kept while fixes stay within `margin` metres of it,
+    so GNSS noise at a row end or on the line between two rows does not
+    flip it back and forth; past that the fix's own row is taken, or
+    ROW_DEFAULT outside every row. Without ROWS_FILE (GeoJSON,
+    see read_geojson) every fix is in ROW_DEFAULT, as before.
+    """
+
+    def __init__(self, index=None, margin=None, default=None):
+        if index is None and os.getenv('ROWS_FILE'):
+            index = RowIndex.load(os.getenv('ROWS_FILE'))
+        self.index = index
+        self.margin = float(margin if margin is not None else os.getenv('ROW_MARGIN', 0.5))
+        self.default = default if default is not None else _default_row()
+        self.row = self.default
+        self.changed = False
+        self._current = None # polygon index of self.row
+
+    def update(self, fix):
+        # -> row name of this fix; self.changed tells whether it is a new one
+        index = self.index
+        if index is None or not fix.valid:
+            self.changed = False
+            return self.row
+        x, y = index.project(fix.lat, fix.lon)
+        current = self._current
+        # the current row holds until a fix is `margin` metres clear of it
+        if current is None or index.distance(current, x, y) > self.margin:
+            current = index.locate_xy(x, y)
+        row = self.default if current is None else index.names[current]
+        self._current = current
+        self.changed = row != self.row
+        if self.changed:
+            ROW_CHANGES.inc()
+            self.row = row
+        return row
+
+
+def farm(tunnels=(8, 5), rows=100, length=50., width=1.5, gap=10., angle=17., lat=53.2680, lon=-0.5240):
+    # a made up farm: a grid of polytunnels, each `rows` rows side by side,
+    # the whole thing turned by `angle` degrees; -> read_geojson style rows
+    proj = _Projection(lat, lon)
+    a = math.radians(angle)
+    ca, sa = math.cos(a), math.sin(a)
+    out = []
+    for tx in range(tunnels[0]):
+        for ty in range(tunnels[1]):
+            for r in range(rows):
+                x = tx * (rows * width + gap) + r * width
+                y = ty * (length + gap)
+                corners = [(x, y), (x + width, y), (x + width, y + length), (x, y + length)]
+                outline = []
+                for cx, cy in corners:
+                    px, py = cx * ca - cy * sa, cx * sa + cy * ca
+                    outline.append((lat + py / proj.ky, lon + px / proj.kx))
+                out.append(("T%d-%d/%d" % (tx, ty, r + 1), outline, None))
+    return out
+
+
+if __name__ == "__main__":
+    # lookups/s on a 40 tunnel, 4000 row farm against testing every row,
+    # and agreement of the two
+    import random
+    from fix import Fix
+
+    rows = farm()
+    t = time.perf_counter()
+    index = RowIndex(rows)
+    print("%d rows indexed in %.0f ms, %dx%d cells of %.2f m" % (
+        len(index.polygons), (time.perf_counter() - t) * 1000, index.nx, index.ny, index.cell))
+
+    lats = [p[0] for _, o, _ in rows for p in o]
+    lons = [p[1] for _, o, _ in rows for p in o]
+    rnd = random.Random(1)
+    points = [(rnd.uniform(min(lats), max(lats)), rnd.uniform(min(lons), max(lons))) for _ in range(20000)]
+
+    t = time.perf_counter()
+    found = [index.locate(lat, lon) for lat, lon in points]
+    grid = len(points) / (time.perf_counter() - t)
+
+    def scan(lat, lon):
+        x, y = index.project(lat, lon)
+        for i in range(len(index.polygons)):
+            if index.contains(i, x, y):
+                return index.names[i]
+
+    sample = points[:500]
+    t = time.perf_counter()
+    expected = [scan(lat, lon) for lat, lon in sample]
+    linear = len(sample) / (time.perf_counter() - t)
+    assert expected == found[:len(sample)]
+    inside = sum(1 for f in found if f is not None)
+    print("grid %.0f lookups/s, scan of every row %.0f lookups/s, %d%% of points in a row" % (
+        grid, linear, 100 * inside // len(found)))
+
+    # a picker walking across the rows of one tunnel with 1 m of noise
+    resolver = RowResolver(index, margin=.5, default='')
+    lat0, lon0 = rows[0][1][0]
+    fixes = [Fix(lat0 + rnd.gauss(0, 1e-5) + 2e-4, lon0 + i * 2e-7 + rnd.gauss(0, 1e-5), ts=i) for i in range(20000)]
+    t = time.perf_counter()
+    changes = 0
+    for fix in fixes:
+        resolver.update(fix)
+        changes += resolver.changed
+    stream = len(fixes) / (time.perf_counter() - t)
+    bare = sum(1 for a, b in zip(fixes, fixes[1:]) if index.locate(a.lat, a.lon) != index.locate(b.lat, b.lon))
+    print("resolver %.0f fixes/s, %d row changes with hysteresis, %d without" % (stream, changes, bare))
@@ -0,0 +1,376 @@
+import collections
+import importlib
+import os
+import threading
+import time
+
+import boot
+import log
+import metrics
+from fix import Fix, HAS_ERROR, HAS_HDOP
+from fixbuffer import FixRing
+
+
+logger = log.get("gps.sources")
+
+# what was published, whichever source it came from; each source counts its
+# own reports in gps_<name>_fixes / gps_<name>_no_fix
+FIXES = metrics.counter("fixes")
+SWITCHES = metrics.counter("gps_switches")
+BACKFILLED = metrics.counter("gps_backfilled")
+RESTARTS = metrics.counter("gps_source_restarts")
+
+
+# name -> Source; the order in GPS_SOURCES is the order of preference
+SOURCES = {}
+
+Source = collections.namedtuple('Source', 'module cls kwargs ready')
+
+
+def register(name, module, cls='GPS', kwargs=None, ready=None):
+    # a backend: module.cls(gps_data_callback, **kwargs()) with start(),
+    # stop() and subscribe() like _gpsd_serial.GPS; ready() says whether
+    # it can be opened now
+    SOURCES[name] = Source(module, cls, kwargs or dict, ready or (lambda: True))
+
+
+def ppp_holds(port):
+    # the PPP data session's tty: PPP_SERIAL_PORT ($MODEM in wvdiald.pl),
+    # or any port pppd/wvdial has a UUCP lock on. Writing AT commands to it
+    # would take down the 4G link the websocket runs over
+    if not port:
+        return False
+    path = os.path.realpath(port)
+    ppp = os.getenv("PPP_SERIAL_PORT")
+    if ppp and os.path.realpath(ppp) == path:
+        return True
+    lock = "LCK.." + os.path.basename(path)
+    return any(os.path.exists(os.path.join(d, lock)) for d in ("/var/lock", "/run/lock"))
+
+
+def at_ready():
+    port = os.getenv("MODEM_SERIAL_PORT")
+    return boot.device_ready(port) and not ppp_holds(port)
+
+
+register('gpsd', '_gpsd_service', ready=boot.gpsd_ready)
+# +CGPSINFO reports asked for on a free AT port, never the PPP one
+register('at', '_gpsd_serial', ready=at_ready)
+# the same port through the AT multiplexer, instead of 'at'
+register('atmux', 'atmux', 'ATMux', ready=at_ready)
+# a port that streams NMEA by itself; gpsd normally holds the SIM7600's
+register('nmea', '_gpsd_serial',
+         kwargs=lambda: {'port': os.getenv("NMEA_SERIAL_PORT", "/dev/ttyUSB1"), 'commands': False},
+         ready=lambda: boot.device_ready(os.getenv("NMEA_SERIAL_PORT", "/dev/ttyUSB1")))
+register('replay', '_gpsd_replay',
+         ready=lambda: bool(os.getenv("GPS_REPLAY_FILE")) and os.path.exists(os.getenv("GPS_REPLAY_FILE")))
+
+
+def use_gpsd():
+    return os.getenv("USE_GPSD", "").lower() in ("1", "true", "yes")
+
+
+def configured():
+    # GPS_SOURCES, or gpsd alone when USE_GPSD is set: a fallback to the
+    # modem's AT port has to be asked for, on a port PPP does not use
+    names = os.getenv("GPS_SOURCES")
+    if names:
+        names = [n.strip() for n in names.split(',') if n.strip()]
+    else:
+        names = ['gpsd'] if use_gpsd() else ['at']
+    unknown = [n for n in names if n not in SOURCES]
+    if unknown:
+        raise ValueError("unknown GPS source %s, known: %s" % (", ".join(unknown), ", ".join(sorted(SOURCES))))
+    if set(names) & set(['at', 'atmux']) and ppp_holds(os.getenv("MODEM_SERIAL_PORT")):
+        logger.error("MODEM_SERIAL_PORT %s carries the PPP session, the AT source will not open it",
+                     os.getenv("MODEM_SERIAL_PORT"))
+    return names
+
+
+def any_ready(names=None):
+    return any(SOURCES[name].ready() for name in (names or configured()))
+
+
+def _clamp(x):
+    return 0. if x < 0. else 1. if x > 1. else x
+
+
+class Health(object):
+    """ How well a source is doing, from 0 (nothing usable) to 1.
+
+    The product of three parts: the age of its last position against
+    GPS_HEALTH_AGE seconds, its position rate over the last GPS_HEALTH_WINDOW
+    seconds against one per GPS_REPORT_INTERVAL, and its error estimate
+    against GPS_HEALTH_ERROR metres (HDOP x GPS_FILTER_UERE when that is all
+    there is, no penalty when there is neither).
+    """
+
+    def __init__(self, interval=None, max_age=None, error=None, window=None, uere=None):
+        self.interval = float(interval or os.getenv("GPS_REPORT_INTERVAL", 1))
+        self.max_age = float(max_age or os.getenv("GPS_HEALTH_AGE", 5))
+        self.error = float(error or os.getenv("GPS_HEALTH_ERROR", 10))
+        self.window = float(window or os.getenv("GPS_HEALTH_WINDOW", 10))
+        self.uere = float(uere or os.getenv("GPS_FILTER_UERE", 5))
+        self.arrivals = collections.deque() # receive times of positions in the window
+        self.first = None
+        self.last = None
+        self.accuracy = None
+
+    def add(self, fix):
+        if not fix.valid:
+            return
+        self.last = fix.ts
+        if self.first is None:
+            self.first = fix.ts
+        self.arrivals.append(fix.ts)
+        if fix.flags & HAS_ERROR:
+            self.accuracy = fix.accuracy
+        elif fix.flags & HAS_HDOP:
+            self.accuracy = fix.hdop * self.uere
+        else:
+            self.accuracy = None
+
+    def score(self, now=None):
+        if self.last is None:
+            return 0.
+        now = now if now is not None else time.time()
+        age = _clamp((self.max_age - (now - self.last)) / max(self.max_age - self.interval, 1e-3))
+
+        while self.arrivals and self.arrivals[0] < now - self.window:
+            self.arrivals.popleft()
+        span = min(self.window, now - self.first)
+        rate = 1. if span < 2 * self.interval else _clamp(len(self.arrivals) * self.interval / span)
+
+        error = 1. if not self.accuracy else _clamp(self.error / self.accuracy)
+        return age * rate * error
+
+
+class Selector(object):
+    """ Decides which source's fixes go out.
+
+    offer() takes every fix from every source and returns the ones to
+    publish. The first source in preference order scoring at least
+    GPS_HEALTH_MIN is used; a degraded active source is left at once, the
+    way back to a preferred one waits until it has held that score for
+    GPS_FAILBACK seconds. On a switch the new source's recent fixes newer
+    than the last one published are replayed first, so a stall of the old
+    source leaves no hole in the track.
+    """
+
+    def __init__(self, names, min_score=None, failback=None, keep=None):
+        self.names = list(names)
+        self.min_score = float(min_score if min_score is not None else os.getenv("GPS_HEALTH_MIN", 0.5))
+        self.failback = float(failback if failback is not None else os.getenv("GPS_FAILBACK", 10))
+        self.health = dict((name, Health()) for name in self.names)
+        self.recent = dict((name, collections.deque(maxlen=keep or 32)) for name in self.names)
+        self.good_since = dict.fromkeys(self.names)
+        self.was_good = set() # the hold-down is for coming back, not for starting up
+        self.active = None
+        self.last_ts = 0.
+        self.last_utc = 0.
+        self.switches = 0
+
+    def scores(self, now=None):
+        now = now if now is not None else time.time()
+        return dict((name, round(self.health[name].score(now), 3)) for name in self.names)
+
+    def _newer(self, fix):
+        # after the last one published; two sources report the same epoch
+        # with different receive times, the receiver's UTC tells them apart
+        if fix.ts <= self.last_ts or (fix.utc and fix.utc <= self.last_utc):
+            return False
+        self.last_ts = fix.ts
+        self.last_utc = fix.utc or self.last_utc
+        return True
+
+    def offer(self, name, fix, now=None):
+        # a fix from source `name` -> fixes to publish, oldest first
+        self.health[name].add(fix)
+        self.recent[name].append(Fix().copy_from(fix))
+        out = self.tick(fix.ts if now is None else now)
+        if name == self.active and not out and self._newer(fix):
+            out.append(fix)
+        return out
+
+    def tick(self, now=None):
+        # re-score the sources, -> backfill to publish when the active one changed
+        now = now if now is not None else time.time()
+        scores = [(name, self.health[name].score(now)) for name in self.names]
+        for name, score in scores:
+            if score < self.min_score:
+                self.good_since[name] = None
+            elif self.good_since[name] is None:
+                self.good_since[name] = now
+        failback = dict((name, self.failback if name in self.was_good else 0.) for name in self.names)
+        self.was_good.update(name for name in self.names if self.good_since[name] is not None)
+
+        best = None
+        for name, score in scores:
+            if score >= self.min_score:
+                best = name
+                break
+        if best is None:
+            # nothing is healthy; the least bad one is better than nothing
+            name, score = max(scores, key=lambda s: s[1])
+            best = name if score > 0 else None
+        if best is None or best == self.active:
+            return []
+
+        current = dict(scores).get(self.active, 0.)
+        if (self.active is not None and current >= self.min_score
+                and (now - self.good_since[best] < failback[best] or dict(scores)[best] < current)):
+            return [] # not long enough back to full health to switch back to it
+
+        logger.warning("gps source %s -> %s (%s)", self.active, best,
+                       ", ".join("%s %.2f" % s for s in scores))
+        self.active = best
+        self.switches += 1
+        SWITCHES.inc()
+        backfill = [f for f in self.recent[best] if self._newer(f)]
+        if backfill and self.switches > 1:
+            BACKFILLED.inc(len(backfill))
+        return backfill
+
+
+class FailoverGPS(threading.Thread):
+    """ The configured sources (GPS_SOURCES) behind one GPS interface.
+
+    Every source runs at once, so a standby has fixes ready when it is
+    needed; a Selector picks which ones are published to this object's
+    own FixRing. A source is opened once its readiness check passes and
+    reopened GPS_RETRY seconds after it fails or dies (a vanished port, a
+    gpsd that went away). `load` imports the backend modules.
+    """
+
+    def __init__(self, gps_data_callback=None, names=None, load=None, retry=None):
+        super(FailoverGPS, self).__init__()
+        self.daemon = True
+        self.callback = gps_data_callback
+        self.names = list(names or configured())
+        self.load = load or importlib.import_module
+        self.retry = float(retry if retry is not None else os.getenv("GPS_RETRY", 5))
+        self.selector = Selector(self.names)
+        self.sources = dict.fromkeys(self.names)
+        self.retry_at = dict.fromkeys(self.names, 0.)
+        self.last_data = Fix() # no fix yet
+        self.fixes = FixRing(int(os.getenv("GPS_BUFFER_SIZE", 64)))
+        self.stop_event = threading.Event()
+        self._lock = threading.Lock()
+        for name in self.names:
+            metrics.gauge("gps_health_" + name, lambda name=name: self.score(name))
+
+    @property
+    def active(self):
+        return self.selector.active
+
+    def score(self, name):
+        with self._lock:
+            return self.selector.scores()[name]
+
+    def set_callback(self, cb):
+        self.callback = cb
+
+    def subscribe(self, name=None):
+        return self.fixes.subscribe(name)
+
+    def get_latest_data(self):
+        return self.last_data
+
+    def _publish(self, fixes):
+        # called with self._lock held, so the ring and FIXES keep a single
+        # writer at a time
+        for fix in fixes:
+            self.last_data = fix
+            self.fixes.publish(fix)
+            FIXES.inc()
+            if self.callback is not None:
+                self.callback(fix)
+
+    def _on_fix(self, name, fix):
+        with self._lock:
+            self._publish(self.selector.offer(name, fix))
+
+    def _open(self, name, now):
+        source = SOURCES[name]
+        if now < self.retry_at[name] or not source.ready():
+            return
+        try:
+            kwargs = dict(source.kwargs(), name=name)
+            gps = getattr(self.load(source.module), source.cls)(
+                lambda fix: self._on_fix(name, fix), **kwargs)
+            gps.daemon = True
+            gps.start()
+        except Exception as e:
+            logger.error("cannot open gps source %s: %s", name, e)
+            self.retry_at[name] = now + self.retry
+            return
+        logger.info("gps source %s open", name)
+        self.sources[name] = gps
+
+    def _check(self):
+        now = time.time()
+        for name in self.names:
+            gps = self.sources[name]
+            if gps is None:
+                self._open(name, now)
+            elif not gps.is_alive():
+                logger.error("gps source %s stopped, reopening in %.0f s", name, self.retry)
+                RESTARTS.inc()
+                self.sources[name] = None
+                self.retry_at[name] = now + self.retry
+        with self._lock:
+            self._publish(self.selector.tick(now))
+
+    def run(self):
+        while not self.stop_event.wait(0.5):
+            self._check()
+
+    def start(self):
+        # open what is there now, so the first fixes are not held up a tick
+        self._check()
+        super(FailoverGPS, self).start()
+
+    def stop(self):
+        self.stop_event.set()
+        for gps in self.sources.values():
+            if gps is not None:
+                gps.stop()
+
+
+if __name__ == "__main__":
+    # two replayed modems with the same walk, the preferred one going quiet
+    # for a while: what comes out of FailoverGPS against that source alone
+    from replay import PtyModem, synthetic, epochs
+
+    n, stall = 40, range(8, 18)
+    chunks = epochs(synthetic(n))
+    primary = PtyModem([b"" if i in stall else c for i, c in enumerate(chunks)])
+    standby = PtyModem(chunks)
+    primary.start()
+    standby.start()
+    register('primary', '_gpsd_serial', kwargs=lambda: {'port': primary.port})
+    register('standby', '_gpsd_serial', kwargs=lambda: {'port': standby.port})
+
+    gps = FailoverGPS(names=['primary', 'standby'])
+    alone = []
+    gps.start()
+    sub = gps.subscribe()
+    # the primary's own ring holds what that source alone would give
+    while gps.sources['primary'] is None:
+        time.sleep(0.1)
+    own = gps.sources['primary'].subscribe()
+    standby.done.wait(n + 5)
+    time.sleep(1.5)
+    gps.stop()
+    primary.stop()
+    standby.stop()
+
+    def coverage(fixes):
+        utc = sorted(set(f.utc for f in fixes if f.valid))
+        gap = max(b - a for a, b in zip(utc, utc[1:])) if len(utc) > 1 else None
+        return "%d of %d epochs, longest gap %s s" % (len(utc), n, gap)
+
+    print("primary alone:", coverage(own.drain()))
+    print("failover:     ", coverage(sub.drain()))
+    print("switches %d, backfilled %d, scores at the end %s"
+          % (gps.selector.switches, BACKFILLED.value, gps.selector.scores()))
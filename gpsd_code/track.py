@@ -0,0 +1,307 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+
+import log
+from fix import Fix, FIX_SIZE, HAS_UTC
+
+logger = log.get("track")
+
+
+# file header: magic, record size, records written (valid up to the last flush)
+HEADER = struct.Struct("<8sII")
+MAGIC = b"SPTRACK1"
+# offsets of Fix.utc and Fix.ts inside a FIX_STRUCT record
+# (lat lon alt speed course | utc | ts)
+UTC_OFFSET = struct.calcsize("<ddfff")
+TS_OFFSET = struct.calcsize("<ddfffd")
+_TS = struct.Struct("<d")
+
+# files are named by a sequence number, not the date: the Pi has no RTC and
+# its clock jumps when NTP syncs, the number only goes up
+NAME = "track-%08d.bin"
+
+
+def default_dir():
+    return os.getenv('TRACK_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'smart_picker', 'track'))
+
+
+class TrackRecorder(threading.Thread):
+    """ Appends every fix from a FixRing subscription to the local track.
+
+    Fixes are read into one reused Fix and packed as FIX_STRUCT records
+    straight into a memory-mapped, preallocated file, so recording allocates
+    nothing per fix. The mapping is flushed (and the header's record count updated)
+    once `flush_records` fixes or `flush_interval` seconds have piled up,
+    which bounds how often the SD card is written. A full file is closed and
+    a new one started; only the newest `max_files` are kept.
+
+    Records are ordered by the receiver's UTC, which does not jump like the
+    system clock: a fix without one is stored with the last UTC seen (its
+    HAS_UTC flag stays clear), so the column never goes backwards.
+    """
+
+    def __init__(self, subscription, directory=None, records_per_file=None,
+                 max_files=None, flush_records=None, flush_interval=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sub = subscription
+        self.directory = directory or default_dir()
+        self.records_per_file = int(records_per_file or os.getenv('TRACK_FILE_RECORDS', 65536))
+        self.max_files = int(max_files or os.getenv('TRACK_FILES', 8))
+        self.flush_records = int(flush_records or os.getenv('TRACK_FLUSH_RECORDS', 64))
+        self.flush_interval = float(flush_interval or os.getenv('TRACK_FLUSH_INTERVAL', 30))
+        self.stop_event = threading.Event()
+
+        self._fix = Fix()
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._flushed = 0
+        self._last_flush = 0.
+        self._seq = None
+        self._utc = 0.
+        self.path = None
+        self.records = 0
+        self.flushes = 0
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if self._seq is None:
+            files = list_files(self.directory)
+            self._seq = max([sequence(p) for p in files] + [-1])
+            self._utc = last_utc(files)
+        self._seq += 1
+        path = os.path.join(self.directory, NAME % self._seq)
+
+        size = HEADER.size + self.records_per_file * FIX_SIZE
+        self._file = open(path, "w+b")
+        self._file.truncate(size) # sparse until written
+        self._map = mmap.mmap(self._file.fileno(), size)
+        HEADER.pack_into(self._map, 0, MAGIC, FIX_SIZE, 0)
+        self._count = self._flushed = 0
+        self._last_flush = time.monotonic()
+        self.path = path
+        self._prune()
+
+    def _prune(self):
+        files = list_files(self.directory)
+        for path in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def flush(self):
+        if self._map is None or self._count == self._flushed:
+            return
+        HEADER.pack_into(self._map, 0, MAGIC, FIX_SIZE, self._count)
+        # only the pages touched since the last flush
+        start = HEADER.size + self._flushed * FIX_SIZE
+        start -= start % mmap.ALLOCATIONGRANULARITY
+        end = HEADER.size + self._count * FIX_SIZE
+        self._map.flush(0, min(mmap.PAGESIZE, len(self._map)))
+        self._map.flush(start, end - start)
+        self._flushed = self._count
+        self._last_flush = time.monotonic()
+        self.flushes += 1
+
+    def _close(self):
+        if self._map is None:
+            return
+        self.flush()
+        self._map.close()
+        self._file.close()
+        self._map = self._file = None
+
+    def record(self, fix):
+        if self._map is None or self._count == self.records_per_file:
+            self._close()
+            self._open()
+        offset = HEADER.size + self._count * FIX_SIZE
+        fix.pack_into(self._map, offset)
+        if fix.flags & HAS_UTC and fix.utc >= self._utc:
+            self._utc = fix.utc
+        else:
+            _TS.pack_into(self._map, offset + UTC_OFFSET, self._utc)
+        self._count += 1
+        self.records += 1
+        if self._count - self._flushed >= self.flush_records:
+            self.flush()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                fix = self.sub.next(timeout=1., out=self._fix)
+                if fix is not None and fix.valid:
+                    self.record(fix)
+                if time.monotonic() - self._last_flush >= self.flush_interval:
+                    self.flush()
+        except (IOError, OSError) as e:
+            logger.error("track recorder stopped: %s", e)
+        finally:
+            self._close()
+            self.sub.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def sequence(path):
+    # the file's sequence number, -1 for the date-named files of older versions
+    n = os.path.basename(path)[6:-4]
+    return int(n) if n.isdigit() else -1
+
+
+def list_files(directory=None):
+    # oldest first: date-named files by name, then by sequence number
+    directory = directory or default_dir()
+    try:
+        names = [n for n in os.listdir(directory) if n.startswith("track-") and n.endswith(".bin")]
+    except OSError:
+        return []
+    names.sort(key=lambda n: (sequence(n), n))
+    return [os.path.join(directory, n) for n in names]
+
+
+def last_utc(files):
+    # the UTC of the newest record in files, 0 when there is none
+    for path in reversed(files):
+        try:
+            f = TrackFile(path)
+        except (ValueError, OSError):
+            continue
+        utc = f.utc(len(f) - 1) if len(f) else None
+        f.close()
+        if utc is not None:
+            return utc
+    return 0.
+
+
+class TrackFile(object):
+    """ Read-only view of one track file, records indexed by position. """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or size != FIX_SIZE:
+            self._map.close()
+            raise ValueError("%s is not a track file" % path)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def ts(self, i):
+        return _TS.unpack_from(self._map, HEADER.size + i * FIX_SIZE + TS_OFFSET)[0]
+
+    def utc(self, i):
+        return _TS.unpack_from(self._map, HEADER.size + i * FIX_SIZE + UTC_OFFSET)[0]
+
+    def fix(self, i, out=None):
+        return (out or Fix()).unpack_from(self._map, HEADER.size + i * FIX_SIZE)
+
+    def find(self, utc):
+        # index of the first record at or after utc
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.utc(mid) < utc:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def close(self):
+        self._map.close()
+
+
+class Track(object):
+    """ Every track file in a directory, in sequence order, searched by
+    the receiver's UTC (epoch seconds). """
+
+    def __init__(self, directory=None):
+        self.files = []
+        for path in list_files(directory):
+            try:
+                f = TrackFile(path)
+            except (ValueError, OSError):
+                continue
+            if len(f):
+                self.files.append(f)
+        self._starts = [f.utc(0) for f in self.files]
+
+    def __len__(self):
+        return sum(len(f) for f in self.files)
+
+    def at(self, utc, out=None):
+        # the last fix recorded at or before utc, None if there is none
+        i = bisect.bisect_right(self._starts, utc) - 1
+        if i < 0:
+            return None
+        f = self.files[i]
+        n = f.find(utc)
+        if n < len(f) and f.utc(n) == utc:
+            return f.fix(n, out)
+        return f.fix(n - 1, out) if n > 0 else None
+
+    def between(self, start, end):
+        # fixes with start <= utc < end, oldest first
+        i = max(0, bisect.bisect_right(self._starts, start) - 1)
+        for f in self.files[i:]:
+            n = f.find(start)
+            while n < len(f):
+                if f.utc(n) >= end:
+                    return
+                yield f.fix(n)
+                n += 1
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+if __name__ == "__main__":
+    # record a synthetic hour at 10 Hz, the system clock set by NTP half
+    # way through, then time lookups by UTC
+    import shutil
+    import tempfile
+    from fixbuffer import FixRing
+
+    directory = tempfile.mkdtemp()
+    try:
+        ring = FixRing(64)
+        rec = TrackRecorder(ring.subscribe("track"), directory, records_per_file=10000, max_files=8)
+        t0 = 1600000000.
+        fix = Fix(53.2, -0.5, utc=t0, ts=0.)
+        n = 36000
+        t = time.perf_counter()
+        for i in range(n):
+            fix.lat += 1e-6
+            fix.utc = t0 + i * 0.1
+            fix.ts = (t0 if i >= n // 2 else 0.) + i * 0.1
+            rec.record(fix)
+        rec._close()
+        elapsed = time.perf_counter() - t
+        print("recorded %d fixes in %.3fs (%.1f us/fix), %d flushes, %d files"
+              % (n, elapsed, elapsed / n * 1e6, rec.flushes, len(list_files(directory))))
+
+        track = Track(directory)
+        out = Fix()
+        queries = [t0 + (i * 7919 % n) * 0.1 + 0.05 for i in range(20000)]
+        t = time.perf_counter()
+        for q in queries:
+            track.at(q, out)
+        elapsed = time.perf_counter() - t
+        print("%d lookups over %d fixes: %.1f us each" % (len(queries), len(track), elapsed / len(queries) * 1e6))
+        print("at(t0 + 100.05):", track.at(t0 + 100.05))
+        print("fixes in [t0+10, t0+11):", len(list(track.between(t0 + 10, t0 + 11))))
+        track.close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,185 @@
+import contextlib
+import os
+import time
+
+import log
+
+logger = log.get("transport")
+
+
+# Connections used by ws.WS. websocket-client cannot do permessage-deflate
+# (it rejects frames with RSV1 set), so compression is negotiated with the
+# websockets package when it is installed and the server agrees to it;
+# anything else falls back to a plain websocket-client connection.
+
+
+class CompressionStats(object):
+    """ Per direction payload bytes before (raw) and after (wire) deflate. """
+
+    def __init__(self):
+        self.negotiated = False
+        self.tx_raw = self.tx_wire = 0
+        self.rx_raw = self.rx_wire = 0
+
+    def ratio(self, direction):
+        raw, wire = (self.tx_raw, self.tx_wire) if direction == 'tx' else (self.rx_raw, self.rx_wire)
+        return wire / float(raw) if raw else 1.
+
+    def summary(self):
+        return {
+            'negotiated': self.negotiated,
+            'tx_raw': self.tx_raw, 'tx_wire': self.tx_wire, 'tx_ratio': round(self.ratio('tx'), 3),
+            'rx_raw': self.rx_raw, 'rx_wire': self.rx_wire, 'rx_ratio': round(self.ratio('rx'), 3),
+        }
+
+
+class PlainTransport(object):
+    """ websocket-client connection, no compression. """
+
+    def __init__(self, address, timeout, stats):
+        from websocket import create_connection
+
+        self.stats = stats
+        self.timeout = timeout
+        self._ws = create_connection(address, timeout=timeout)
+        self._last_rx = time.time()
+
+    def send(self, frame):
+        if isinstance(frame, bytes):
+            self._ws.send_binary(frame)
+        else:
+            self._ws.send(frame)
+        self.stats.tx_raw += len(frame)
+        self.stats.tx_wire += len(frame)
+
+    def recv(self):
+        # next text (str) or binary (bytes) message, None after `timeout`
+        # seconds without one
+        from websocket import WebSocketTimeoutException, ABNF
+
+        while True:
+            try:
+                opcode, data = self._ws.recv_data(control_frame=True)
+            except WebSocketTimeoutException:
+                return None
+            self._last_rx = time.time()
+            if opcode == ABNF.OPCODE_CLOSE:
+                raise IOError("closed by server")
+            if opcode == ABNF.OPCODE_TEXT:
+                self.stats.rx_raw += len(data)
+                self.stats.rx_wire += len(data)
+                return data.decode('utf-8')
+            if opcode == ABNF.OPCODE_BINARY:
+                self.stats.rx_raw += len(data)
+                self.stats.rx_wire += len(data)
+                return data
+            # ping/pong, handled by websocket-client
+
+    def keepalive(self):
+        # False when the last ping went unanswered
+        if time.time() - self._last_rx > 2 * self.timeout:
+            return False
+        self._ws.ping()
+        return True
+
+    def close(self):
+        self._ws.close()
+
+
+class _CountingExtension(object):
+    # wraps the negotiated websockets PerMessageDeflate to count bytes on
+    # both sides of it
+    def __init__(self, ext, stats):
+        from websockets.frames import DATA_OPCODES
+
+        self._ext = ext
+        self._data = DATA_OPCODES
+        self.name = ext.name
+        self.stats = stats
+
+    def decode(self, frame, *, max_size=None):
+        out = self._ext.decode(frame, max_size=max_size)
+        if frame.opcode in self._data:
+            self.stats.rx_wire += len(frame.data)
+            self.stats.rx_raw += len(out.data)
+        return out
+
+    def encode(self, frame):
+        out = self._ext.encode(frame)
+        if frame.opcode in self._data:
+            self.stats.tx_raw += len(frame.data)
+            self.stats.tx_wire += len(out.data)
+        return out
+
+
+def count_extensions(protocol, stats):
+    # install the counters on a websockets connection (sync or asyncio);
+    # True if permessage-deflate was negotiated
+    negotiated = False
+    for i, ext in enumerate(protocol.extensions):
+        if ext.name == 'permessage-deflate':
+            protocol.extensions[i] = _CountingExtension(ext, stats)
+            negotiated = True
+    stats.negotiated = negotiated
+    return negotiated
+
+
+class DeflateTransport(object):
+    """ websockets sync connection offering permessage-deflate with context
+    takeover; if the server declines, frames are simply sent uncompressed.
+    """
+
+    def __init__(self, address, timeout, stats):
+        from websockets.sync.client import connect
+
+        self.stats = stats
+        self.timeout = timeout
+        # connect() is a context manager, the stack closes it in close()
+        self._stack = contextlib.ExitStack()
+        self._ws = self._stack.enter_context(connect(address, compression='deflate', open_timeout=timeout))
+        self._pong = None
+        if not count_extensions(self._ws.protocol, stats):
+            logger.info("server declined permessage-deflate, sending uncompressed")
+
+    def send(self, frame):
+        if not self.stats.negotiated:
+            self.stats.tx_raw += len(frame)
+            self.stats.tx_wire += len(frame)
+        self._ws.send(frame)
+
+    def recv(self):
+        try:
+            data = self._ws.recv(timeout=self.timeout)
+        except TimeoutError:
+            return None
+        if not self.stats.negotiated:
+            self.stats.rx_raw += len(data)
+            self.stats.rx_wire += len(data)
+        return data
+
+    def keepalive(self):
+        if self._pong is not None and not self._pong.is_set():
+            return False
+        self._pong = self._ws.ping()
+        return True
+
+    def close(self):
+        self._stack.close()
+
+
+def connect(address, timeout, stats, compression=None):
+    compression = compression or os.getenv('WS_COMPRESSION', 'deflate')
+    if compression == 'deflate':
+        try:
+            import websockets.sync.client # noqa: F401
+        except ImportError:
+            logger.warning("websockets not installed, connecting without compression")
+        else:
+            from websockets.exceptions import InvalidHandshake
+            try:
+                return DeflateTransport(address, timeout, stats)
+            except InvalidHandshake as e:
+                logger.warning("compressed handshake failed (%s), retrying without compression", e)
+
+    stats.negotiated = False
+    return PlainTransport(address, timeout, stats)
@@ -0,0 +1,156 @@
+import math
+import threading
+import time
+
+
+_UNSET = object()
+
+
+class UI(object):
+    """ Single owner of the LEDs and the display widgets.
+
+    Any thread (GPIO callbacks, the websocket thread) only records the state
+    it wants and asks the display thread for a frame (after_idle), which
+    applies whatever changed since the last one in one go, so widgets are
+    never written from another thread, repeated writes collapse into one and
+    unchanged values are not redrawn. Blinking and toasts (a message shown
+    for a while over the current text) are computed from the clock; their
+    next edge is the only timer kept, nothing runs while the UI is idle.
+    """
+
+    LEDS = ('r', 'g', 'b')
+
+    def __init__(self, gui, buttons):
+        self._gui = gui
+        self._buttons = buttons
+
+        self._lock = threading.Lock()
+        self._desired = {'r': False, 'g': False, 'b': False, 'text': '', 'user': ''}
+        self._applied = {}
+        self._blink = {} # led -> half period in seconds
+        self._toast = None # (text, until)
+        self._dirty = True
+        self._idle = False # a frame is queued with after_idle
+        self._timer_at = None # when the pending timer frame runs
+        self.frames = 0
+
+        self._apply = {
+            'r': lambda v: (self._buttons.setRedLed(v), self._gui.setRedButton(v)),
+            'g': lambda v: (self._buttons.setGreenLed(v), self._gui.setGreenButton(v)),
+            'b': lambda v: (self._buttons.setBlueLed(v), self._gui.setBlueButton(v)),
+            'text': self._gui.setDescription,
+            'user': self._gui.setUser,
+        }
+
+    def start(self):
+        self._wake()
+
+    def set(self, all=None, r=None, g=None, b=None):
+        if all is not None:
+            r, g, b = all, all, all
+        with self._lock:
+            for led, value in (('r', r), ('g', g), ('b', b)):
+                if value is not None:
+                    self._desired[led] = bool(value)
+            self._dirty = True
+        self._wake()
+
+    def set_text(self, desc):
+        with self._lock:
+            self._desired['text'] = desc
+            self._toast = None # real news replaces a toast
+            self._dirty = True
+        self._wake()
+
+    def get_text(self):
+        return self._desired['text']
+
+    def toast(self, text, seconds=2.):
+        # show text for a while, then whatever set_text() says by then
+        with self._lock:
+            self._toast = (text, time.time() + seconds)
+            self._dirty = True
+        self._wake()
+
+    def set_user(self, user):
+        with self._lock:
+            self._desired['user'] = user
+            self._dirty = True
+        self._wake()
+
+    def blink(self, led, period=1.):
+        with self._lock:
+            self._blink[led] = period / 2.
+        self._wake()
+
+    def stop_blink(self, led=None):
+        with self._lock:
+            for l in ([led] if led else list(self._blink)):
+                self._blink.pop(l, None)
+            self._dirty = True # fall back to the steady value
+        self._wake()
+
+    def _wake(self):
+        with self._lock:
+            if self._idle:
+                return
+            self._idle = True
+        self._gui.after_idle(self._frame)
+
+    def _frame(self):
+        with self._lock:
+            self._idle = False
+        self._next(self.flush())
+
+    def _timer(self, at):
+        with self._lock:
+            if self._timer_at == at:
+                self._timer_at = None
+        self._next(self.flush())
+
+    def _next(self, at):
+        # keep one timer for the earliest blink edge or toast end
+        if at is None:
+            return
+        with self._lock:
+            if self._timer_at is not None and self._timer_at <= at:
+                return
+            self._timer_at = at
+        ms = int(math.ceil(max(0., at - time.time()) * 1000))
+        self._gui.after(ms, lambda: self._timer(at))
+
+    def flush(self):
+        # apply pending changes, -> when the next frame is due (None: only
+        # once something changes); only ever called on the display thread
+        with self._lock:
+            if not self._dirty and not self._blink and not self._toast:
+                return None
+            frame = dict(self._desired)
+            blink = dict(self._blink)
+            toast = self._toast
+            self._dirty = False
+
+        now = time.time()
+        due = None
+        if toast is not None:
+            if now < toast[1]:
+                frame['text'] = toast[0]
+                due = toast[1]
+            else:
+                with self._lock:
+                    if self._toast is toast:
+                        self._toast = None
+        for led, half in blink.items():
+            edge = int(now / half)
+            frame[led] = edge % 2 == 0
+            due = min(due or float('inf'), (edge + 1) * half)
+
+        changed = False
+        for key, value in frame.items():
+            if self._applied.get(key, _UNSET) != value:
+                self._applied[key] = value
+                self._apply[key](value)
+                changed = True
+        if changed:
+            self.frames += 1
+        return due
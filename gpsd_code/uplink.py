@@ -0,0 +1,87 @@
+import os
+import time
+
+import protocol
+
+
+class LocationBatcher(object):
+    """ Turns a stream of fixes into location frames for the coordinator.
+
+    mode 'compat' sends every fix as its own location_update (what the
+    current coordinator understands), 'json' and 'binary' collect fixes
+    for `window` seconds or `max_count` fixes and send them as one
+    delta-encoded location_batch frame.
+    """
+
+    MODES = ('compat', 'json', 'binary')
+
+    def __init__(self, user_name, mode=None, window=None, max_count=None):
+        self.user_name = user_name
+        self.mode = mode or os.getenv('UPLINK_MODE', 'compat')
+        if self.mode not in LocationBatcher.MODES:
+            raise ValueError("unknown uplink mode %r" % self.mode)
+        self.window = float(window or os.getenv('UPLINK_WINDOW', 5))
+        self.max_count = int(max_count or os.getenv('UPLINK_MAX_COUNT', 10))
+
+        self._pending = []
+        self._first = None
+        self._row = '3'
+
+        # bytes-per-fix accounting, compat_bytes is what the same fixes would
+        # have cost as individual location_update frames
+        self.fixes = 0
+        self.frames = 0
+        self.bytes = 0
+        self.compat_bytes = 0
+
+    def add(self, fix, row='3'):
+        # returns the frames (str or bytes) that are due now, maybe none
+        self.fixes += 1
+        single = protocol.location_update(self.user_name, fix, row)
+        self.compat_bytes += len(single)
+
+        if self.mode == 'compat':
+            return [self._count(single)]
+
+        frames = []
+        if self._pending and row != self._row:
+            # a batch is in one row, a new row goes out as soon as it starts
+            frames.append(self.flush())
+        if not self._pending:
+            self._first = time.time()
+        self._pending.append(fix)
+        self._row = row
+
+        if len(self._pending) >= self.max_count or self.due():
+            frames.append(self.flush())
+        return frames
+
+    def due(self):
+        return bool(self._pending) and time.time() - self._first >= self.window
+
+    def flush(self, force=True):
+        # the pending batch as one frame, None if empty (or not due yet and
+        # not forced)
+        if not self._pending or not (force or self.due()):
+            return None
+        if self.mode == 'binary':
+            frame = protocol.location_batch_binary(self.user_name, self._pending, self._row)
+        else:
+            frame = protocol.location_batch(self.user_name, self._pending, self._row)
+        self._pending = []
+        return self._count(frame)
+
+    def _count(self, frame):
+        self.frames += 1
+        self.bytes += len(frame)
+        return frame
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'fixes': self.fixes,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'bytes_per_fix': self.bytes / float(self.fixes) if self.fixes else 0.,
+            'compat_bytes_per_fix': self.compat_bytes / float(self.fixes) if self.fixes else 0.,
+        }
@@ -1,68 +1,219 @@
 
-from websocket import create_connection
-from requests import post
-
 import threading
-import time
-import json
 import os
 
-class WS(threading.Thread):
-    def __init__(self, address=None, user_name=None, update_orders_cb=None):
-        threading.Thread.__init__(self)
+import log
+import metrics
+import protocol
+import uplink
+import transport
+from registration import Registrar
+from orders import OrdersFilter
+from outbox import Outbox, Journal, backoff_delay
+
+logger = log.get("ws")
+
+RECONNECTS = metrics.counter("ws_reconnects")
+SEND_ERRORS = metrics.counter("ws_send_errors")
+FRAMES_OUT = metrics.counter("ws_frames_out")
+FRAMES_IN = metrics.counter("ws_frames_in")
+ORDERS_CALLBACK_MS = metrics.histogram("orders_callback_ms")
+
+
+class Client(object):
+    """ What ws.WS and ws_async.AsyncWS share: the messages the app sends,
+    queued in the Outbox until the connection takes them (control ones
+    first, never dropped and journaled), and the filtering of what comes
+    back. Subclasses own the connection, set `connected` while it is up
+    and call _received() with each incoming message.
+    """
+
+    def __init__(self, address=None, user_name=None, update_orders_cb=None, journal=None):
         self.address = address or os.getenv('WS_ADDRESS')
-        self._ws = create_connection(address)
         self.user_name = user_name
         self.update_orders_cb = update_orders_cb
-        self.stop_event = threading.Event()
-        self.registered = False
+        self.registrar = Registrar(user_name)
+        self.uplink = uplink.LocationBatcher(user_name)
+        self.orders = OrdersFilter(user_name)
+        self.compression = transport.CompressionStats()
+
+        # messages wait here while the link is down, control ones on disk too
+        self.outbox = Outbox(journal or Journal())
+
+        # sampled when metrics are read, nothing to do per message
+        metrics.gauge("ws_queue_depth", self.outbox.depth)
+        metrics.gauge("ws_connected", lambda: self.connected.is_set())
+        metrics.gauge("ws_bytes_out", lambda: self.compression.tx_wire)
+        metrics.gauge("ws_bytes_in", lambda: self.compression.rx_wire)
+        metrics.gauge("ws_dropped", lambda: self.outbox.dropped)
+
+    @property
+    def registered(self):
+        return self.registrar.registered.is_set()
+
+    def _queued(self):
+        # something went into the outbox
+        pass
+
+    def _control(self, frame):
+        # a local transition, the coordinator's next word on it counts again
+        self.orders.invalidate()
+        self.outbox.put_control(frame)
+        self._queued()
+
+    def _location(self, frame, mergeable):
+        self.outbox.put_location(frame, mergeable)
+        self._queued()
 
     def call_robot(self):
-        self._ws.send(json.dumps({'method':'call', 'user': self.user_name}))
+        self._control(protocol.call(self.user_name))
 
     def cancel_robot(self):
-        self._ws.send(json.dumps({'method':'cancel', 'user': self.user_name}))
+        self._control(protocol.cancel(self.user_name))
 
     def set_loaded(self):
-        self._ws.send(json.dumps({'method':'set_state', 'user': self.user_name, 'state': 'car_LOADED'}))
+        self._control(protocol.set_state(self.user_name, 'car_LOADED'))
 
     def set_init(self):
-        self._ws.send(json.dumps({'method':'set_state', 'user': self.user_name, 'state': 'car_INIT'}))
-
-    def send_gps(self, lat, lon, epx, epy, ts=time.time()):
-        self._ws.send(json.dumps(
-            {
-                'method':'location_update', 
-                'row':'3', 
-                'user': self.user_name, 
-                'latitude':float(lat), 
-                'longitude':float(lon), 
-                'accuracy':float(epx), 
-                'rcv_time':ts
-            }
-        ))
+        self._control(protocol.set_state(self.user_name, 'car_INIT'))
+
+    def send_gps(self, fix, row='3'):
+        # str frames go out as text, bytes (binary batches) as binary
+        for frame in self.uplink.add(fix, row):
+            self._location(frame, self.uplink.mode == 'compat')
+
+    def send_metrics(self, summary):
+        # a lost summary does not matter, it goes with the locations
+        self._location(protocol.metrics(self.user_name, summary), False)
+
+    def flush_gps(self, force=False):
+        # send a batch whose window has run out even if no new fix arrived
+        frame = self.uplink.flush(force)
+        if frame is not None:
+            self._location(frame, False)
+
+    def _received(self, data):
+        FRAMES_IN.inc()
+        if isinstance(data, bytes):
+            return
+
+        # only real transitions of our own state get through
+        new_state = self.orders.feed(data)
+        self._checkRegistration()
+        if new_state is not None:
+            # call update_orders callback
+            if self.update_orders_cb is not None:
+                with ORDERS_CALLBACK_MS.time():
+                    self.update_orders_cb(new_state)
+
+    def _checkRegistration(self):
+        # register again when the coordinator restarted and lost us
+        raise NotImplementedError
+
+    def log_stats(self):
+        logger.info("uplink stats: %s", self.uplink.stats())
+        logger.info("compression stats: %s", self.compression.summary())
+
+
+class WS(Client, threading.Thread):
+    def __init__(self, address=None, user_name=None, update_orders_cb=None, ping_interval=20.):
+        threading.Thread.__init__(self)
+        self.connected = threading.Event()
+        Client.__init__(self, address, user_name, update_orders_cb)
+        self._ws = None
+        self.stop_event = threading.Event()
+        self.ping_interval = ping_interval
+        self.reconnects = 0
+
+        self._sender = threading.Thread(target=self._sendLoop)
+        self._sender.daemon = True
+
+        # registration runs next to the connection, never on the receive path
+        self._registration = threading.Thread(target=self.registrar.ensure, args=(self.stop_event,))
+        self._registration.daemon = True
+
+    def _sendLoop(self):
+        while not self.stop_event.is_set():
+            if not self.connected.wait(1.):
+                continue
+            item = self.outbox.get(timeout=1.)
+            if item is None:
+                continue
+            try:
+                self._ws.send(Outbox.frame(item))
+            except Exception as e:
+                logger.warning("send failed: %s", e)
+                SEND_ERRORS.inc()
+                self.outbox.requeue(item)
+                self._drop()
+            else:
+                FRAMES_OUT.inc()
+                self.outbox.done(item)
 
     def register(self):
-        res = post(os.getenv('SITE_ADDRESS'), data={'username': self.user_name})
-        self.registered = res.ok
-        if self.registered:
-            print("Registered, response:", res)
+        return self.registrar.register()
+
+    def _connect(self):
+        self._ws = transport.connect(self.address, self.ping_interval, self.compression)
+        self.orders.reset() # whatever the coordinator says first is news
+        self.connected.set()
+        logger.info("connected to %s%s", self.address,
+                    " (compressed)" if self.compression.negotiated else "")
+
+    def _drop(self):
+        # wake the receive loop so it reconnects
+        self.connected.clear()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _receive(self):
+        while not self.stop_event.is_set() and self.connected.is_set():
+            data = self._ws.recv() #< blocking up to ping_interval
+            if data is None:
+                if not self._ws.keepalive():
+                    raise IOError("no answer to keepalive ping")
+                self._checkRegistration()
+                continue
+            self._received(data)
+
+    def _checkRegistration(self):
+        # the coordinator restarted and lost us while our registration was
+        # cached: register again, next to the connection as at start
+        if self.registrar.check(self.orders) and not self._registration.is_alive():
+            self._registration = threading.Thread(target=self.registrar.ensure, args=(self.stop_event,))
+            self._registration.daemon = True
+            self._registration.start()
 
     def run(self):
-        self.register()
+        self._registration.start()
+        self._sender.start()
+        attempt = 0
 
         while not self.stop_event.is_set():
-            if not self.registered:
-                self.register()
-
-            msg = json.loads(self._ws.recv()) #< blocking
+            try:
+                self._connect()
+                attempt = 0
 
-            if msg['method'] == 'update_orders' and self.user_name in msg['states']:
-                # call update_orders callback
-                if self.update_orders_cb is not None:
-                    self.update_orders_cb(msg['states'][self.user_name])
+                self._receive()
+            except Exception as e:
+                if self.stop_event.is_set():
+                    break
+                logger.warning("connection lost: %s", e)
+            finally:
+                self._drop()
 
-        self._ws.close()
+            delay = backoff_delay(attempt)
+            attempt += 1
+            self.reconnects += 1
+            RECONNECTS.inc()
+            logger.info("reconnecting in %.1fs", delay)
+            self.stop_event.wait(delay)
 
     def stop(self):
+        self.log_stats()
         self.stop_event.set()
+        self._drop()
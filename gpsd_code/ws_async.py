@@ -0,0 +1,111 @@
+import asyncio
+import os
+import threading
+
+import log
+import transport
+from outbox import Outbox, backoff_delay
+from ws import Client, FRAMES_OUT, RECONNECTS, SEND_ERRORS
+
+logger = log.get("ws")
+
+
+class AsyncWS(Client):
+    """ asyncio counterpart of ws.WS, the same messages and Outbox.
+
+    The send methods only queue the message, so they are safe to call from
+    button callbacks running on the event loop; run() owns the connection.
+    """
+
+    def __init__(self, address=None, user_name=None, update_orders_cb=None, journal=None):
+        self.connected = asyncio.Event()
+        Client.__init__(self, address, user_name, update_orders_cb, journal)
+        self._ready = asyncio.Event() # set when something was queued
+
+    def _queued(self):
+        self._ready.set()
+
+    async def register(self):
+        # Registrar blocks on requests, keep it off the loop
+        stop = threading.Event()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.registrar.ensure, stop)
+        finally:
+            stop.set()
+
+    async def _writer(self, conn):
+        while True:
+            # never blocks: everything that queues runs on this loop and
+            # sets _ready, so an empty outbox stays empty until then
+            item = self.outbox.get(timeout=0)
+            if item is None:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            try:
+                await conn.send(Outbox.frame(item))
+            except Exception:
+                # the connection failed mid-send
+                SEND_ERRORS.inc()
+                self.outbox.requeue(item)
+                raise
+            except BaseException:
+                # the session ended mid-send
+                self.outbox.requeue(item)
+                raise
+            FRAMES_OUT.inc()
+            self.outbox.done(item)
+
+    async def _session(self, conn):
+        writer = asyncio.ensure_future(self._writer(conn))
+        try:
+            async for raw in conn:
+                self._received(raw)
+        finally:
+            writer.cancel()
+
+    def _checkRegistration(self):
+        if self.registrar.check(self.orders) and self._registration.done():
+            # the coordinator restarted and lost us, register again
+            self._registration = asyncio.ensure_future(self.register())
+
+    async def run(self):
+        import websockets
+
+        self._registration = asyncio.ensure_future(self.register())
+        attempt = 0
+        try:
+            while True:
+                try:
+                    # websockets pings every 20s and fails the connection
+                    # when the pong does not come back
+                    compression = 'deflate' if os.getenv('WS_COMPRESSION', 'deflate') == 'deflate' else None
+                    async with websockets.connect(self.address, compression=compression) as conn:
+                        attempt = 0
+                        self.orders.reset() # whatever the coordinator says first is news
+                        transport.count_extensions(getattr(conn, 'protocol', conn), self.compression)
+                        self.connected.set()
+                        logger.info("connected to %s%s", self.address,
+                                    " (compressed)" if self.compression.negotiated else "")
+                        try:
+                            await self._session(conn)
+                        except asyncio.CancelledError:
+                            await conn.close() # shutting down, a normal close
+                            raise
+                except (OSError, websockets.WebSocketException) as e:
+                    logger.warning("connection lost: %s", e)
+                finally:
+                    self.connected.clear()
+
+                # queued messages survive until the next connection
+                delay = backoff_delay(attempt)
+                attempt += 1
+                RECONNECTS.inc()
+                logger.info("reconnecting in %.1fs", delay)
+                await asyncio.sleep(delay)
+        finally:
+            self._registration.cancel()
+
+    def stop(self):
+        # the run() task is cancelled by its owner
+        self.log_stats()
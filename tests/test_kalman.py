@@ -0,0 +1,44 @@
+import math
+import os
+import sys
+
+import pytest
+
+# the application modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpsd_code"))
+
+np = pytest.importorskip("numpy") # batch() only, the device runs without it
+
+from fix import Fix
+from kalman import FixFilter, walk, _KY
+
+
+def track():
+    _, xy, _ = walk(n=300)
+    lat0, lon0 = 53.2680, -0.5240
+    lat = lat0 + xy[:, 1] / _KY
+    lon = lon0 + xy[:, 0] / (_KY * math.cos(math.radians(lat0)))
+    t = 1605607810. + np.arange(len(lat))
+    t[150:] += 60 # a gap, the filter starts again
+    return lat, lon, t, np.full(len(lat), 4.)
+
+
+def test_single_track_batch_matches_streaming():
+    lat, lon, t, sigma = track()
+    blat, blon, berr, accepted = FixFilter().batch(lat, lon, t, sigma)
+    streaming = FixFilter()
+    smoothed = [streaming.update(Fix(float(la), float(lo), utc=float(ti), ts=float(ti)))
+                for la, lo, ti in zip(lat, lon, t)]
+    assert (np.array([s is not None for s in smoothed]) == accepted).all()
+    assert not accepted.all()
+    assert np.allclose([s.lat for s in smoothed if s], blat[accepted], rtol=0, atol=1e-9)
+    assert np.allclose([s.epx for s in smoothed if s], berr[accepted])
+
+
+def test_tracks_side_by_side_match_one_at_a_time():
+    lat, lon, t, sigma = track()
+    one = FixFilter().batch(lat, lon, t, sigma)
+    many = FixFilter().batch(*(np.tile(v, (3, 1)) for v in (lat, lon, t, sigma)))
+    for a, b in zip(one, many):
+        assert b.shape == (3, len(lat))
+        assert np.allclose(b, a)
@@ -0,0 +1,68 @@
+import os
+import sys
+
+# the application modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpsd_code"))
+
+import nmea
+from fix import Fix, HAS_SPEED, HAS_ALT
+
+
+def sentence(body):
+    x = 0
+    for c in body:
+        x ^= c
+    return b"$" + body + b"*%02X\r\n" % x
+
+
+def rmc(hms):
+    return sentence(b"GPRMC," + hms + b",A,5211.123456,N,00033.654321,W,1.2,45.0,171120,,,A")
+
+
+def gga(hms):
+    return sentence(b"GPGGA," + hms + b",5211.123456,N,00033.654321,W,1,09,0.8,12.3,M,47.0,M,,")
+
+
+def test_rmc_only_receiver_gets_each_fix_in_its_own_epoch():
+    parser = nmea.FixParser()
+    for hms in (b"101010.0", b"101011.0", b"101012.0"):
+        fixes = parser.feed(rmc(hms))
+        assert len(fixes) == 1
+        assert fixes[0].utc % 60 == float(hms[4:])
+
+
+def test_rmc_and_gga_merge_into_one_fix():
+    parser = nmea.FixParser()
+    parser.feed(gga(b"101009.0") + rmc(b"101009.0")) # the start-up epoch
+    fixes = parser.feed(gga(b"101010.0") + rmc(b"101010.0"))
+    assert len(fixes) == 1
+    fix = fixes[0]
+    assert (fix.alt, fix.sats, fix.hdop) == (12.3, 9, 0.8)
+    assert abs(fix.speed - 1.2 * nmea.KNOTS) < 1e-9
+
+
+def test_bad_checksum_is_an_error():
+    parser = nmea.FixParser()
+    assert parser.feed(rmc(b"101010.0").replace(b"*", b"0*", 1)) == []
+    assert parser.errors == 1
+
+
+def test_optional_fields_are_decoded_on_read():
+    line = b"+CGPSINFO: 5211.123456,N,00033.654321,W,171120,101010.0,12.3,x,45.0\r\n"
+    fix = nmea.FixParser().feed(line)[0]
+    assert fix.__class__ is not Fix
+    assert fix.flags & HAS_SPEED
+    copy = Fix().copy_from(fix) # still undecoded
+    assert copy.alt == 12.3
+    assert copy.__class__ is Fix
+    assert copy.flags & HAS_ALT and not copy.flags & HAS_SPEED # "x" did not parse
+    assert fix.speed == 0. and fix.__class__ is Fix
+
+
+def test_framer_keeps_lines_and_drops_only_an_overlong_tail():
+    framer = nmea.LineFramer(max_size=8)
+    assert framer.feed(b"abc\r\nde") == [b"abc"]
+    assert framer.feed(b"f\r\nghij") == [b"def"]
+    assert framer.feed(b"klmnopqrs") == []
+    assert framer.dropped == 13
+    assert framer.feed(b"yy\r\nzz\r\n") == [b"yy", b"zz"]
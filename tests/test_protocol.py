@@ -0,0 +1,19 @@
+import json
+import os
+import sys
+
+# the application modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpsd_code"))
+
+import protocol
+from fix import Fix
+
+
+def test_every_form_sends_the_same_accuracy():
+    fixes = [Fix(53.2, -0.5, ts=1., epx=2.5, epy=4.0), Fix(53.2, -0.5, ts=2.)]
+    single = [json.loads(protocol.location_update('picker02', f))['accuracy'] for f in fixes]
+    assert single == [4.0, -1]
+    for frame in (protocol.location_batch('picker02', fixes),
+                  protocol.location_batch_binary('picker02', fixes)):
+        _, _, decoded = protocol.decode_location_batch(frame)
+        assert [acc for _, _, acc, _ in decoded] == single
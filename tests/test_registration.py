@@ -0,0 +1,120 @@
+import json
+import os
+import sys
+import time
+
+# the application modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpsd_code"))
+
+from orders import OrdersFilter
+from registration import Registrar
+
+
+USER = 'picker02-device1'
+
+
+def broadcast(states):
+    return json.dumps({'method': 'update_orders', 'states': states})
+
+
+def cached_registrar(tmp_path, **kwargs):
+    registrar = Registrar(USER, site_address='http://coordinator/register',
+                          cache_path=str(tmp_path / 'registration.json'), **kwargs)
+    registrar._store()
+    assert registrar.cached()
+    return registrar
+
+
+def test_orders_filter_counts_broadcasts_without_us():
+    orders = OrdersFilter(USER)
+    for _ in range(3):
+        assert orders.feed(broadcast({'picker_0001': 'car_INIT'})) is None
+    assert orders.missing == 3
+
+    assert orders.feed(broadcast({USER: 'REGISTERED'})) == 'REGISTERED'
+    assert orders.missing == 0
+
+    orders.feed(broadcast({'picker_0001': 'car_INIT'}))
+    orders.reset()
+    assert orders.missing == 0
+
+
+def test_orders_filter_only_reads_the_states_object():
+    orders = OrdersFilter(USER)
+    # our name as a key of a later object is not our state
+    frame = json.dumps({'method': 'update_orders', 'states': {'picker_0001': 'car_INIT'},
+                        'robots': {USER: 'car_ACCEPT'}})
+    assert orders.feed(frame) is None and orders.missing == 1
+    # a '}' inside a state name does not hide us
+    frame = broadcast({'picker_0001': 'odd}state', USER: 'car_ACCEPT'})
+    assert orders.feed(frame) == 'car_ACCEPT'
+
+
+def test_cached_registration_forgotten_when_coordinator_lost_us(tmp_path):
+    registrar = cached_registrar(tmp_path, missing_frames=3, retry_interval=60)
+    orders = OrdersFilter(USER)
+    assert registrar.ensure() # from the cache, no POST
+
+    # the coordinator restarted: its broadcasts no longer have us
+    for _ in range(2):
+        orders.feed(broadcast({'picker_0001': 'car_INIT'}))
+        assert not registrar.check(orders, now=1001.)
+    orders.feed(broadcast({'picker_0001': 'car_INIT'}))
+    assert registrar.check(orders, now=1001.)
+    assert not registrar.cached()
+    assert not registrar.registered.is_set()
+
+    # and not again straight away
+    for _ in range(3):
+        orders.feed(broadcast({'picker_0001': 'car_INIT'}))
+    assert not registrar.check(orders, now=1002.)
+
+
+def test_quiet_link_keeps_its_registration(tmp_path):
+    # a coordinator with nothing to broadcast has not forgotten us
+    registrar = cached_registrar(tmp_path, missing_frames=3, retry_interval=30)
+    orders = OrdersFilter(USER)
+    orders.feed('{"method": "ping"}')
+    for now in (1000., 1031., 1100., 5000.):
+        assert not registrar.check(orders, now=now)
+    assert registrar.cached()
+
+
+def test_known_picker_keeps_its_registration(tmp_path):
+    registrar = cached_registrar(tmp_path, missing_frames=3, retry_interval=30)
+    orders = OrdersFilter(USER)
+    for state in ('CONNECTED', 'REGISTERED', 'REGISTERED', 'car_INIT'):
+        orders.feed(broadcast({USER: state, 'picker_0001': 'car_INIT'}))
+    assert not registrar.check(orders, now=1100.)
+    assert registrar.cached()
+
+
+def test_websocket_registers_again_after_coordinator_restart(tmp_path, monkeypatch):
+    from replay import FakeCoordinator, RegistrationServer
+    import ws
+
+    # a coordinator that only knows another picker, as after its restart
+    coordinator = FakeCoordinator('picker_0001', script=[(0.1, 'car_INIT'), (0.2, 'car_INIT'), (0.3, 'car_INIT')],
+                                  pickers=0)
+    registration = RegistrationServer()
+    coordinator.start()
+    registration.start()
+    monkeypatch.setenv('SITE_ADDRESS', registration.address)
+    monkeypatch.setenv('REGISTRATION_CACHE', str(tmp_path / 'registration.json'))
+    monkeypatch.setenv('WS_JOURNAL', str(tmp_path / 'journal'))
+
+    link = ws.WS(address=coordinator.address, user_name=USER)
+    link.registrar._store() # registered with the coordinator before its restart
+    link.start()
+    try:
+        deadline = time.time() + 10
+        while not registration.posts and time.time() < deadline:
+            time.sleep(0.05)
+        assert len(registration.posts) == 1
+        assert USER in registration.posts[0].decode()
+        assert link.registrar.registered.wait(5)
+        assert link.registrar.cached()
+    finally:
+        link.stop()
+        coordinator.stop()
+        registration.stop()
@@ -0,0 +1,32 @@
+import os
+import sys
+
+# the application modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpsd_code"))
+
+from robotStateCode import RobotState, SCRIPTS, VIEWS, _legacy
+
+
+def test_table_agrees_with_the_old_if_chains():
+    for events, expected in SCRIPTS:
+        rs, legacy = RobotState(), 'INIT'
+        for event in events:
+            rs.fire(event)
+            legacy = _legacy(legacy, event)
+            assert rs.state == legacy, (events, event)
+        assert rs.state == expected, events
+
+
+def test_refused_button_changes_nothing():
+    rs = RobotState('car_CALLED')
+    assert rs.fire('blue') is None
+    assert rs.state == 'car_CALLED'
+
+
+def test_unknown_state_is_taken_and_buttons_act_as_in_init():
+    rs = RobotState()
+    step = rs.fire('car_PAUSED')
+    assert (rs.state, step.action, step.view) == ('car_PAUSED', None, None)
+    assert rs.fire('green') is None
+    step = RobotState('REGISTERED').fire('green')
+    assert (step.dest, step.action, step.view) == ('car_CALLED', 'call_robot', VIEWS['requested'])
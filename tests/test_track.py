@@ -0,0 +1,57 @@
+import os
+import sys
+
+# the application modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpsd_code"))
+
+from fix import Fix
+from fixbuffer import FixRing
+from track import Track, TrackRecorder, list_files
+
+
+T0 = 1600000000.
+
+
+def recorder(directory, **kwargs):
+    return TrackRecorder(FixRing(8).subscribe("track"), str(directory), records_per_file=10, **kwargs)
+
+
+def test_clock_step_does_not_reorder_the_track(tmp_path):
+    # the system clock is set back a day by NTP half way through
+    rec = recorder(tmp_path, max_files=100)
+    fix = Fix(53.2, -0.5, utc=T0)
+    for i in range(40):
+        fix.utc = T0 + i
+        fix.ts = T0 + i - (86400 if i >= 20 else 0)
+        rec.record(fix)
+    rec._close()
+
+    track = Track(str(tmp_path))
+    assert len(track) == 40
+    assert track.at(T0 + 25.5).utc == T0 + 25
+    assert [f.utc for f in track.between(T0 + 18, T0 + 22)] == [T0 + 18, T0 + 19, T0 + 20, T0 + 21]
+    track.close()
+
+
+def test_files_continue_the_sequence_and_prune_oldest(tmp_path):
+    fix = Fix(53.2, -0.5, utc=T0)
+    for run in range(3):
+        rec = recorder(tmp_path, max_files=3)
+        for i in range(20):
+            fix.utc += 1
+            rec.record(fix)
+        rec._close()
+    names = [os.path.basename(p) for p in list_files(str(tmp_path))]
+    assert names == ["track-00000003.bin", "track-00000004.bin", "track-00000005.bin"]
+
+
+def test_fix_without_utc_keeps_the_last_one(tmp_path):
+    rec = recorder(tmp_path)
+    rec.record(Fix(53.2, -0.5, utc=T0))
+    rec.record(Fix(53.2, -0.5, ts=T0 + 1))
+    rec._close()
+
+    track = Track(str(tmp_path))
+    fix = track.at(T0 + 5)
+    assert fix.utc == T0 and fix.ts == T0 + 1
+    track.close()
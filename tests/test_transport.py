@@ -0,0 +1,45 @@
+import json
+import os
+import sys
+import time
+import warnings
+
+# the application modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpsd_code"))
+
+import transport
+from replay import FakeCoordinator
+
+
+def exchange(compression):
+    # one location_update through transport.connect() -> (transport, stats, coordinator)
+    coordinator = FakeCoordinator('picker02', script=[], pickers=0, compression=compression)
+    coordinator.start()
+    stats = transport.CompressionStats()
+    link = transport.connect(coordinator.address, 2, stats)
+    try:
+        link.send(json.dumps({'method': 'location_update', 'latitude': 53.2}))
+        deadline = time.time() + 5
+        while not coordinator.received and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        link.close()
+        coordinator.stop()
+    return link, stats, coordinator
+
+
+def test_declined_compression_sends_uncompressed():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        link, stats, coordinator = exchange(None)
+    assert isinstance(link, transport.DeflateTransport)
+    assert coordinator.received['location_update'] == 1
+    assert not stats.negotiated
+    assert stats.tx_raw == stats.tx_wire > 0
+
+
+def test_negotiated_compression_is_counted():
+    link, stats, coordinator = exchange('deflate')
+    assert coordinator.received['location_update'] == 1
+    assert stats.negotiated
+    assert stats.tx_raw > 0 and stats.tx_wire > 0
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+
+# the application modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpsd_code"))
+
+from gui import Display
+from ui import UI
+
+
+class Leds(object):
+    def __init__(self):
+        self.writes = []
+
+    def setRedLed(self, v):
+        self.writes.append(('r', v))
+
+    def setGreenLed(self, v):
+        self.writes.append(('g', v))
+
+    def setBlueLed(self, v):
+        self.writes.append(('b', v))
+
+
+def started():
+    display = Display(None, None, None)
+    ui = UI(display, Leds())
+    ui.start()
+    display.update()
+    return display, ui
+
+
+def test_idle_ui_schedules_nothing():
+    display, ui = started()
+    assert display._timers == []
+
+    ui.set(r=True)
+    ui.set_text("Ready to Call")
+    assert len(display._timers) == 1 # both in one frame
+    display.update()
+    assert display.state['red'] and display.state['description'] == "Ready to Call"
+    assert display._timers == []
+
+
+def test_blink_and_toast_keep_one_timer_until_done():
+    display, ui = started()
+    ui.blink('b', period=0.2)
+    ui.toast("Cannot load a robot right now.", seconds=0.05)
+    display.update()
+    assert display.state['description'] == "Cannot load a robot right now."
+    assert len(display._timers) == 1
+    assert display._timers[0][0] - time.time() <= 0.05
+
+    time.sleep(0.06)
+    display.update()
+    assert display.state['description'] == ""
+    ui.stop_blink()
+    display.update()
+    while display._timers: # the blink edge already queued
+        time.sleep(0.01)
+        display.update()
+    assert not display.state['blue']
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import sys
+
+# the application modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpsd_code"))
+
+from fix import Fix
+from outbox import CONTROL, Journal, Outbox
+from ws_async import AsyncWS
+
+
+class FlakyConnection(object):
+    # fails the first `failures` sends, like a link dropping mid-write
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+
+    async def send(self, frame):
+        await asyncio.sleep(0)
+        if self.failures:
+            self.failures -= 1
+            raise OSError("link down")
+        self.sent.append(frame)
+
+
+def run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+async def drain(ws, conn):
+    writer = asyncio.ensure_future(ws._writer(conn))
+    for _ in range(20):
+        await asyncio.sleep(0)
+    writer.cancel()
+    try:
+        await writer
+    except (asyncio.CancelledError, OSError):
+        pass
+
+
+def test_control_survives_a_failed_send_and_goes_first(tmp_path):
+    async def scenario():
+        ws = AsyncWS('ws://unused', 'picker02', journal=Journal(str(tmp_path / 'journal.jsonl')))
+        ws.send_gps(Fix(53.2, -0.5, ts=1.))
+        ws.call_robot()
+
+        await drain(ws, FlakyConnection(failures=1))
+        assert ws.outbox.depth() == 2 # nothing lost
+
+        conn = FlakyConnection()
+        await drain(ws, conn)
+        return ws, conn
+
+    ws, conn = run(scenario())
+    assert [json.loads(f)['method'] for f in conn.sent] == ['call', 'location_update']
+    assert ws.outbox.depth() == 0
+
+
+def test_control_is_never_dropped_for_locations(tmp_path):
+    async def scenario():
+        ws = AsyncWS('ws://unused', 'picker02', journal=Journal(str(tmp_path / 'journal.jsonl')))
+        ws.set_loaded()
+        for i in range(200):
+            ws.send_gps(Fix(53.2 + i * 1e-5, -0.5, ts=float(i)))
+        conn = FlakyConnection()
+        await drain(ws, conn)
+        return conn
+
+    conn = run(scenario())
+    assert json.loads(conn.sent[0])['method'] == 'set_state'
+
+
+def test_outbox_keeps_every_control_message(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.jsonl'))
+    outbox = Outbox(journal)
+    for i in range(100):
+        outbox.put_control('call %d' % i)
+    assert outbox.dropped == 0
+    assert len(journal.load()) == 100
+    item = outbox.get(timeout=0)
+    assert item[0] == CONTROL and Outbox.frame(item) == 'call 0'
+    outbox.done(item)
+    assert len(journal.load()) == 99
+
+
+def test_orders_reach_the_callback_once(tmp_path):
+    async def scenario():
+        states = []
+        ws = AsyncWS('ws://unused', 'picker02', states.append, journal=Journal(str(tmp_path / 'journal.jsonl')))
+        ws._registration = asyncio.get_running_loop().create_future() # registered
+        ws._registration.set_result(None)
+        frame = json.dumps({'method': 'update_orders', 'states': {'picker02': 'car_ACCEPT'}})
+        for raw in (frame, frame, b'\x00binary'):
+            ws._received(raw)
+        ws.send_metrics({'counters': {}})
+        return states, ws
+
+    states, ws = run(scenario())
+    assert states == ['car_ACCEPT']
+    assert json.loads(Outbox.frame(ws.outbox.get(timeout=0)))['method'] == 'metrics'